@@ -17,5 +17,8 @@ def render(filename, output=None):
 
     """
     kp = Knitpy()
-    return kp.render(filename, output=output)
+    try:
+        return kp.render(filename, output=output)
+    finally:
+        kp.shutdown_kernels()
 
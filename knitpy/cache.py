@@ -0,0 +1,246 @@
+# encoding: utf-8
+"""
+Caching of chunk results (the knitr `cache=TRUE` chunk option) and of markup conversions.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+
+from pypandoc import get_pandoc_version
+
+from traitlets.config.configurable import LoggingConfigurable
+from traitlets import Integer, Unicode
+
+from .py3compat import iteritems, cast_bytes, cast_unicode
+
+# Bump this if the format of the cache entries changes
+CACHE_FORMAT_VERSION = "1"
+
+# Bump this if the conversion of markup changes (e.g. how the html is prepared for pandoc)
+MARKUP_CACHE_VERSION = "1"
+
+
+class DiskStore(object):
+    """A content addressed store of compressed entries in a directory
+
+    If the entries in the store get bigger than `max_size` (in bytes), the least recently used
+    entries are removed.
+    """
+
+    def __init__(self, directory, max_size, log):
+        self.directory = directory
+        self.max_size = max_size
+        self.log = log
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        """Returns the data stored under key or None if there is no such entry"""
+        filename = self._filename(key)
+        try:
+            with open(filename, "rb") as f:
+                data = zlib.decompress(f.read())
+        except (IOError, OSError, zlib.error):
+            return None
+        # mark as recently used
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, data):
+        """Stores the data (bytes) under key"""
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        filename = self._filename(key)
+        # write to a temporary file first, so that a half written entry is never read (one per
+        # writer: the same entry can be written by more than one thread)
+        tmp_filename = "%s.%s.tmp" % (filename, uuid.uuid4().hex)
+        try:
+            with open(tmp_filename, "wb") as f:
+                f.write(zlib.compress(data))
+            os.rename(tmp_filename, filename)
+        except (IOError, OSError):
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the store is not bigger than max_size"""
+        if self.max_size <= 0:
+            return
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                # still written by another thread or process (see put())
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, filename))
+            total += stat.st_size
+        entries.sort()
+        while entries and total > self.max_size:
+            mtime, size, filename = entries.pop(0)
+            self.log.debug("Removing cache entry %s.", filename)
+            try:
+                os.remove(filename)
+            except OSError:
+                continue
+            total -= size
+
+
+class ChunkCache(LoggingConfigurable):
+    """On disk cache for the results of code chunks with the `cache=True` option
+
+    The entries are stored under a key which covers the chunk code, the chunk options, the
+    engine, the enabled image formats and the keys of the chunks it depends on (see
+    :mod:`knitpy.dependencies`), so a change in a chunk only invalidates the chunks which depend
+    on it. An entry holds the recorded kernel messages (which include the figures) and the
+    objects which the chunk created in the kernel.
+    """
+
+    max_size = Integer(512 * 1024 * 1024, config=True,
+        help="""Maximal size (in bytes) of the cache of a document. Least recently used entries
+                are removed if the cache gets bigger (0: unlimited).""")
+
+    def __init__(self, directory, **kwargs):
+        super(ChunkCache, self).__init__(**kwargs)
+        self.directory = directory
+        self._store = DiskStore(directory, self.max_size, self.log)
+
+    def key(self, chunk, image_formats, upstream_keys, params=None):
+        """Returns the cache key for a chunk
+
+        params : dict or None
+            the parameters of the document (see `Knitpy.render_sweep()`)
+        """
+        parts = [CACHE_FORMAT_VERSION, chunk.engine.name, chunk.code,
+                 repr(sorted((k, repr(v)) for k, v in iteritems(chunk.args))),
+                 repr(sorted(image_formats))]
+        if params is not None:
+            parts.append(json.dumps(params, sort_keys=True, default=str))
+        parts.extend(upstream_keys)
+        return hashlib.sha1(cast_bytes("\0".join(parts), "utf-8")).hexdigest()
+
+    def load(self, key):
+        """Returns the entry (a dict with 'messages' and 'objects') or None"""
+        data = self._store.get(key)
+        if data is None:
+            return None
+        try:
+            return pickle.loads(data)
+        except Exception:
+            self.log.warn("Could not read cache entry %s, ignoring it.", key)
+            return None
+
+    def store(self, key, messages, objects):
+        """Stores the recorded messages and the objects (engine specific) under key"""
+        # Only keep what is needed to replay the messages: the rest might not be picklable
+        messages = [{"msg_type": msg["msg_type"], "content": msg["content"],
+                     "header": {"msg_type": msg["msg_type"]}, "parent_header": {}}
+                    for msg in messages]
+        entry = {"messages": messages, "objects": objects}
+        try:
+            self._store.put(key, pickle.dumps(entry, 2))
+        except (IOError, OSError) as e:
+            self.log.warn("Could not write cache entry %s, not caching it: %s", key, e)
+
+
+class MarkupCache(LoggingConfigurable):
+    """Memo of markup conversions (see `TemporaryOutputDocument.add_markup_text()`)
+
+    The converted text is stored under a key which covers the markup, its format, the target
+    format and the pandoc version. The most recently used entries are kept in memory and, if
+    `directory` is set, also on disk, so that later runs don't need pandoc for the same markup.
+    One cache is used for all documents (and output formats) of a :class:`knitpy.Knitpy`.
+    """
+
+    memory_entries = Integer(512, config=True,
+        help="""Number of conversions which are kept in memory (0: none).""")
+
+    directory = Unicode("", config=True,
+        help="""Directory where the conversions are also stored on disk, e.g.
+                `~/.cache/knitpy/markup`. Empty: only in memory.""")
+
+    max_size = Integer(64 * 1024 * 1024, config=True,
+        help="""Maximal size (in bytes) of the conversions on disk. Least recently used entries
+                are removed if the store gets bigger (0: unlimited).""")
+
+    def __init__(self, **kwargs):
+        super(MarkupCache, self).__init__(**kwargs)
+        # key -> converted text, the most recently used last
+        self._entries = OrderedDict()
+        # the cache can be used by more than one thread
+        self._lock = threading.Lock()
+        self._store = None
+        if self.directory:
+            self._store = DiskStore(os.path.expanduser(self.directory), self.max_size, self.log)
+        self._pandoc_version = None
+
+    def key(self, source, from_format, to_format):
+        """Returns the key for the conversion or None, if pandoc is not available"""
+        if self._pandoc_version is None:
+            try:
+                self._pandoc_version = get_pandoc_version()
+            except Exception:
+                # without pandoc, there is nothing to convert (and nothing to cache)
+                return None
+        parts = [MARKUP_CACHE_VERSION, self._pandoc_version, from_format, to_format, source]
+        return hashlib.sha1(cast_bytes("\0".join(parts), "utf-8")).hexdigest()
+
+    def get(self, key):
+        """Returns the converted text or None"""
+        if key is None:
+            return None
+        with self._lock:
+            text = self._entries.pop(key, None)
+            if text is not None:
+                self._entries[key] = text
+                return text
+        if self._store is None:
+            return None
+        data = self._store.get(key)
+        if data is None:
+            return None
+        text = cast_unicode(data, "utf-8")
+        self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        """Stores the converted text under key"""
+        if key is None:
+            return
+        self._remember(key, text)
+        if self._store is not None:
+            try:
+                self._store.put(key, cast_bytes(text, "utf-8"))
+            except (IOError, OSError) as e:
+                self.log.warn("Could not store the converted markup in %s: %s",
+                              self.directory, e)
+
+    def _remember(self, key, text):
+        if self.memory_entries <= 0:
+            return
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = text
+            while len(self._entries) > self.memory_entries:
+                self._entries.popitem(last=False)
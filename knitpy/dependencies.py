@@ -0,0 +1,377 @@
+# encoding: utf-8
+"""
+Static analysis of the names which code chunks define and read and the resulting dependencies
+between the chunks of a document.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import ast
+import re
+
+from .utils import is_string
+
+# IPython magics which don't define or read any names of the document
+HARMLESS_MAGICS = ["matplotlib", "colors", "config"]
+
+_re_magic = re.compile(r"get_ipython\(\)\.run_(?:line|cell)_magic\(\s*['\"](\w+)['\"]")
+
+_FUNCTION_NODES = (ast.FunctionDef, ast.Lambda) + \
+                  ((ast.AsyncFunctionDef,) if hasattr(ast, "AsyncFunctionDef") else ())
+
+
+class CodeNames(object):
+    """The names which a piece of code defines, reads and (probably) modifies"""
+
+    def __init__(self):
+        # names which are bound by the code
+        self.defines = set()
+        # names which are bound by import statements (these are not modified by method calls)
+        self.imports = set()
+        # names which are read before they are bound in the code
+        self.reads = set()
+        # names of objects which are (probably) modified in place: `x[0] = 1`, `x.a += 1`
+        self.modifies = set()
+        # names of objects which have methods called on them (`x.append(1)`)
+        self.calls = set()
+        # function/class name -> (names read, global names bound) when it is called
+        self.deferred = {}
+        # `from x import *`: unknown names are defined
+        self.star_import = False
+        # the code does things which can't be analysed (e.g. IPython magics), so it might read
+        # and define anything
+        self.opaque = False
+
+
+def _root_name(node):
+    """Returns the name at the root of `a.b[c].d` or None"""
+    while isinstance(node, (ast.Attribute, ast.Subscript)):
+        node = node.value
+    if isinstance(node, ast.Name):
+        return node.id
+    return None
+
+
+def _function_names(node):
+    """Returns (names read, global names bound) of a function/lambda/class body"""
+    reads = set()
+    global_names = set()
+    local_names = set()
+    args = getattr(node, "args", None)
+    if args is not None:
+        for arg in ast.walk(args):
+            if isinstance(arg, ast.Name):
+                local_names.add(arg.id)
+            elif hasattr(ast, "arg") and isinstance(arg, ast.arg):
+                local_names.add(arg.arg)
+    body = node.body if isinstance(node.body, list) else [node.body]
+    for stmt in body:
+        for child in ast.walk(stmt):
+            if isinstance(child, ast.Global):
+                global_names.update(child.names)
+            elif isinstance(child, ast.Name):
+                if isinstance(child.ctx, ast.Load):
+                    reads.add(child.id)
+                else:
+                    local_names.add(child.id)
+    reads -= (local_names - global_names)
+    written_globals = global_names & local_names
+    return reads, written_globals
+
+
+class _StatementVisitor(ast.NodeVisitor):
+    """Collects the names of one top level statement"""
+
+    def __init__(self):
+        self.reads = set()
+        self.defines = set()
+        self.imports = set()
+        self.modifies = set()
+        self.calls = set()
+        self.deferred = {}
+        self.star_import = False
+
+    def visit_Name(self, node):
+        if isinstance(node.ctx, ast.Load):
+            self.reads.add(node.id)
+        else:
+            self.defines.add(node.id)
+
+    def _visit_store_target(self, node):
+        if isinstance(node, (ast.Attribute, ast.Subscript)):
+            name = _root_name(node)
+            if name is not None:
+                self.modifies.add(name)
+                self.reads.add(name)
+        self.generic_visit(node)
+
+    def visit_Attribute(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_store_target(node)
+        else:
+            self.generic_visit(node)
+
+    def visit_Subscript(self, node):
+        if not isinstance(node.ctx, ast.Load):
+            self._visit_store_target(node)
+        else:
+            self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        name = _root_name(node.target)
+        if name is not None:
+            self.reads.add(name)
+            if isinstance(node.target, ast.Name):
+                self.defines.add(name)
+            else:
+                self.modifies.add(name)
+        self.generic_visit(node)
+
+    def visit_Call(self, node):
+        if isinstance(node.func, ast.Attribute):
+            name = _root_name(node.func)
+            if name is not None:
+                self.calls.add(name)
+        self.generic_visit(node)
+
+    def visit_Import(self, node):
+        for alias in node.names:
+            name = alias.asname or alias.name.split(".")[0]
+            self.defines.add(name)
+            self.imports.add(name)
+
+    def visit_ImportFrom(self, node):
+        for alias in node.names:
+            if alias.name == "*":
+                self.star_import = True
+                continue
+            name = alias.asname or alias.name
+            self.defines.add(name)
+            self.imports.add(name)
+
+    def _visit_function(self, node):
+        # decorators and default values are evaluated when the function is defined
+        for decorator in getattr(node, "decorator_list", []):
+            self.visit(decorator)
+        args = getattr(node, "args", None)
+        if args is not None:
+            for default in args.defaults + getattr(args, "kw_defaults", []):
+                if default is not None:
+                    self.visit(default)
+        if hasattr(node, "name"):
+            self.defines.add(node.name)
+            self.deferred[node.name] = _function_names(node)
+        else:
+            # lambda: the body is read when the lambda is called, be conservative
+            reads, _ = _function_names(node)
+            self.reads.update(reads)
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+    visit_Lambda = _visit_function
+
+    def visit_ClassDef(self, node):
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        for base in node.bases:
+            self.visit(base)
+        reads = set()
+        written_globals = set()
+        # names bound in the class body are class attributes, not globals
+        class_names = set()
+        for stmt in node.body:
+            if isinstance(stmt, _FUNCTION_NODES):
+                # methods: read when they are called
+                method_reads, method_globals = _function_names(stmt)
+                reads.update(method_reads)
+                written_globals.update(method_globals)
+                for decorator in getattr(stmt, "decorator_list", []):
+                    self.visit(decorator)
+                class_names.add(stmt.name)
+            else:
+                body = _StatementVisitor()
+                body.visit(stmt)
+                self.reads.update(body.reads - class_names)
+                self.modifies.update(body.modifies - class_names)
+                self.calls.update(body.calls - class_names)
+                class_names.update(body.defines)
+        self.defines.add(node.name)
+        self.deferred[node.name] = (reads, written_globals)
+
+    def _visit_comprehension(self, node):
+        # the targets are local to the comprehension (python 3)
+        inner = _StatementVisitor()
+        targets = set()
+        # the first iterable is evaluated in the enclosing scope (`[x for x in x]`)
+        self.visit(node.generators[0].iter)
+        for number, generator in enumerate(node.generators):
+            if number > 0:
+                inner.visit(generator.iter)
+            inner.visit(generator.target)
+            for condition in generator.ifs:
+                inner.visit(condition)
+            targets.update(child.id for child in ast.walk(generator.target)
+                           if isinstance(child, ast.Name))
+        for field in ("elt", "key", "value"):
+            if hasattr(node, field):
+                inner.visit(getattr(node, field))
+        self.reads.update(inner.reads - targets)
+        self.modifies.update(inner.modifies - targets)
+        self.calls.update(inner.calls - targets)
+        # e.g. `(y := x)` binds in the enclosing scope
+        self.defines.update(inner.defines - targets)
+        self.deferred.update(inner.deferred)
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+
+
+def analyse_python_code(source):
+    """Returns the :class:`CodeNames` of the python source or None if it isn't valid python
+
+    IPython syntax has to be transformed to python before (e.g. magics to
+    `get_ipython().run_line_magic(...)` calls). Magics which are not in HARMLESS_MAGICS make the
+    code opaque.
+    """
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return None
+
+    names = CodeNames()
+    for magic in _re_magic.findall(source):
+        if not magic in HARMLESS_MAGICS:
+            names.opaque = True
+
+    for stmt in tree.body:
+        visitor = _StatementVisitor()
+        visitor.visit(stmt)
+        # names which were bound by an earlier statement of the same code are not read from
+        # upstream
+        names.reads.update(visitor.reads - names.defines)
+        names.modifies.update(visitor.modifies - names.defines)
+        names.calls.update(visitor.calls - names.defines)
+        names.defines.update(visitor.defines)
+        names.imports.difference_update(visitor.defines)
+        names.imports.update(visitor.imports)
+        for name in visitor.defines:
+            names.deferred.pop(name, None)
+        names.deferred.update(visitor.deferred)
+        names.star_import = names.star_import or visitor.star_import
+    return names
+
+
+def _parse_dependson(value, index, labels, log):
+    """Returns the indices of the chunks given in the `dependson` option of chunk `index`"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        values = [value]
+    elif is_string(value):
+        values = [v for v in re.split(r"[\s;]+", value) if v]
+    else:
+        log.warn("Invalid dependson option: %r. Ignored...", value)
+        return []
+    result = []
+    for value in values:
+        if is_string(value) and re.match(r"^-?[0-9]+$", value):
+            value = int(value)
+        if is_string(value):
+            if value in labels:
+                result.append(labels[value])
+            else:
+                log.warn("dependson: unknown chunk label '%s'. Ignored...", value)
+        elif value < 0:
+            # knitr: negative numbers are relative to the current chunk
+            result.append(index + value)
+        else:
+            # knitr: positive numbers are chunk numbers (starting with 1)
+            result.append(value - 1)
+    return [i for i in result if 0 <= i < index]
+
+
+def find_dependencies(chunks, log):
+    """Sets the `dependencies` of each chunk: the indices of the chunks it directly depends on
+
+    chunks : list of ChunkRecording
+        all code chunks of a document in document order. Each chunk needs the attributes
+        `names` (CodeNames or None, if the code couldn't be analysed), `args` and `evaluated`.
+
+    A chunk depends on the last upstream chunk which defined or modified a name it reads or
+    modifies. Chunks which couldn't be analysed depend on all upstream chunks and opaque chunks
+    are depended on by all downstream chunks. Additional dependencies can be given with the
+    `dependson` chunk option (labels and/or chunk numbers like in knitr), these are also set as
+    `declared_dependencies`.
+    """
+    labels = {}
+    # name -> index of the chunk which last defined or modified it
+    writers = {}
+    # name -> (reads, written globals) if the last definition was a function or class
+    deferred = {}
+    # names whose last definition was an import
+    imported = set()
+    last_star_import = None
+    last_opaque = None
+
+    for index, chunk in enumerate(chunks):
+        deps = set()
+        writes = set()
+        names = chunk.names
+        if not chunk.evaluated:
+            names = None
+        elif names is None or names.opaque:
+            deps.update(range(index))
+        else:
+            reads = set(names.reads)
+            writes.update(names.modifies)
+            writes.update(name for name in names.calls if not name in imported)
+            # calling a function reads (and maybe writes) what the function body uses
+            todo = list(reads | names.calls)
+            seen = set()
+            while todo:
+                name = todo.pop()
+                if name in seen or not name in deferred:
+                    continue
+                seen.add(name)
+                body_reads, body_writes = deferred[name]
+                reads.update(body_reads)
+                writes.update(body_writes)
+                todo.extend(body_reads)
+            for name in reads | writes:
+                if name in writers:
+                    deps.add(writers[name])
+                elif last_star_import is not None:
+                    deps.add(last_star_import)
+            if last_opaque is not None:
+                deps.add(last_opaque)
+
+        declared = set()
+        if "dependson" in chunk.args:
+            declared.update(_parse_dependson(chunk.args["dependson"], index, labels, log))
+            deps.update(declared)
+
+        deps.discard(index)
+        chunk.dependencies = sorted(deps)
+        chunk.declared_dependencies = sorted(declared)
+
+        label = chunk.args.get("chunk_label")
+        if label:
+            labels[label] = index
+
+        if names is None:
+            continue
+        for name in names.defines:
+            writers[name] = index
+            deferred.pop(name, None)
+            imported.discard(name)
+        for name in writes:
+            writers[name] = index
+        deferred.update(names.deferred)
+        imported.update(names.imports)
+        if names.star_import:
+            last_star_import = index
+        if names.opaque:
+            last_opaque = index
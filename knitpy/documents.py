@@ -1,8 +1,10 @@
 from __future__ import absolute_import, unicode_literals
 
 import os
+import io
 import tempfile
 import re
+import uuid
 from collections import OrderedDict
 
 try:
@@ -18,10 +20,12 @@ from pypandoc import convert as pandoc
 
 # Basic things from IPython
 from traitlets.config.configurable import LoggingConfigurable
-from traitlets import Bool, Unicode, CaselessStrEnum, List, Instance
+from traitlets import Bool, Unicode, CaselessStrEnum, List, Instance, Integer
 
-from .py3compat import iteritems
+from .py3compat import iteritems, unicode_type
 from .utils import is_iterable, is_string
+from .htmltables import html_tables_to_markdown
+from .pandocserver import PandocServerUnavailable
 
 TEXT, OUTPUT, CODE, ASIS = "text", "output", "code", "asis"
 
@@ -41,6 +45,32 @@ MARKUP_FORMAT_CONVERTER = OrderedDict([("text/markdown", "markdown"),
 class KnitpyOutputException(Exception):
     pass
 
+class _PendingMarkup(unicode_type):
+    """Placeholder in the output for markup, which is not yet converted to markdown
+
+    Replaced by `text` when the pending conversions are done (see
+    `TemporaryOutputDocument.convert_pending()`).
+    """
+
+    def __new__(cls, number, mimetype, mimedata, fallbacks, results, comment):
+        self = super(_PendingMarkup, cls).__new__(cls, "<knitpy markup %s>" % number)
+        self.mimetype = mimetype
+        self.mimedata = mimedata
+        self.fallbacks = fallbacks
+        # the chunk options at the time the markup was added, needed for the fallbacks
+        self.results = results
+        self.comment = comment
+        self.text = None
+        return self
+
+def _ensure_dir(path):
+    # another process (e.g. `knitpy -j N`) might create the same directory at the same time
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
 # this is the intersection of what matplotlib supports (eps, pdf, pgf, png, ps, raw, rgba, svg,
 # svgz) and what IPython supports ('png', 'png2x', 'retina', 'jpg', 'jpeg', 'svg', 'pdf')...
 _possible_image_formats = CaselessStrEnum(values=['pdf', 'png', 'svg'])
@@ -127,6 +157,11 @@ class TemporaryOutputDocument(LoggingConfigurable):
         help="""Whether to print outputs to the (debug) log""")
     # TODO: put loglevel to debug of this is True...
 
+    stream_to_file = Bool(False, config=True,
+        help="""Whether flushed output is written to a temporary file instead of being kept in
+                memory. Pandoc then converts that file, so big documents don't need to fit into
+                memory (more than once).""")
+
     code_startmarker = Unicode("```{}", config=True,
                                help="Start of a code block, with language placeholder and "
                                     "without linefeed")
@@ -138,6 +173,20 @@ class TemporaryOutputDocument(LoggingConfigurable):
     error_line = Unicode("**ERROR**: {}", config=True,
                          help="error message line, with msg placeholder and without linefeed")
 
+    batch_markup_conversions = Bool(True, config=True,
+        help="""Whether markup (html, latex), which needs to be converted to markdown, is
+                collected and converted in one pandoc run per markup format (when the document is
+                finished or `markup_batch_size` conversions are pending) instead of one pandoc run
+                per output.""")
+
+    native_html_tables = Bool(True, config=True,
+        help="""Whether html outputs, which only consist of simple tables (e.g. pandas
+                DataFrames), are converted to markdown tables by knitpy instead of pandoc.""")
+
+    markup_batch_size = Integer(100, config=True,
+        help="""Maximum number of pending markup conversions: more start the conversion of the
+                pending ones. 0 means no limit.""")
+
     export_config = Instance(klass=FinalOutputConfiguration, help="Final output document configuration")
 
 
@@ -151,6 +200,14 @@ class TemporaryOutputDocument(LoggingConfigurable):
 
     context = Instance(klass="knitpy.knitpy.ExecutionContext", config=False, allow_none=True)
 
+    markup_cache = Instance(klass="knitpy.cache.MarkupCache", config=False, allow_none=True,
+                            help="The memo of markup conversions (None: no memo)")
+
+    pandoc_server = Instance(klass="knitpy.pandocserver.PandocServer", config=False,
+                             allow_none=True,
+                             help="The pandoc server for markup conversions (None: a pandoc "
+                                  "subprocess for each conversion)")
+
     def __init__(self, fileoutputs, export_config, **kwargs):
         super(TemporaryOutputDocument,self).__init__(**kwargs)
         self._fileoutputs = fileoutputs
@@ -163,11 +220,16 @@ class TemporaryOutputDocument(LoggingConfigurable):
         self._cache_code = []
         self._cache_code_language = None
         self._cache_output = []
+        # the temporary file in streaming mode (see `stream_to_file`)
+        self._file = None
+        self._filename = None
+        # the placeholders of markup, which still needs to be converted
+        self._pending = []
 
     @property
     def outputdir(self):
         if not os.path.isdir(self._fileoutputs):
-            os.mkdir(self._fileoutputs)
+            _ensure_dir(self._fileoutputs)
             self.log.info("Support files will be in %s", os.path.join(self._fileoutputs, ''))
 
         return self._fileoutputs
@@ -177,13 +239,63 @@ class TemporaryOutputDocument(LoggingConfigurable):
         plotdir_name = "figure-%s" % self.export_config.file_extension
         plotdir = os.path.join(self.outputdir, plotdir_name)
         if not os.path.isdir(plotdir):
-            os.mkdir(plotdir)
+            _ensure_dir(plotdir)
         return plotdir
 
     @property
     def content(self):
         self.flush()
-        return "".join(self._output)
+        self.convert_pending()
+        if self._filename is None:
+            return "".join(self._output)
+        with io.open(self.save(), "r", encoding="utf-8") as f:
+            return f.read()
+
+    def save(self):
+        """Writes the complete output into the temporary file and returns its filename
+
+        Only available with `stream_to_file`. The file is removed by :meth:`cleanup`.
+        """
+        assert self.stream_to_file, "Output is not streamed to a file."
+        self.flush()
+        self.convert_pending()
+        self._spill(keep_last=False)
+        self._file.flush()
+        return self._filename
+
+    def cleanup(self):
+        """Removes the temporary file (if any)"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._filename is not None:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+            self._filename = None
+
+    def _spill(self, keep_last=True):
+        # writes the flushed output to the temporary file. The last (non-empty) part is kept by
+        # default, as _ensure_newline() needs to look at (and change) it.
+        if self._file is None:
+            fd, self._filename = tempfile.mkstemp(suffix=".md", prefix="knitpy-")
+            self._file = io.open(fd, "w", encoding="utf-8")
+        last = len(self._output)
+        if keep_last:
+            last -= 1
+            while last >= 0 and self._output[last] == "":
+                last -= 1
+        if self._pending:
+            # placeholders stay in memory until their markup is converted
+            for pos, part in enumerate(self._output[:max(last, 0)]):
+                if isinstance(part, _PendingMarkup):
+                    last = pos
+                    break
+        if last <= 0:
+            return
+        self._file.write("".join(self._output[:last]))
+        del self._output[:last]
 
     # The caching system is needed to make fusing together same "type" of content possible
     # -> code inputs without output should go to the same block
@@ -218,22 +330,21 @@ class TemporaryOutputDocument(LoggingConfigurable):
             self._cache_code_language = None
         if self._cache_output:
             self._ensure_newline()
-            self._output.append(self.output_startmarker)
-            self._output.append("\n")
-            comment = self.context.comment
-            if comment:
-                comment = str(comment) + " "
-                outputs = "".join(self._cache_output)
-                outputs = outputs[:-1] if outputs[-1] == "\n" else outputs
-                outputs = outputs.split("\n")
-                outputs = [comment + line + "\n" for line in outputs]
-                self._output.extend(outputs)
-            else:
-                self._output.extend(self._cache_output)
-                self._ensure_newline()
-            self._output.append(self.output_endmarker)
-            self._output.append("\n")
+            self._output.append(self._output_block("".join(self._cache_output),
+                                                   self.context.comment))
             self._cache_output = []
+        if self.stream_to_file:
+            self._spill()
+
+    def _output_block(self, output, comment):
+        """Returns the output block for the text output"""
+        if comment:
+            comment = str(comment) + " "
+            output = output[:-1] if output[-1] == "\n" else output
+            output = "".join([comment + line + "\n" for line in output.split("\n")])
+        elif output[-1] != "\n":
+            output += "\n"
+        return "%s\n%s%s\n" % (self.output_startmarker, output, self.output_endmarker)
 
     def _add_to_cache(self, content, content_type):
 
@@ -323,7 +434,59 @@ class TemporaryOutputDocument(LoggingConfigurable):
             raise KnitpyOutputException(str(e))
 
 
-    def add_markup_text(self, mimetype, mimedata):
+    def add_markup_text(self, mimetype, mimedata, fallbacks=None):
+        """Adds marked up text, converted to markdown if the final output can't include it
+
+        With `batch_markup_conversions`, the conversion is only done later (together with the
+        other pending ones, see :meth:`convert_pending`) and a placeholder is added instead.
+
+        fallbacks : list or None
+            (mimetype, mimedata), which are included instead (the first one which works) if a
+            batched conversion fails: other markup mimetypes or "text/plain" (added as output
+            or, with `results='asis'`, as is). Without batching, a failed conversion raises a
+            :class:`KnitpyOutputException` right away.
+        """
+        converted = self._convert_natively(mimetype, mimedata)
+        if converted is not None:
+            mimedata = converted
+        else:
+            mimedata = self._prepare_markup(mimetype, mimedata)
+            cached = self._cached_markup(mimetype, mimedata)
+            if not self._needs_conversion(mimetype):
+                pass
+            elif cached is not None:
+                mimedata = cached
+            elif self.batch_markup_conversions:
+                context = self.context
+                placeholder = _PendingMarkup(len(self._pending), mimetype, mimedata,
+                                             list(fallbacks or []),
+                                             "markup" if context is None else context.results,
+                                             "##" if context is None else context.comment)
+                self._pending.append(placeholder)
+                mimedata = placeholder
+            else:
+                mimedata = self._convert_markup(mimetype, mimedata)
+
+        self.add_asis("\n")
+        self.add_asis(mimedata)
+        self.add_asis("\n")
+        if self.markup_batch_size and (len(self._pending) >= self.markup_batch_size):
+            self.convert_pending()
+
+    def _needs_conversion(self, mimetype):
+        to_format = "markdown"
+        # try to convert to the current format so that it can be included "asis"
+        return not MARKUP_FORMAT_CONVERTER[mimetype] in [to_format,
+                                                         self.export_config.pandoc_export_format]
+
+    def _convert_natively(self, mimetype, mimedata):
+        """Returns the markdown for simple html tables (without pandoc) or None"""
+        if (mimetype != "text/html") or (not self.native_html_tables) or \
+                (not self._needs_conversion(mimetype)) or (not "<table" in mimedata):
+            return None
+        return html_tables_to_markdown(mimedata)
+
+    def _prepare_markup(self, mimetype, mimedata):
         # workaround for some pandoc weirdness:
         # pandoc interprets html with indention as code and formats it with pre
         # So remove all linefeeds/whitespace...
@@ -336,34 +499,144 @@ class TemporaryOutputDocument(LoggingConfigurable):
             # short. Remove these spaces, as pandoc doesn't like them...
             mimedata = re.sub(' +',' ', mimedata)
 
+        if self._needs_conversion(mimetype) and ("<table" in mimedata):
+            # There is a bug in pandoc <=1.13.2, where th in normal tr is triggers "only
+            # text" conversion.
+            msg = "Trying to fix tables for conversion with pandoc (bug in pandoc <=1.13.2)."
+            self.log.debug(msg)
+            mimedata = self._fix_html_tables_old_pandoc(mimedata)
+        return mimedata
+
+    def _markup_key(self, mimetype, mimedata):
+        if self.markup_cache is None:
+            return None
+        return self.markup_cache.key(mimedata, MARKUP_FORMAT_CONVERTER[mimetype], "markdown")
+
+    def _cached_markup(self, mimetype, mimedata):
+        """Returns the markdown of an earlier conversion of the markup or None"""
+        if (self.markup_cache is None) or not self._needs_conversion(mimetype):
+            return None
+        return self.markup_cache.get(self._markup_key(mimetype, mimedata))
+
+    def _convert_markup(self, mimetype, mimedata):
+        """Converts the (prepared) markup to markdown, raises KnitpyOutputException on errors"""
+        text = self._cached_markup(mimetype, mimedata)
+        if text is None:
+            text = self._run_pandoc(mimetype, mimedata)
+            if self.markup_cache is not None:
+                self.markup_cache.put(self._markup_key(mimetype, mimedata), text)
+        return text
+
+    def _run_pandoc(self, mimetype, mimedata):
         to_format = "markdown"
-        # try to convert to the current format so that it can be included "asis"
-        if not MARKUP_FORMAT_CONVERTER[mimetype] in [to_format,
-                                                     self.export_config.pandoc_export_format]:
-            if "<table" in mimedata:
-                # There is a bug in pandoc <=1.13.2, where th in normal tr is triggers "only
-                # text" conversion.
-                msg = "Trying to fix tables for conversion with pandoc (bug in pandoc <=1.13.2)."
-                self.log.debug(msg)
-                mimedata = self._fix_html_tables_old_pandoc(mimedata)
+        try:
+            self.log.debug("Converting markup of type '%s' to '%s' via pandoc...",
+                           mimetype, to_format)
+            if (self.pandoc_server is not None) and self.pandoc_server.available:
+                try:
+                    return self.pandoc_server.convert(mimedata, to=to_format,
+                                                      format=MARKUP_FORMAT_CONVERTER[mimetype])
+                except PandocServerUnavailable:
+                    # the server logged why, convert it with a subprocess
+                    pass
+            return pandoc(mimedata, to=to_format, format=MARKUP_FORMAT_CONVERTER[mimetype])
+        except RuntimeError as e:
+            # these are pypandoc errors
+            msg = "Could not convert mime data of type '%s' to output format '%s'."
+            self.log.debug(msg, mimetype, to_format)
+            raise KnitpyOutputException(str(e))
+        except Exception as e:
+            msg = "Could not convert mime data of type '%s' to output format '%s'."
+            self.log.exception(msg, mimetype, to_format)
+            raise KnitpyOutputException(str(e))
 
-            try:
-                self.log.debug("Converting markup of type '%s' to '%s' via pandoc...",
-                               mimetype, to_format)
-                mimedata = pandoc(mimedata, to=to_format, format=MARKUP_FORMAT_CONVERTER[mimetype])
-            except RuntimeError as e:
-                # these are pypandoc errors
-                msg = "Could not convert mime data of type '%s' to output format '%s'."
-                self.log.debug(msg, mimetype, to_format)
-                raise KnitpyOutputException(str(e))
-            except Exception as e:
-                msg = "Could not convert mime data of type '%s' to output format '%s'."
-                self.log.exception(msg, mimetype, to_format)
-                raise KnitpyOutputException(str(e))
+    def convert_pending(self):
+        """Converts the markup of all placeholders (see :meth:`add_markup_text`)
 
-        self.add_asis("\n")
-        self.add_asis(mimedata)
-        self.add_asis("\n")
+        The markup of each format is joined (with a marker between the parts) and converted in
+        one pandoc run, the result is split at the markers again. If that fails (or the markers
+        don't come back in order), the parts are converted one by one and if that fails too,
+        the fallbacks of the part are used.
+        """
+        pending, self._pending = self._pending, []
+        if not pending:
+            return
+        by_mimetype = OrderedDict()
+        for placeholder in pending:
+            by_mimetype.setdefault(placeholder.mimetype, []).append(placeholder)
+        for mimetype, placeholders in iteritems(by_mimetype):
+            texts = self._convert_batch(mimetype, [p.mimedata for p in placeholders])
+            for placeholder, text in zip(placeholders, texts):
+                if text is None:
+                    text = self._convert_fallbacks(placeholder)
+                placeholder.text = text
+        for part in (self._output, self._cache_text):
+            for pos, content in enumerate(part):
+                if isinstance(content, _PendingMarkup):
+                    part[pos] = content.text
+
+    def _convert_batch(self, mimetype, texts):
+        """Converts the markup texts, returns the converted texts (None for failed ones)"""
+        results = [self._cached_markup(mimetype, text) for text in texts]
+        # the numbers of the texts, which were not converted before
+        missing = [number for number, result in enumerate(results) if result is None]
+        if len(missing) > 1:
+            converted = self._run_batch(mimetype, [texts[number] for number in missing])
+            if converted is not None:
+                for number, text in zip(missing, converted):
+                    results[number] = text
+                    if self.markup_cache is not None:
+                        self.markup_cache.put(self._markup_key(mimetype, texts[number]), text)
+                missing = []
+        for number in missing:
+            try:
+                results[number] = self._convert_markup(mimetype, texts[number])
+            except KnitpyOutputException as e:
+                self.log.info("Couldn't include markup text: %s", e)
+        return results
+
+    def _run_batch(self, mimetype, texts):
+        """Converts the markup texts in one pandoc run, returns the converted texts or None"""
+        self.log.debug("Converting %s markup outputs of type '%s' in one pandoc run...",
+                       len(texts), mimetype)
+        marker = "knitpy%s" % uuid.uuid4().hex
+        # a paragraph with only the marker (and the number of the part before it)
+        if mimetype == "text/html":
+            separator = "<p>%s%%s</p>" % marker
+        else:
+            separator = "\n\n%s%%s\n\n" % marker
+        source = "".join([text + separator % number for number, text in enumerate(texts)])
+        try:
+            converted = self._run_pandoc(mimetype, source)
+        except KnitpyOutputException as e:
+            self.log.debug("Batched conversion failed (%s), converting one by one.", e)
+            return None
+        parts = re.split(r"^%s(\d+)[ \t]*$" % marker, converted, flags=re.MULTILINE)
+        numbers = [int(number) for number in parts[1::2]]
+        if (numbers != list(range(len(texts)))) or parts[-1].strip():
+            self.log.debug("Markers got lost in the batched conversion, converting one by one.")
+            return None
+        return [part.strip("\n") + "\n" for part in parts[0:-1:2]]
+
+    def _convert_fallbacks(self, placeholder):
+        """Returns the text of the first fallback of the placeholder which works"""
+        for mimetype, mimedata in placeholder.fallbacks:
+            if mimetype == "text/plain":
+                if placeholder.results == "asis":
+                    return mimedata if mimedata[-1] == "\n" else mimedata + "\n"
+                return self._output_block(mimedata, placeholder.comment)
+            converted = self._convert_natively(mimetype, mimedata)
+            if converted is not None:
+                return converted
+            mimedata = self._prepare_markup(mimetype, mimedata)
+            if not self._needs_conversion(mimetype):
+                return mimedata
+            try:
+                return self._convert_markup(mimetype, mimedata)
+            except KnitpyOutputException as e:
+                self.log.info("Couldn't include markup text: %s", e)
+        self.log.warn("Couldn't include markup text of type '%s'.", placeholder.mimetype)
+        return ""
 
     def _fix_html_tables_old_pandoc(self, htmlstring):
         """
@@ -375,30 +648,13 @@ class TemporaryOutputDocument(LoggingConfigurable):
 
         See also: https://github.com/jgm/pandoc/issues/2015
         """
-        result = []
-        pos = 0
-        re_tables = re.compile(r"<table.*</table>", re.DOTALL)
-        re_tbody = re.compile(r"<tbody.*</tbody>", re.DOTALL)
-        tables = re_tables.finditer(htmlstring)
-        for table in tables:
-            # process the html before the match
-            result.append(htmlstring[pos:table.start()])
-            # now the table itself
-            table_html = htmlstring[table.start():table.end()]
-            tbody = re_tbody.search(table_html)
-            if not tbody is None:
-                result.append(table_html[0:tbody.start()])
-                tbody_html = table_html[tbody.start():tbody.end()]
-                tbody_html = tbody_html.replace("<th","<td")
-                tbody_html = tbody_html.replace("</th>", "</td>")
-                result.append(tbody_html)
-                result.append(table_html[tbody.end():])
-            else:
-                result.append(table_html)
-            pos = table.end()
-        result.append(htmlstring[pos:])
+        # non greedy: each tbody on its own, and not everything from the first to the last one
+        re_tbody = re.compile(r"<tbody.*?</tbody>", re.DOTALL)
+
+        def fix_tbody(tbody):
+            return tbody.group(0).replace("<th", "<td").replace("</th>", "</td>")
 
-        return "".join(result)
+        return re_tbody.sub(fix_tbody, htmlstring)
 
 
 
@@ -1,11 +1,31 @@
 from __future__ import absolute_import, unicode_literals
 
-__all__ = ["PythonKnitpyEngine"]
+__all__ = ["PythonKnitpyEngine", "ShellKnitpyEngine", "BashKnitpyEngine", "SqlKnitpyEngine"]
 
 LANGUAGE_ENGINES = []
 
+import ast
+import json
+import re
+
 from traitlets.config.configurable import LoggingConfigurable
-from traitlets import Bool, Unicode, CaselessStrEnum, Instance
+from traitlets import Bool, Integer, Unicode, CaselessStrEnum, Instance
+
+from .dependencies import analyse_python_code, CodeNames
+from .inprocess import INPROCESS_KERNEL_NAME
+from .shellkernel import SHELL_KERNEL_PREFIX, shell_quote
+from .sqlkernel import SQL_KERNEL_NAME, OPTIONS_PREFIX
+
+# Used to check python code for completeness and to transform IPython syntax (magics, ...) into
+# plain python without asking the kernel
+try:
+    # IPython >= 7
+    from IPython.core.inputtransformer2 import TransformerManager as _IPythonInputChecker
+except ImportError:
+    try:
+        from IPython.core.inputsplitter import IPythonInputSplitter as _IPythonInputChecker
+    except ImportError:
+        _IPythonInputChecker = None
 
 
 class BaseKnitpyEngine(LoggingConfigurable):
@@ -13,6 +33,10 @@ class BaseKnitpyEngine(LoggingConfigurable):
     kernel_name = "<NOT_EXISTANT>"
     startup_lines = ""
     language = "<NOT_EXISTANT>" # for syntax highlighting...
+    # True if the code can change or read state outside of the kernel (e.g. files), which the
+    # dependency analysis can't see: such chunks don't run at the same time as chunks of other
+    # kernels (see Knitpy.concurrent_engines)
+    external_effects = False
 
     @property
     def kernel(self):
@@ -30,15 +54,330 @@ class BaseKnitpyEngine(LoggingConfigurable):
         """
         raise NotImplementedError
 
+    def is_complete(self, code):
+        """
+        Checks if the code is complete without asking the kernel.
+
+        returns string or None
+            'complete', 'incomplete' or 'invalid' (like the kernel's `is_complete_reply`) or None
+            if the engine can't check that itself and the kernel has to be asked.
+        """
+        return None
+
+    def split_statements(self, code):
+        """
+        Splits the code of a chunk into groups of top level statements without asking the kernel.
+
+        Comment lines belong to the next statement. Each group is executed on its own and the
+        output of a group is shown below its code.
+
+        returns list of strings or None
+            the code groups or None if the engine can't split the code itself. In this case, the
+            code is split line by line with the help of :meth:`is_complete`.
+        """
+        return None
+
+    def analyse_code(self, code, args=None):
+        """
+        Finds the names which the code of a chunk defines, reads and modifies without running it.
+
+        This is used to find the dependencies between chunks (e.g. for the cache).
+
+        args : dict or None
+            the options of the chunk
+
+        returns CodeNames or None
+            the names (see :class:`knitpy.dependencies.CodeNames`) or None if the engine can't
+            analyse the code. In that case, the chunk depends on all chunks before it.
+        """
+        return None
+
+    def get_chunk_code(self, code, args):
+        """
+        The code which is sent to the kernel for the code of a chunk with the given options.
+
+        returns string
+            the code, e.g. with the options the kernel needs added to it
+        """
+        return code
+
+    def get_output_variable(self, args):
+        """
+        Where the result of a chunk with the given options should be bound to, instead of showing
+        it (e.g. the `output_var` option of sql chunks).
+
+        returns (string, string) or None
+            the name of the engine, in whose kernel the variable is set, and the variable name
+        """
+        return None
+
+    def get_result_expression(self, name):
+        """
+        Expression which returns the result of the last chunk, which should be bound to the
+        variable `name` (see :meth:`get_output_variable`), as a python literal `(columns, rows)`.
+        """
+        raise NotImplementedError
+
+    def get_table_assign_code(self, name, columns, rows):
+        """
+        Code which binds a table (e.g. the result of a sql chunk) to a variable.
+
+        columns : list of strings
+            the column names
+        rows : list of tuples
+            the rows, which only contain python literals
+
+        returns string or None
+            The code which should be run on the kernel or None if the engine doesn't support
+            that.
+        """
+        return None
+
+    def get_batch_code(self, statements, marker):
+        """
+        Code to run several statement groups with one execute request.
+
+        The code has to run each statement like its own execute request would (e.g. display the
+        result of the last expression) and before running statement `i`, it has to flush
+        stdout/stderr and print `marker + str(i) + "@@\\n"` on stdout.
+
+        statements : list of strings
+            the statement groups, as returned by :meth:`split_statements`
+        marker : string
+            the unique start of the marker
+
+        returns string or None
+            The code which should be run on the kernel or None if the engine can't do that. In
+            that case, each statement is run in its own execute request.
+        """
+        return None
+
+    def get_combined_code(self, parts):
+        """
+        Code to run several independent pieces of setup code with one execute request.
+
+        Each part has to be run on its own: an error in one part must not stop the others. The
+        request should fail (status 'error') if any part failed.
+
+        parts : list of strings
+            the code pieces
+
+        returns string or None
+            The code which should be run on the kernel or None if the engine can't do that. In
+            that case, each part is run in its own execute request.
+        """
+        return None
+
+    def get_params_code(self, params):
+        """
+        Code which makes the parameters of the document available as `params` (see
+        `Knitpy.render_sweep()`).
+
+        params : dict
+            the parameters, values which are not json serializable are converted to strings
+
+        returns string or None
+            The code which should be run on the kernel or None if the engine doesn't support
+            parameters.
+        """
+        return None
+
+    def get_chdir_code(self, path):
+        """
+        Code which changes the working directory of the kernel to the directory of the document.
+
+        Kernels of the kernel pool are started (and reused) in whatever directory knitpy was in
+        at that time, so relative paths would otherwise point to the directory of an earlier
+        document.
+
+        returns string or None
+            The code which should be run on the kernel or None if the kernel has no working
+            directory of its own.
+        """
+        return None
+
+    def get_cache_helper_code(self):
+        """
+        Code which defines the helpers for the other cache related code (see
+        :meth:`get_namespace_expression`, :meth:`get_dump_expression` and :meth:`get_load_code`).
+
+        returns string or None
+            The code which should be run on the kernel or None if the engine can't save and
+            restore objects. In that case only the output of cached chunks is cached.
+        """
+        return None
+
+    def get_namespace_expression(self):
+        """
+        Expression which returns a json string of a dict `name -> object identity` of all
+        objects in the namespace. The difference of two of these is used to find the objects
+        which a chunk created.
+        """
+        raise NotImplementedError
+
+    def get_dump_expression(self, names):
+        """
+        Expression which returns a string representation of the objects `names`.
+
+        The expression should return a tuple `("ok", data)` or `("error", names)`, if some
+        objects can't be saved.
+        """
+        raise NotImplementedError
+
+    def get_load_code(self, data):
+        """
+        Code which restores objects, which were saved by the expression returned by
+        :meth:`get_dump_expression`.
+        """
+        raise NotImplementedError
+
+    def get_reset_code(self):
+        """
+        Code to bring a used kernel back into a clean state, so that it can be reused for the next
+        document.
+
+        returns string or None
+            The code which should be run on the kernel. If None or if the code fails, the kernel
+            is restarted instead.
+        """
+        return None
+
 
 class PythonKnitpyEngine(BaseKnitpyEngine):
 
     name = "python"
-    kernel_name = "python"
     startup_lines = "# Bad things happen if tracebacks have ansi escape sequences\n" +\
-                    "%colors NoColor\n"
+                    "%colors NoColor\n" +\
+                    "# remember the modules of a clean kernel (see get_reset_code())\n" +\
+                    "import sys as _knitpy_sys\n" +\
+                    "if not hasattr(_knitpy_sys, '_knitpy_clean_modules'):\n" +\
+                    "    _knitpy_sys._knitpy_clean_modules = set(_knitpy_sys.modules)\n" +\
+                    "del _knitpy_sys\n"
     language = "python"
 
+    in_process = Bool(False, config=True,
+        help="""Whether python code runs in the knitpy process instead of a kernel (see
+                knitpy.inprocess). This is faster for lightweight documents, but only meant for
+                trusted code: it runs in knitpy and resource limits are not supported. A document
+                can set it with `in_process: true` in its yaml metadata.""")
+
+    unload_modules = Bool(False, config=True,
+        help="""Whether modules imported by a document are removed when the kernel is reset for
+                the next document. Kernels which imported extension modules are restarted
+                instead. If False, imported modules are kept (and are therefore fast to import in
+                the next document).""")
+
+    def __init__(self, **kwargs):
+        super(PythonKnitpyEngine, self).__init__(**kwargs)
+        self._input_checker = None
+        if _IPythonInputChecker is not None:
+            self._input_checker = _IPythonInputChecker()
+
+    @property
+    def kernel_name(self):
+        in_process = getattr(self.parent, "_in_process", None)
+        if in_process is None:
+            in_process = self.in_process
+        return INPROCESS_KERNEL_NAME if in_process else "python"
+
+    def is_complete(self, code):
+        if self._input_checker is None:
+            return None
+        status, indent = self._input_checker.check_complete(code)
+        return status
+
+    def split_statements(self, code):
+        if self._input_checker is None:
+            return None
+
+        code_lines = code.split("\n")
+        # transform_cell() removes leading empty lines, so remove them here, too
+        first = 0
+        while first < len(code_lines) and code_lines[first].strip() == "":
+            first += 1
+        code_lines = code_lines[first:]
+        if not code_lines:
+            return []
+
+        if code_lines[0].startswith("%%"):
+            # a cell magic: the whole chunk belongs to it
+            return ["\n".join(code_lines).rstrip("\n") + "\n"]
+
+        source = "\n".join(code_lines)
+        try:
+            # magics and other IPython syntax -> python code
+            transformed = self._input_checker.transform_cell(source)
+            tree = ast.parse(transformed)
+        except (SyntaxError, ValueError):
+            # Let the line based splitting (and the kernel) handle (and report) the error
+            return None
+        if transformed.rstrip("\n").count("\n") != source.rstrip("\n").count("\n"):
+            # can't map the statements back to the lines in the chunk
+            return None
+
+        # the (0-based, inclusive) line span of each top level statement
+        spans = []
+        for node in tree.body:
+            start = node.lineno
+            for decorator in getattr(node, "decorator_list", []):
+                start = min(start, decorator.lineno)
+            end = getattr(node, "end_lineno", None)
+            if end is None:
+                # python < 3.8
+                end = max(getattr(n, "lineno", start) for n in ast.walk(node))
+            if spans and start - 1 <= spans[-1][1]:
+                # more than one statement in a line
+                spans[-1][1] = max(spans[-1][1], end - 1)
+            else:
+                spans.append([start - 1, end - 1])
+
+        def is_free_line(line):
+            stripped = line.strip()
+            return stripped == "" or stripped.startswith("#")
+
+        # lines between statements which are neither empty nor comments (e.g. a closing bracket
+        # on its own line in python < 3.8) belong to the statement before
+        for i, span in enumerate(spans):
+            last_line = spans[i + 1][0] if i + 1 < len(spans) else len(code_lines)
+            for line_no in range(span[1] + 1, last_line):
+                if not is_free_line(code_lines[line_no]):
+                    span[1] = line_no
+
+        # Comments belong to the next statement, unless an empty line follows them: then they
+        # are a group of their own. Other empty lines between statements are dropped.
+        groups = []
+        pending = []
+
+        def add_free_lines(lines):
+            for line in lines:
+                if line.strip() != "":
+                    pending.append(line)
+                elif pending:
+                    groups.append(pending[:] + [""])
+                    del pending[:]
+
+        line_no = 0
+        for start, end in spans:
+            add_free_lines(code_lines[line_no:start])
+            groups.append(pending[:] + code_lines[start:end + 1])
+            del pending[:]
+            line_no = end + 1
+        add_free_lines(code_lines[line_no:])
+        if pending:
+            groups.append(pending)
+
+        return ["\n".join(group) + "\n" for group in groups]
+
+    def analyse_code(self, code, args=None):
+        if self._input_checker is None:
+            return analyse_python_code(code)
+        try:
+            # magics and other IPython syntax -> python code
+            source = self._input_checker.transform_cell(code)
+        except (SyntaxError, ValueError):
+            return None
+        return analyse_python_code(source)
+
     def get_plotting_format_code(self, formats):
         valid_formats = ["png", "jpg", "jpeg", "pdf"]
         code = "%matplotlib inline\n" +\
@@ -51,3 +390,259 @@ class PythonKnitpyEngine(BaseKnitpyEngine):
         fmt_string = "', '".join(formats)
         fmt_string = "'"+fmt_string+"'"
         return code.format(fmt_string)
+
+    def get_batch_code(self, statements, marker):
+        # Each statement is run as its own cell (in the same execute request), so that the
+        # display of results, tracebacks and the execution count are the same as if the
+        # statement was sent on its own. An error in one statement doesn't stop the rest, an
+        # interrupt (e.g. a timeout) does.
+        code = "def _knitpy_run_batch(statements, marker):\n" +\
+               "    import sys\n" +\
+               "    for i, statement in enumerate(statements):\n" +\
+               "        sys.stderr.flush()\n" +\
+               "        sys.stdout.write('%s%s@@\\n' % (marker, i))\n" +\
+               "        sys.stdout.flush()\n" +\
+               "        result = get_ipython().run_cell(statement, store_history=True)\n" +\
+               "        if isinstance(result.error_in_exec, KeyboardInterrupt):\n" +\
+               "            break\n" +\
+               "    sys.stderr.flush()\n" +\
+               "    sys.stdout.flush()\n" +\
+               "try:\n" +\
+               "    _knitpy_run_batch({0!r}, {1!r})\n" +\
+               "finally:\n" +\
+               "    globals().pop('_knitpy_run_batch', None)\n"
+        return code.format(list(statements), marker)
+
+    def get_combined_code(self, parts):
+        code = "def _knitpy_run_all(parts):\n" +\
+               "    failed = []\n" +\
+               "    for i, part in enumerate(parts):\n" +\
+               "        result = get_ipython().run_cell(part, silent=True)\n" +\
+               "        if not result.success:\n" +\
+               "            failed.append('%s (%r)' % (i, result.error_in_exec or\n" +\
+               "                                          result.error_before_exec))\n" +\
+               "    if failed:\n" +\
+               "        raise RuntimeError('Failed setup code part(s): ' + ', '.join(failed))\n" +\
+               "try:\n" +\
+               "    _knitpy_run_all({0!r})\n" +\
+               "finally:\n" +\
+               "    globals().pop('_knitpy_run_all', None)\n"
+        return code.format(list(parts))
+
+    def get_params_code(self, params):
+        code = "import json as _knitpy_json\n" +\
+               "params = _knitpy_json.loads({0!r})\n" +\
+               "del _knitpy_json\n"
+        return code.format(json.dumps(params, default=str))
+
+    def get_chdir_code(self, path):
+        # `python -m ipykernel_launcher` imports from the directory the kernel was started in:
+        # import from the directory of the document instead
+        code = "import os as _knitpy_os, sys as _knitpy_sys\n" +\
+               "if not hasattr(_knitpy_sys, '_knitpy_path_is_cwd'):\n" +\
+               "    _knitpy_sys._knitpy_path_is_cwd = bool(_knitpy_sys.path) and \\\n" +\
+               "        _knitpy_sys.path[0] == _knitpy_os.getcwd()\n" +\
+               "if _knitpy_sys._knitpy_path_is_cwd:\n" +\
+               "    _knitpy_sys.path[0] = {0!r}\n" +\
+               "_knitpy_os.chdir({0!r})\n" +\
+               "del _knitpy_os, _knitpy_sys\n"
+        return code.format(path)
+
+    def get_table_assign_code(self, name, columns, rows):
+        if not re.match(r"^[A-Za-z_]\w*$", name):
+            # the name ends up in the code
+            raise ValueError("'%s' is not a valid python variable name." % name)
+        # a DataFrame if pandas is there
+        return "_knitpy_columns, _knitpy_rows = %r, %r\n" % (list(columns), list(rows)) +\
+               "try:\n" +\
+               "    import pandas as _knitpy_pandas\n" +\
+               "    %s = _knitpy_pandas.DataFrame.from_records(_knitpy_rows,\n" % name +\
+               "                                                columns=_knitpy_columns)\n" +\
+               "    del _knitpy_pandas\n" +\
+               "except ImportError:\n" +\
+               "    %s = [dict(zip(_knitpy_columns, row)) for row in _knitpy_rows]\n" % name +\
+               "del _knitpy_columns, _knitpy_rows\n"
+
+    def get_cache_helper_code(self):
+        # Modules can't be pickled, so they are imported again. Functions, classes and instances
+        # of classes from the document (module '__main__') can only be restored in the same
+        # kernel and are therefore not saved.
+        code = "def _knitpy_namespace():\n" +\
+               "    import json\n" +\
+               "    ignored = ('In', 'Out', 'exit', 'quit', 'get_ipython')\n" +\
+               "    return json.dumps(dict((name, id(value))\n" +\
+               "                           for name, value in globals().items()\n" +\
+               "                           if not (name.startswith('_') or name in ignored)))\n" +\
+               "def _knitpy_dump(names):\n" +\
+               "    import base64, pickle, types, zlib\n" +\
+               "    objects, failed = {}, []\n" +\
+               "    for name in names:\n" +\
+               "        if name not in globals():\n" +\
+               "            continue\n" +\
+               "        value = globals()[name]\n" +\
+               "        if isinstance(value, types.ModuleType):\n" +\
+               "            objects[name] = ('module', value.__name__)\n" +\
+               "            continue\n" +\
+               "        if '__main__' in (getattr(value, '__module__', None),\n" +\
+               "                          type(value).__module__):\n" +\
+               "            failed.append(name)\n" +\
+               "            continue\n" +\
+               "        try:\n" +\
+               "            objects[name] = ('pickle', pickle.dumps(value, 2))\n" +\
+               "        except Exception:\n" +\
+               "            failed.append(name)\n" +\
+               "    if failed:\n" +\
+               "        return ('error', failed)\n" +\
+               "    data = zlib.compress(pickle.dumps(objects, 2))\n" +\
+               "    return ('ok', base64.b64encode(data).decode('ascii'))\n" +\
+               "def _knitpy_load(data):\n" +\
+               "    import base64, importlib, pickle, zlib\n" +\
+               "    objects = pickle.loads(zlib.decompress(base64.b64decode(data)))\n" +\
+               "    for name, (kind, value) in objects.items():\n" +\
+               "        if kind == 'module':\n" +\
+               "            globals()[name] = importlib.import_module(value)\n" +\
+               "        else:\n" +\
+               "            globals()[name] = pickle.loads(value)\n"
+        return code
+
+    def get_namespace_expression(self):
+        return "_knitpy_namespace()"
+
+    def get_dump_expression(self, names):
+        return "_knitpy_dump(%r)" % (list(names),)
+
+    def get_load_code(self, data):
+        return "_knitpy_load(%r)" % (data,)
+
+    def get_reset_code(self):
+        code = "import sys as _knitpy_sys\n" +\
+               "if 'matplotlib.pyplot' in _knitpy_sys.modules:\n" +\
+               "    _knitpy_sys.modules['matplotlib.pyplot'].close('all')\n"
+        if self.unload_modules:
+            # extension modules can't be imported a second time, so raise which will result in
+            # a restart of the kernel
+            code += "_knitpy_new = [name for name in list(_knitpy_sys.modules)\n" +\
+                    "               if name not in _knitpy_sys._knitpy_clean_modules]\n" +\
+                    "_knitpy_ext = [name for name in _knitpy_new if not\n" +\
+                    "               (getattr(_knitpy_sys.modules[name], '__file__', None) or\n" +\
+                    "                '').endswith('.py')]\n" +\
+                    "if _knitpy_ext:\n" +\
+                    "    raise RuntimeError('Can not unload modules: %s' % _knitpy_ext)\n" +\
+                    "for name in _knitpy_new:\n" +\
+                    "    del _knitpy_sys.modules[name]\n"
+        code += "%reset -f\n"
+        return code
+
+
+class ShellKnitpyEngine(BaseKnitpyEngine):
+    """Runs shell chunks in a shell subprocess (see knitpy.shellkernel), without a kernel
+
+    The whole chunk is run at once, its output is shown below the code.
+    """
+
+    name = "sh"
+    language = "sh"
+
+    executable = Unicode("sh", config=True,
+        help="""The shell which runs the chunks. One shell process is used for all chunks of a
+                document, so e.g. the working directory and environment variables are kept.""")
+
+    @property
+    def kernel_name(self):
+        return SHELL_KERNEL_PREFIX + self.executable
+
+    def get_plotting_format_code(self, formats):
+        # no plots
+        return ""
+
+    def is_complete(self, code):
+        return "complete"
+
+    def split_statements(self, code):
+        if not code.strip():
+            return []
+        return [code.strip("\n") + "\n"]
+
+    def get_chdir_code(self, path):
+        return "cd %s\n" % shell_quote(path)
+
+
+class BashKnitpyEngine(ShellKnitpyEngine):
+    """Runs bash chunks (see ShellKnitpyEngine)"""
+
+    name = "bash"
+    language = "bash"
+
+    def _executable_default(self):
+        return "bash"
+
+
+class SqlKnitpyEngine(BaseKnitpyEngine):
+    """Runs sql chunks on SQLite/DuckDB databases (see knitpy.sqlkernel), without a kernel
+
+    Chunk options: `connection` (the database, default: `connection`), `max_rows` (rows shown
+    per query, default: `max_rows`) and `output_var`: the result of the last query is not shown,
+    but set as variable in the python kernel (a pandas DataFrame if pandas is installed, else a
+    list of dicts).
+    """
+
+    name = "sql"
+    kernel_name = SQL_KERNEL_NAME
+    language = "sql"
+    # database files (or files read by the database) can be used by other chunks
+    external_effects = True
+
+    connection = Unicode(":memory:", config=True,
+        help="""The database of chunks without the `connection` option: a SQLite file,
+                `sqlite:///file`, `duckdb:///file` (needs duckdb) or `:memory:`. The connection
+                is kept for the whole document.""")
+
+    max_rows = Integer(20, config=True,
+        help="""Maximal number of rows shown for a query (0: all). Chunks can change it with
+                the `max_rows` option.""")
+
+    output_engine = Unicode("python", config=True,
+        help="""The engine in whose kernel the `output_var` of sql chunks is set.""")
+
+    def _connection(self, args):
+        return (args or {}).get("connection", self.connection)
+
+    def get_plotting_format_code(self, formats):
+        # no plots
+        return ""
+
+    def is_complete(self, code):
+        return "complete"
+
+    def split_statements(self, code):
+        # the statements of a chunk are run together, the result tables are shown below the code
+        if not code.strip():
+            return []
+        return [code.strip("\n") + "\n"]
+
+    def analyse_code(self, code, args=None):
+        # sql chunks on the same database depend on each other (through the tables), but not on
+        # the python names
+        names = CodeNames()
+        database = "sql:%s" % self._connection(args)
+        names.reads.add(database)
+        names.modifies.add(database)
+        output = self.get_output_variable(args or {})
+        if output is not None:
+            names.defines.add(output[1])
+        return names
+
+    def get_chunk_code(self, code, args):
+        options = {"connection": self._connection(args),
+                   "max_rows": args.get("max_rows", self.max_rows),
+                   "output_var": args.get("output_var", None)}
+        return OPTIONS_PREFIX + json.dumps(options) + "\n" + code.strip("\n")
+
+    def get_output_variable(self, args):
+        name = args.get("output_var", None)
+        if not name:
+            return None
+        return self.output_engine, name
+
+    def get_result_expression(self, name):
+        return "result:%s" % name
@@ -0,0 +1,220 @@
+# encoding: utf-8
+"""
+Kernels which are forked from a template process (linux only).
+
+The template process imports the kernel machinery, runs setup code (e.g. the imports of a
+document) once and then forks a new IPython kernel for each request. The forked kernels start
+with the namespace and the imported modules of the template, so the setup code doesn't have to
+run again. This is used to render a document for many parameter sets (see
+`Knitpy.render_sweep()`).
+
+This module is also run as a script (the template process, which runs with the python of the
+kernel), so it must not use relative imports at module level.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import uuid
+
+from traitlets.config.configurable import LoggingConfigurable
+
+
+def is_supported():
+    """Whether kernels can be forked on this platform"""
+    return hasattr(os, "fork") and sys.platform.startswith("linux")
+
+
+class ForkedKernelManager(object):
+    """The part of the `KernelManager` interface which knitpy uses, for a forked kernel
+
+    The kernel is not a child of this process, so it is controlled via signals.
+    """
+
+    def __init__(self, pid, connection_file):
+        self.pid = pid
+        self.connection_file = connection_file
+
+    def is_alive(self):
+        try:
+            os.kill(self.pid, 0)
+        except OSError:
+            return False
+        return True
+
+    def interrupt_kernel(self):
+        os.kill(self.pid, signal.SIGINT)
+
+    def shutdown_kernel(self, now=False):
+        if self.is_alive():
+            os.kill(self.pid, signal.SIGKILL if now else signal.SIGTERM)
+        try:
+            os.remove(self.connection_file)
+        except OSError:
+            pass
+
+
+class ForkServer(LoggingConfigurable):
+    """Controls a template process, from which kernels are forked
+
+    python : string
+        the python executable of the kernel (it needs ipykernel)
+    env : dict or None
+        additional environment variables for the template process (e.g. from the kernel spec)
+    """
+
+    def __init__(self, python, env=None, **kwargs):
+        super(ForkServer, self).__init__(**kwargs)
+        self.python = python
+        self.env = env
+        self._process = None
+
+    def start(self):
+        env = dict(os.environ)
+        env.update(self.env or {})
+        script = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+        self.log.info("Starting a template process for forked kernels.")
+        # in its own session like the kernels started by jupyter_client, so that a Ctrl-C in the
+        # terminal doesn't kill it
+        self._process = subprocess.Popen([self.python, script], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, env=env,
+                                         preexec_fn=os.setsid)
+
+    def _request(self, **request):
+        if (self._process is None) or (self._process.poll() is not None):
+            raise RuntimeError("The template process is not running.")
+        self._process.stdin.write((json.dumps(request) + "\n").encode("utf-8"))
+        self._process.stdin.flush()
+        line = self._process.stdout.readline()
+        if not line:
+            raise RuntimeError("The template process died.")
+        return json.loads(line.decode("utf-8"))
+
+    def run(self, code):
+        """Runs code in the template process (silently), the forked kernels inherit its results
+
+        returns string or None
+            the error (e.g. "NameError: name 'x' is not defined") or None if the code ran fine
+        """
+        reply = self._request(cmd="run", code=code)
+        if reply["status"] != "ok":
+            return reply["error"]
+        return None
+
+    def fork(self, kernel_name):
+        """Forks a new kernel from the template process
+
+        returns PooledKernel
+            the new kernel, its channels are started (see `KernelPool.adopt()`)
+        """
+        # only used in the knitpy process, the template process doesn't know knitpy
+        from jupyter_client.blocking import BlockingKernelClient
+        from jupyter_client.connect import write_connection_file
+        from jupyter_core.paths import jupyter_runtime_dir
+        from .kernels import PooledKernel
+
+        kernel_id = "fork-%s" % uuid.uuid4()
+        runtime_dir = jupyter_runtime_dir()
+        if not os.path.isdir(runtime_dir):
+            os.makedirs(runtime_dir)
+        connection_file, _ = write_connection_file(
+            os.path.join(runtime_dir, "kernel-%s.json" % kernel_id))
+        reply = self._request(cmd="fork", connection_file=connection_file)
+        manager = ForkedKernelManager(reply["pid"], connection_file)
+        client = BlockingKernelClient(connection_file=connection_file, log=self.log)
+        client.load_connection_file()
+        client.start_channels()
+        self.log.debug("Forked kernel '%s' (%s, pid %s).", kernel_name, kernel_id,
+                       manager.pid)
+        return PooledKernel(kernel_name, kernel_id, manager, client)
+
+    def shutdown(self):
+        """Stops the template process, the forked kernels keep running"""
+        if self._process is None:
+            return
+        try:
+            # the template exits at the end of its input
+            self._process.stdin.close()
+            self._process.wait()
+        except (IOError, OSError):
+            self._process.kill()
+        self._process = None
+
+
+# ----------------------------------------------------------------------------
+# The template process
+# ----------------------------------------------------------------------------
+
+def _start_forked_kernel(shell, connection_file):
+    """Turns the forked child of the template process into a kernel (never returns)"""
+    from ipykernel.kernelapp import IPKernelApp
+    # kernel code (e.g. subprocess) has to wait for its children
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 0)
+    # tracebacks are sent to the frontend again
+    del shell._showtraceback
+    try:
+        # the kernel uses the existing shell (a singleton), so the namespace is kept
+        app = IPKernelApp.instance(connection_file=connection_file)
+        app.initialize([])
+        if getattr(shell, "kernel", None) is None:
+            shell.kernel = app.kernel
+        app.start()
+    finally:
+        os._exit(0)
+
+
+def _serve():
+    """Runs the template process: reads json requests from stdin, writes replies to stdout"""
+    replies = os.fdopen(os.dup(1), "w")
+    # the setup code must not write into the replies
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+    # forked kernels are not waited for
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+    # imported here, so that the forked kernels don't have to import it
+    from ipykernel.kernelapp import IPKernelApp
+    from ipykernel.zmqshell import ZMQInteractiveShell
+    shell = ZMQInteractiveShell.instance()
+    errors = []
+
+    # there is no frontend which could show tracebacks, so only remember the error
+    def _showtraceback(etype, evalue, stb):
+        errors.append("%s: %s" % (etype.__name__, evalue))
+    shell._showtraceback = _showtraceback
+
+    for line in iter(sys.stdin.readline, ""):
+        request = json.loads(line)
+        if request["cmd"] == "run":
+            del errors[:]
+            result = shell.run_cell(request["code"], silent=True, store_history=False)
+            if result.success:
+                reply = {"status": "ok"}
+            else:
+                reply = {"status": "error", "error": errors[-1] if errors else "unknown error"}
+        elif request["cmd"] == "fork":
+            pid = os.fork()
+            if pid == 0:
+                replies.close()
+                _start_forked_kernel(shell, request["connection_file"])
+            reply = {"pid": pid}
+        else:
+            reply = {"status": "error", "error": "Unknown request: %s" % request["cmd"]}
+        replies.write(json.dumps(reply) + "\n")
+        replies.flush()
+
+
+if __name__ == "__main__":
+    # like `python -m ipykernel_launcher`: the code should import from the working directory and
+    # not from the knitpy package (e.g. `utils`)
+    sys.path[0] = os.getcwd()
+    _serve()
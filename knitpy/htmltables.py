@@ -0,0 +1,250 @@
+# encoding: utf-8
+"""
+Conversion of simple html tables (like the ones of pandas DataFrames) to markdown tables.
+
+The html is read in one pass by a `HTMLParser`, so most html outputs don't need a pandoc run.
+Everything which isn't a simple table (cells spanning more than one row or column, nested tables,
+more than one header row, markup in cells,...) is left to pandoc.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import re
+
+try:
+    from html.parser import HTMLParser
+except ImportError:
+    from HTMLParser import HTMLParser
+
+try:
+    from html.entities import name2codepoint
+except ImportError:
+    from htmlentitydefs import name2codepoint
+
+try:
+    unichr
+except NameError:
+    # py3
+    unichr = chr
+
+# characters which pandoc's markdown reader would interpret in a cell
+_re_markdown_special = re.compile(r"([\\`*_\[\]<>$|~^@&])")
+
+_re_number = re.compile(r"^[-+]?(\d[\d,]*(\.\d*)?|\.\d+)([eE][-+]?\d+)?%?$|^[-+]?(nan|NaN|inf)$")
+
+# tags which can be around the tables (e.g. the `<div>` of pandas)
+_WRAPPER_TAGS = ("div",)
+# tags in cells, which are dropped (but not their content)
+_IGNORED_CELL_TAGS = ("span",)
+
+
+class UnsupportedHtml(Exception):
+    """The html can't be converted without pandoc"""
+    pass
+
+
+def html_tables_to_markdown(html):
+    """Converts html, which only consists of simple tables, to markdown tables
+
+    Besides the tables, the html can contain `<div>`, `<style>` (which is dropped) and `<p>`
+    with text only. Tables become pipe tables or, if a cell has more than one line (`<br>`),
+    grid tables. Columns with only numbers are right aligned.
+
+    returns string or None
+        the markdown or None, if the html is not that simple
+    """
+    parser = _TableParser()
+    try:
+        parser.feed(html)
+        parser.close()
+        return parser.markdown()
+    except UnsupportedHtml:
+        return None
+
+
+class _Table(object):
+
+    def __init__(self):
+        # (is_header, cells) of all rows
+        self.rows = []
+        self.in_head = False
+
+    def markdown(self):
+        header = [cells for is_header, cells in self.rows if is_header]
+        body = [cells for is_header, cells in self.rows if not is_header]
+        if (len(header) != 1) or (self.rows[0][1] is not header[0]):
+            # markdown tables need exactly one header row
+            raise UnsupportedHtml("Only tables with one header row are supported.")
+        header = header[0]
+        columns = max(len(cells) for cells in [header] + body)
+        if columns == 0:
+            raise UnsupportedHtml("Empty table.")
+        header = header + [""] * (columns - len(header))
+        body = [cells + [""] * (columns - len(cells)) for cells in body]
+        if any("\n" in cell for cells in [header] + body for cell in cells):
+            return _grid_table(header, body)
+        return _pipe_table(header, body)
+
+
+def _is_numeric_column(body, column):
+    values = [cells[column] for cells in body if cells[column]]
+    return bool(values) and all(_re_number.match(value) for value in values)
+
+
+def _pipe_table(header, body):
+    alignments = ["---:" if _is_numeric_column(body, column) else "---"
+                  for column in range(len(header))]
+    lines = ["| " + " | ".join(header) + " |", "|" + "|".join(alignments) + "|"]
+    for cells in body:
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines)
+
+
+def _grid_table(header, body):
+    rows = [[cell.split("\n") for cell in cells] for cells in [header] + body]
+    widths = [max(max(len(line) for line in cell) for cell in column) for column in zip(*rows)]
+
+    def border(char):
+        return "+" + "+".join(char * (width + 2) for width in widths) + "+"
+
+    lines = [border("-")]
+    for number, row in enumerate(rows):
+        for line in range(max(len(cell) for cell in row)):
+            parts = [(cell[line] if line < len(cell) else "").ljust(width)
+                     for cell, width in zip(row, widths)]
+            lines.append("| " + " | ".join(parts) + " |")
+        lines.append(border("=" if number == 0 else "-"))
+    return "\n".join(lines)
+
+
+class _TableParser(HTMLParser):
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        # entities are decoded by handle_entityref()/handle_charref(), also in python 2
+        self.convert_charrefs = False
+        # markdown paragraphs and _Table
+        self._blocks = []
+        self._open = []
+        self._table = None
+        # the lines of the current cell or paragraph
+        self._lines = None
+        # the cells of the current row and whether they are <th>
+        self._cells = None
+        self._header_cells = None
+
+    def markdown(self):
+        if self._open:
+            raise UnsupportedHtml("Unclosed tags: %s" % self._open)
+        if not any(isinstance(block, _Table) for block in self._blocks):
+            raise UnsupportedHtml("No table.")
+        return "\n\n".join(block.markdown() if isinstance(block, _Table) else block
+                           for block in self._blocks) + "\n"
+
+    def handle_starttag(self, tag, attrs):
+        parent = self._open[-1] if self._open else None
+        if tag == "br":
+            if self._lines is None:
+                raise UnsupportedHtml("<br> outside of a cell.")
+            self._lines.append("")
+            return
+        for name, value in attrs:
+            if (name in ("colspan", "rowspan")) and ((value or "1").strip() != "1"):
+                raise UnsupportedHtml("Cells spanning more than one row or column.")
+        if (tag in _IGNORED_CELL_TAGS) and (parent in ("th", "td")):
+            # the content stays in the cell, the end tag closes this "cell" again
+            tag = parent
+        elif (tag in _WRAPPER_TAGS) and (parent is None or parent in _WRAPPER_TAGS):
+            pass
+        elif (tag == "style") and (parent is None or parent in _WRAPPER_TAGS):
+            pass
+        elif (tag == "p") and (parent is None or parent in _WRAPPER_TAGS):
+            self._lines = [""]
+        elif (tag == "table") and (parent is None or parent in _WRAPPER_TAGS):
+            self._table = _Table()
+            self._blocks.append(self._table)
+        elif (tag in ("thead", "tbody", "tfoot")) and (parent == "table"):
+            self._table.in_head = tag == "thead"
+        elif (tag == "tr") and (parent in ("table", "thead", "tbody", "tfoot")):
+            self._cells = []
+            self._header_cells = []
+        elif (tag in ("th", "td")) and (parent == "tr"):
+            self._lines = [""]
+        else:
+            raise UnsupportedHtml("Unsupported tag <%s> in <%s>." % (tag, parent))
+        self._open.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if tag != "br":
+            raise UnsupportedHtml("Unsupported tag <%s/>." % tag)
+        self.handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        if tag == "br":
+            return
+        if (tag in _IGNORED_CELL_TAGS) and self._open and (self._open[-1] in ("th", "td")):
+            tag = self._open[-1]
+        if (not self._open) or (self._open[-1] != tag):
+            raise UnsupportedHtml("Unexpected </%s>." % tag)
+        self._open.pop()
+        if self._open and (self._open[-1] == tag):
+            # the end of an ignored tag in a cell
+            return
+        if tag == "p":
+            text = self._text()
+            if text:
+                self._blocks.append(text)
+            self._lines = None
+        elif tag == "table":
+            self._table = None
+        elif tag == "thead":
+            self._table.in_head = False
+        elif tag == "tr":
+            # without <thead>, a first row of <th> is the header
+            is_header = self._table.in_head or \
+                        ((not self._table.rows) and bool(self._cells) and all(self._header_cells))
+            self._table.rows.append((is_header, self._cells))
+            self._cells = None
+        elif tag in ("th", "td"):
+            self._cells.append(self._text())
+            self._header_cells.append(tag == "th")
+            self._lines = None
+
+    def handle_data(self, data):
+        if self._open and (self._open[-1] == "style"):
+            return
+        if self._lines is not None:
+            # whitespace (also newlines) is collapsed, only <br> starts a new line
+            line = self._lines[-1] + _escape(data)
+            self._lines[-1] = " ".join(line.split()) + (" " if line[-1:].isspace() else "")
+        elif data.strip():
+            raise UnsupportedHtml("Text outside of cells and paragraphs.")
+
+    def _text(self):
+        return "\n".join(line.strip() for line in self._lines).strip("\n")
+
+    def handle_entityref(self, name):
+        if name not in name2codepoint:
+            raise UnsupportedHtml("Unknown entity &%s;." % name)
+        self.handle_data(unichr(name2codepoint[name]))
+
+    def handle_charref(self, name):
+        try:
+            if name[:1] in ("x", "X"):
+                char = unichr(int(name[1:], 16))
+            else:
+                char = unichr(int(name))
+        except (ValueError, OverflowError):
+            # not a number or not a code point (e.g. `&#1114112;`): pandoc can handle that
+            raise UnsupportedHtml("Invalid character reference &#%s;." % name)
+        self.handle_data(char)
+
+    def handle_decl(self, decl):
+        raise UnsupportedHtml("Declaration in html output.")
+
+
+def _escape(text):
+    return _re_markdown_special.sub(r"\\\1", text)
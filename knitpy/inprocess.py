@@ -0,0 +1,378 @@
+# encoding: utf-8
+"""
+Kernels which run in a thread of the knitpy process instead of a jupyter kernel process.
+
+The messages of these kernels have the same shape as the ones of a real kernel and are sent over
+in-process zmq sockets, so the :class:`knitpy.kernels.MessageDispatcher` (and with it timeouts
+and interrupts) works like for a real kernel. :class:`LocalKernelManager` is the base class
+(see also :mod:`knitpy.shellkernel`).
+
+:class:`InProcessKernelManager` runs python code in an IPython shell in the knitpy process, so
+there is no kernel process to start and no serialization. The shell's display publisher,
+displayhook, tracebacks and the output on stdout/stderr are turned into messages. The code runs
+with the rights and in the process of knitpy (e.g. a crash of an extension module kills knitpy),
+so this is only meant for trusted documents. Resource limits are not supported.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import ctypes
+import sys
+import threading
+import uuid
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+import zmq
+
+from traitlets import Type
+from traitlets.config import Config
+
+from IPython.core.interactiveshell import InteractiveShell
+from IPython.core.displayhook import DisplayHook
+from IPython.core.displaypub import DisplayPublisher
+
+# the kernel name of in-process kernels (see `KernelPool`)
+INPROCESS_KERNEL_NAME = "knitpy-inprocess"
+
+# only one in-process kernel runs code at a time: stdout, the displayhook and the IPython
+# instance are global
+_execution_lock = threading.Lock()
+
+
+def _message(msg_type, content, parent_id=None):
+    """Builds a message in the shape of the ones `KernelClient.get_*_msg()` returns"""
+    msg_id = str(uuid.uuid4())
+    header = {"msg_id": msg_id, "msg_type": msg_type}
+    return {"header": header, "msg_id": msg_id, "msg_type": msg_type,
+            "parent_header": {"msg_id": parent_id}, "metadata": {}, "content": content}
+
+
+class _CapturingDisplayPublisher(DisplayPublisher):
+    """Sends `display()` calls as display_data messages"""
+
+    def publish(self, data, metadata=None, *args, **kwargs):
+        self.shell.knitpy_kernel.send_iopub("display_data", {
+            "data": data, "metadata": metadata or {},
+            "transient": kwargs.get("transient") or {}})
+
+    def clear_output(self, wait=False):
+        self.shell.knitpy_kernel.send_iopub("clear_output", {"wait": wait})
+
+
+class _CapturingDisplayHook(DisplayHook):
+    """Sends the result of the last expression as execute_result message"""
+
+    def write_output_prompt(self):
+        pass
+
+    def write_format_data(self, format_dict, md_dict=None):
+        self.shell.knitpy_kernel.send_iopub("execute_result", {
+            "data": format_dict, "metadata": md_dict or {},
+            "execution_count": self.prompt_count})
+
+    def finish_displayhook(self):
+        pass
+
+
+class _KnitpyShell(InteractiveShell):
+    """The IPython shell of an in-process kernel"""
+
+    displayhook_class = Type(_CapturingDisplayHook)
+    display_pub_class = Type(_CapturingDisplayPublisher)
+
+    # set by the kernel, which runs the shell
+    knitpy_kernel = None
+
+    def _showtraceback(self, etype, evalue, stb):
+        self.knitpy_kernel.send_iopub("error", {
+            "ename": etype.__name__, "evalue": "%s" % evalue, "traceback": stb})
+
+
+class _OutputStream(object):
+    """Replaces stdout/stderr while code runs and sends the output as stream messages"""
+
+    def __init__(self, kernel, name):
+        self.kernel = kernel
+        self.name = name
+        self.encoding = "utf-8"
+        self._buffer = []
+
+    def write(self, text):
+        if isinstance(text, bytes):
+            text = text.decode(self.encoding, "replace")
+        self._buffer.append(text)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        if self._buffer:
+            text = "".join(self._buffer)
+            self._buffer = []
+            self.kernel.send_iopub("stream", {"name": self.name, "text": text}, flush=False)
+
+    def isatty(self):
+        return False
+
+
+class _Channel(object):
+    """The part of a kernel client channel which the `MessageDispatcher` uses"""
+
+    def __init__(self, socket):
+        self.socket = socket
+
+    def msg_ready(self):
+        return bool(self.socket.poll(0))
+
+    def get_msg(self, timeout=None):
+        return self.socket.recv_pyobj()
+
+
+class LocalKernelClient(object):
+    """The part of the `KernelClient` interface which knitpy uses, for a kernel in a thread"""
+
+    def __init__(self, kernel):
+        self._kernel = kernel
+        self.shell_channel = _Channel(kernel.shell_socket)
+        self.iopub_channel = _Channel(kernel.iopub_socket)
+
+    def execute(self, code, silent=False, store_history=True, user_expressions=None, **kwargs):
+        return self._kernel.request("execute", code=code, silent=silent,
+                                    store_history=store_history,
+                                    user_expressions=user_expressions or {})
+
+    def is_complete(self, code):
+        return self._kernel.request("is_complete", code=code)
+
+    def wait_for_ready(self, timeout=None):
+        self._kernel.ready.wait(timeout)
+
+    def start_channels(self):
+        pass
+
+    def stop_channels(self):
+        pass
+
+
+class LocalKernelManager(object):
+    """Base class for kernels which are run by a thread of the knitpy process
+
+    Implements the part of `KernelManager` which knitpy uses. The requests are handled one after
+    the other in the kernel thread by :meth:`_handle_request`, the messages for the dispatcher
+    are sent with :meth:`send_iopub`.
+    """
+
+    kernel_id_prefix = "local"
+
+    def __init__(self, log=None):
+        self.log = log
+        self.kernel_id = "%s-%s" % (self.kernel_id_prefix, uuid.uuid4())
+        # no process of its own, so no resource limits (see `knitpy.kernels._kernel_pid`)
+        self.pid = None
+        self.ready = threading.Event()
+        self._requests = Queue()
+        self._thread = None
+        # messages can be sent by more than one thread (e.g. output readers)
+        self._send_lock = threading.Lock()
+        # the kernel thread sends on the *_socket_out ends, the dispatcher receives on the others
+        context = zmq.Context.instance()
+        self.shell_socket, self._shell_socket_out = self._socket_pair(context, "shell")
+        self.iopub_socket, self._iopub_socket_out = self._socket_pair(context, "iopub")
+        self._parent_id = None
+
+    def _socket_pair(self, context, name):
+        address = "inproc://knitpy-%s-%s" % (self.kernel_id, name)
+        receiver = context.socket(zmq.PAIR)
+        receiver.bind(address)
+        sender = context.socket(zmq.PAIR)
+        sender.connect(address)
+        return receiver, sender
+
+    def start_kernel(self):
+        self._thread = threading.Thread(target=self._run, name=self.kernel_id)
+        # code which hangs (and can't be interrupted) must not keep knitpy from exiting
+        self._thread.daemon = True
+        self._thread.start()
+
+    def client(self):
+        return LocalKernelClient(self)
+
+    def is_alive(self):
+        return (self._thread is not None) and self._thread.is_alive()
+
+    def interrupt_kernel(self):
+        raise NotImplementedError
+
+    def shutdown_kernel(self, now=False):
+        if self.is_alive():
+            self._requests.put(None)
+            if not now:
+                self._thread.join(1)
+        for socket in (self.shell_socket, self._shell_socket_out, self.iopub_socket,
+                       self._iopub_socket_out):
+            socket.close(linger=0)
+
+    def request(self, msg_type, **content):
+        """Queues a request for the kernel thread and returns its msg_id"""
+        msg_id = str(uuid.uuid4())
+        self._requests.put((msg_id, msg_type, content))
+        return msg_id
+
+    def send_iopub(self, msg_type, content):
+        with self._send_lock:
+            self._iopub_socket_out.send_pyobj(_message(msg_type, content, self._parent_id))
+
+    def _setup(self):
+        """Called in the kernel thread, before the first request is handled"""
+        pass
+
+    def _teardown(self):
+        """Called in the kernel thread, after the last request was handled (on shutdown)"""
+        pass
+
+    def _handle_request(self, msg_type, content):
+        """Handles a request in the kernel thread and returns the content of the reply"""
+        raise NotImplementedError
+
+    def _run(self):
+        try:
+            self._setup()
+        finally:
+            self.ready.set()
+        try:
+            for request in iter(self._requests.get, None):
+                msg_id, msg_type, content = request
+                self._parent_id = msg_id
+                self.send_iopub("status", {"execution_state": "busy"})
+                reply = self._handle_request(msg_type, content)
+                if reply is None:
+                    reply = {"status": "error", "ename": "ValueError",
+                             "evalue": "Unknown request: %s" % msg_type, "traceback": []}
+                with self._send_lock:
+                    self._shell_socket_out.send_pyobj(_message(msg_type + "_reply", reply,
+                                                               msg_id))
+                self.send_iopub("status", {"execution_state": "idle"})
+                self._parent_id = None
+        finally:
+            self._teardown()
+
+
+class InProcessKernelManager(LocalKernelManager):
+    """Runs python code in an IPython shell in its own thread
+
+    Each kernel has its own IPython shell and namespace.
+    """
+
+    kernel_id_prefix = "inprocess"
+
+    def __init__(self, log=None):
+        super(InProcessKernelManager, self).__init__(log=log)
+        self.shell = None
+        self._executing = False
+        self._streams = None
+
+    def interrupt_kernel(self):
+        """Raises a KeyboardInterrupt in the code which is running right now
+
+        Like a SIGINT in a kernel process, code which waits in a C function (e.g. `time.sleep`)
+        only sees the interrupt when that returns.
+        """
+        if self._executing and self.is_alive():
+            ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(self._thread.ident),
+                                                       ctypes.py_object(KeyboardInterrupt))
+
+    def send_iopub(self, msg_type, content, flush=True):
+        if flush and (self._streams is not None):
+            # output which was written before belongs in front of this message
+            for stream in self._streams:
+                stream.flush()
+        super(InProcessKernelManager, self).send_iopub(msg_type, content)
+
+    def _setup(self):
+        # no history database: the shell is used for one document only
+        config = Config({"HistoryManager": {"enabled": False}})
+        main_module = sys.modules.get("__main__")
+        try:
+            self.shell = _KnitpyShell(config=config, colors="NoColor")
+        finally:
+            # the shell sets its namespace as `__main__`, but that must only be the case while
+            # its code runs
+            sys.modules["__main__"] = main_module
+        self.shell.knitpy_kernel = self
+
+    def _teardown(self):
+        # `InteractiveShell.__init__` registers the shell with atexit, which would keep it (and
+        # the whole namespace of the document) alive until knitpy exits
+        shell, self.shell = self.shell, None
+        if shell is None:
+            return
+        try:
+            shell.reset(new_session=False)
+        except Exception as e:
+            if self.log is not None:
+                self.log.debug("Could not reset the in-process shell: %s", e)
+        if hasattr(atexit, "unregister"):
+            # py3 only, in py2 the shell stays alive. The script magics (`%%bash`,...) register
+            # themselves, too.
+            atexit.unregister(shell.atexit_operations)
+            script_magics = shell.magics_manager.registry.get("ScriptMagics")
+            if script_magics is not None:
+                atexit.unregister(script_magics.kill_bg_processes)
+        shell.knitpy_kernel = None
+
+    def _handle_request(self, msg_type, content):
+        if msg_type == "execute":
+            return self._execute(**content)
+        elif msg_type == "is_complete":
+            status, indent = self.shell.input_transformer_manager.check_complete(
+                content["code"])
+            return {"status": status, "indent": " " * (indent or 0)}
+        return None
+
+    def _execute(self, code, silent, store_history, user_expressions):
+        shell = self.shell
+        if not silent:
+            self.send_iopub("execute_input", {"code": code,
+                                              "execution_count": shell.execution_count})
+        with _execution_lock:
+            saved = (sys.stdout, sys.stderr, sys.modules.get("__main__"),
+                     InteractiveShell._instance)
+            self._streams = [_OutputStream(self, "stdout"), _OutputStream(self, "stderr")]
+            sys.stdout, sys.stderr = self._streams
+            sys.modules["__main__"] = shell.user_module
+            # `display()` and `get_ipython()` use the IPython instance
+            InteractiveShell._instance = shell
+            try:
+                self._executing = True
+                try:
+                    result = shell.run_cell(code, store_history=store_history, silent=silent)
+                finally:
+                    self._executing = False
+                expressions = shell.user_expressions(user_expressions)
+                for stream in self._streams:
+                    stream.flush()
+            except KeyboardInterrupt:
+                # the interrupt came after the code was done
+                result = None
+                expressions = {}
+            finally:
+                self._streams = None
+                sys.stdout, sys.stderr = saved[:2]
+                sys.modules["__main__"] = saved[2]
+                InteractiveShell._instance = saved[3]
+        reply = {"status": "ok", "execution_count": shell.execution_count,
+                 "user_expressions": expressions, "payload": []}
+        error = None if result is None else (result.error_before_exec or result.error_in_exec)
+        if error is not None:
+            reply.update({"status": "error", "ename": type(error).__name__,
+                          "evalue": "%s" % error, "traceback": []})
+        return reply
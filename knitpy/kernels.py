@@ -0,0 +1,522 @@
+# encoding: utf-8
+"""
+Kernel handling for knitpy: a pool of (prestarted) kernels, which can be reused for more than one
+document, and a dispatcher which routes the messages of the kernels to the requests they belong
+to.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import os
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    # e.g. on windows
+    resource = None
+
+import zmq
+
+from traitlets.config.configurable import LoggingConfigurable
+from traitlets import Integer
+
+from jupyter_client.multikernelmanager import MultiKernelManager
+
+from .py3compat import iteritems
+from .inprocess import InProcessKernelManager, INPROCESS_KERNEL_NAME
+from .shellkernel import ShellKernelManager, SHELL_KERNEL_PREFIX
+from .sqlkernel import SqlKernelManager, SQL_KERNEL_NAME
+
+
+class PooledKernel(object):
+    """A kernel which is managed by the :class:`KernelPool`"""
+
+    def __init__(self, kernel_name, kernel_id, manager, client):
+        self.kernel_name = kernel_name
+        self.kernel_id = kernel_id
+        self.manager = manager
+        self.client = client
+        # number of documents this kernel was used for
+        self.uses = 0
+        self.last_used = time.time()
+        # the current (soft) limit of the address space of the kernel process or None
+        self.memory_limit = None
+
+
+def _kernel_pid(kernel):
+    """Returns the process id of the kernel or None if it isn't known"""
+    manager = kernel.manager
+    if getattr(manager, "pid", None) is not None:
+        # e.g. a forked kernel (see knitpy.forkserver)
+        return manager.pid
+    # jupyter_client >=7 starts the kernel via a provisioner, older versions keep the process
+    process = getattr(getattr(manager, "provisioner", None), "process", None)
+    if process is None:
+        process = getattr(manager, "kernel", None)
+    return getattr(process, "pid", None)
+
+
+def _cpu_time(pid):
+    """Returns the CPU time (in seconds) which the process used so far (linux only)"""
+    with open("/proc/%s/stat" % pid) as f:
+        # the process name (second field) can contain spaces, so split after it
+        fields = f.read().rsplit(")", 1)[1].split()
+    # utime and stime (fields 14 and 15) in clock ticks
+    ticks = int(fields[11]) + int(fields[12])
+    return ticks / float(os.sysconf(os.sysconf_names["SC_CLK_TCK"]))
+
+
+class KernelRequest(object):
+    """A request which was sent to a kernel and the messages which the kernel sent for it"""
+
+    def __init__(self, client, msg_id):
+        self.client = client
+        self.msg_id = msg_id
+        # the reply on the shell channel
+        self.reply = None
+        # all IOPub messages of the request, apart from the status messages
+        self.messages = []
+        # whether the kernel reported 'idle' for this request: no more IOPub messages will come
+        self.idle = False
+        # True if the kernel died before the request was done
+        self.kernel_died = False
+        self.last_activity = time.time()
+
+    @property
+    def done(self):
+        return (self.reply is not None) and self.idle
+
+
+class MessageDispatcher(LoggingConfigurable):
+    """Routes the shell and IOPub messages of all registered kernels to their requests
+
+    Instead of reading the channels of one kernel (and throwing away everything which doesn't
+    belong to the current request), all channels are polled together and each message is given
+    to the :class:`KernelRequest` with the same parent msg_id. This makes it possible to wait for
+    requests on more than one kernel at the same time.
+
+    The dispatcher can be used from more than one thread (e.g. one per kernel): the sockets are
+    only used while holding a lock.
+    """
+
+    def __init__(self, **kwargs):
+        super(MessageDispatcher, self).__init__(**kwargs)
+        self._lock = threading.RLock()
+        # maximal time (in seconds) of one poll. Other threads can't send requests while a poll
+        # is running, so this should be short if the dispatcher is used by more than one thread.
+        self.poll_interval = 1
+        self._poller = zmq.Poller()
+        # socket -> (channel name, channel)
+        self._channels = {}
+        # msg_id -> KernelRequest
+        self._requests = {}
+        # client -> function which returns whether the kernel is still alive
+        self._is_alive = {}
+
+    def register(self, client, is_alive=None):
+        """Starts dispatching the messages of the kernel client
+
+        is_alive : callable or None
+            returns False if the kernel died (e.g. `KernelManager.is_alive`). Waiting for
+            requests of a dead kernel stops as soon as this is noticed.
+        """
+        with self._lock:
+            if is_alive is not None:
+                self._is_alive[client] = is_alive
+            for name in ("shell", "iopub"):
+                channel = getattr(client, name + "_channel")
+                if not channel.socket in self._channels:
+                    self._channels[channel.socket] = (name, channel)
+                    self._poller.register(channel.socket, zmq.POLLIN)
+
+    def unregister(self, client):
+        """Stops dispatching the messages of the kernel client"""
+        with self._lock:
+            self._is_alive.pop(client, None)
+            for name in ("shell", "iopub"):
+                channel = getattr(client, name + "_channel")
+                if channel.socket in self._channels:
+                    del self._channels[channel.socket]
+                    self._poller.unregister(channel.socket)
+            for msg_id, request in list(self._requests.items()):
+                if request.client is client:
+                    del self._requests[msg_id]
+
+    def execute(self, client, code, **kwargs):
+        """Sends an execute request (see `KernelClient.execute()`) and returns the request"""
+        with self._lock:
+            return self._add_request(client, client.execute(code, **kwargs))
+
+    def is_complete(self, client, code):
+        """Sends an is_complete request and returns the request"""
+        with self._lock:
+            return self._add_request(client, client.is_complete(code))
+
+    def _add_request(self, client, msg_id):
+        request = KernelRequest(client, msg_id)
+        self._requests[msg_id] = request
+        return request
+
+    def wait(self, requests, timeout, until_reply=False, deadline=None, give_up=True):
+        """Dispatches messages until all requests are done
+
+        timeout : number or None
+            the time (in seconds) a request may go without any new message before waiting for it
+            is given up. None: no limit.
+        until_reply : bool
+            if True, waiting ends when all requests got their shell reply, even if the kernel
+            didn't report 'idle' for them yet
+        deadline : number or None
+            waiting is given up at that time (as returned by `time.time()`)
+        give_up : bool
+            if True, the requests which didn't finish are discarded (see :meth:`discard`) when
+            waiting is given up. False: the caller waits for them again (e.g. after an interrupt).
+
+        returns bool
+            True if all requests finished
+        """
+        if isinstance(requests, KernelRequest):
+            requests = [requests]
+
+        def finished(request):
+            return (request.reply is not None) if until_reply else request.done
+
+        while True:
+            pending = [r for r in requests if not finished(r)]
+            if not pending:
+                return True
+            if any(r.kernel_died for r in pending):
+                break
+            end = deadline
+            if timeout is not None:
+                inactive_end = max(r.last_activity for r in pending) + timeout
+                end = inactive_end if end is None else min(end, inactive_end)
+            wait_time = 1 if end is None else end - time.time()
+            if wait_time <= 0:
+                break
+            # wake up regularly to check whether the kernels are still alive
+            if not self.poll(min(wait_time, self.poll_interval)):
+                self._check_alive(pending)
+        if give_up:
+            self.discard(pending)
+        return False
+
+    def discard(self, requests):
+        """Stops dispatching messages to the requests, later messages for them are dropped"""
+        if isinstance(requests, KernelRequest):
+            requests = [requests]
+        with self._lock:
+            for request in requests:
+                self._requests.pop(request.msg_id, None)
+
+    def _check_alive(self, requests):
+        for request in requests:
+            is_alive = self._is_alive.get(request.client)
+            if (is_alive is not None) and not is_alive():
+                self.log.error("The kernel died while waiting for request %s.", request.msg_id)
+                request.kernel_died = True
+
+    def poll(self, timeout):
+        """Waits up to `timeout` seconds for messages and dispatches all available messages
+
+        returns int
+            the number of dispatched messages
+        """
+        with self._lock:
+            events = dict(self._poller.poll(int(timeout * 1000)))
+            count = 0
+            for socket in events:
+                name, channel = self._channels[socket]
+                while channel.msg_ready():
+                    self._dispatch(name, channel.get_msg(timeout=0))
+                    count += 1
+            return count
+
+    def _dispatch(self, channel_name, msg):
+        msg_id = msg['parent_header'].get('msg_id')
+        request = self._requests.get(msg_id)
+        if request is None:
+            # e.g. a late kernel_info reply or outputs of a request which was given up
+            self.log.debug("Discarding message for an unknown request: %s", msg)
+            return
+        request.last_activity = time.time()
+        if channel_name == "shell":
+            request.reply = msg
+        elif msg['msg_type'] == 'status':
+            if msg['content']['execution_state'] == 'idle':
+                request.idle = True
+        else:
+            request.messages.append(msg)
+        if request.done:
+            del self._requests[msg_id]
+
+
+class KernelPool(LoggingConfigurable):
+    """Pool of kernels, which hands out a clean kernel for each document
+
+    Kernels are started in the background (starting the process does not wait for the kernel to
+    be ready) and reused for later documents after their namespace was reset. If a kernel
+    couldn't be reset, it is replaced by a freshly started one.
+    """
+
+    size = Integer(0, config=True,
+        help="""Number of kernels (idle and in use) which are kept per kernel name. Missing
+                kernels are prestarted in the background. 0 disables the pool: kernels are
+                started when needed and shut down after each document.""")
+
+    max_uses = Integer(20, config=True,
+        help="""Number of documents a kernel is used for, before it is replaced by a fresh one
+                (0: unlimited).""")
+
+    cull_idle_timeout = Integer(0, config=True,
+        help="""Idle kernels are shut down if they were not used for that many seconds
+                (0: never).""")
+
+    memory_limit = Integer(0, config=True,
+        help="""Maximal memory (address space, in MB) of a kernel process. Allocations above the
+                limit fail (in python with a MemoryError). Only supported on linux
+                (0: unlimited).""")
+
+    cpu_time_limit = Integer(0, config=True,
+        help="""Maximal CPU time (in seconds) a kernel process may use for one document. A kernel
+                which uses more is killed. Only supported on linux (0: unlimited).""")
+
+    def __init__(self, **kwargs):
+        super(KernelPool, self).__init__(**kwargs)
+        self._limits_unsupported_warned = False
+        # the pool can be used from more than one thread
+        self._lock = threading.RLock()
+        self.kernel_manager = MultiKernelManager(log=self.log, parent=self)
+        self.dispatcher = MessageDispatcher(log=self.log, parent=self)
+        # kernel_name -> list of idle PooledKernel, reused kernels first
+        self._idle = {}
+        # kernel_name -> list of PooledKernel which are currently in use
+        self._in_use = {}
+
+    def acquire(self, kernel_name):
+        """Returns a ready to use kernel
+
+        The caller has to give the kernel back via :meth:`release` when it is done.
+        """
+        with self._lock:
+            self.cull_idle()
+            idle = self._idle.setdefault(kernel_name, [])
+            if idle:
+                kernel = idle.pop(0)
+                self.log.debug("Reusing kernel '%s' (%s) from the pool.", kernel_name,
+                               kernel.kernel_id)
+            else:
+                kernel = self._start_kernel(kernel_name)
+            self._in_use.setdefault(kernel_name, []).append(kernel)
+            # replace the taken kernel, so that the next document gets a prestarted kernel as well
+            self._fill(kernel_name)
+        # other threads can start their kernels while this one boots
+        kernel.client.wait_for_ready()
+        self._apply_limits(kernel)
+        self.dispatcher.register(kernel.client, is_alive=kernel.manager.is_alive)
+        kernel.uses += 1
+        return kernel
+
+    def set_memory_limit(self, kernel, megabytes=None):
+        """Limits the memory of the kernel process, e.g. for the code of one chunk
+
+        megabytes : int or None
+            the new limit. It can't be above the `memory_limit` of the pool. None sets the limit
+            back to `memory_limit`.
+        """
+        if self.memory_limit > 0:
+            megabytes = min(megabytes or self.memory_limit, self.memory_limit)
+        limit = megabytes * 1024 * 1024 if megabytes else None
+        if limit == kernel.memory_limit:
+            return
+        if self._set_soft_limit(kernel, "RLIMIT_AS", limit):
+            kernel.memory_limit = limit
+
+    def exit_signal(self, kernel):
+        """Returns the number of the signal which killed the kernel or None"""
+        try:
+            exit_code = kernel.manager.provisioner.process.poll()
+        except AttributeError:
+            return None
+        if (exit_code is not None) and (exit_code < 0):
+            return -exit_code
+        return None
+
+    def _apply_limits(self, kernel):
+        """Sets the configured resource limits on the kernel process"""
+        self.set_memory_limit(kernel)
+        if self.cpu_time_limit > 0:
+            # the limit is on the CPU time of the process, so a reused kernel gets the time it
+            # already used on top
+            try:
+                used = _cpu_time(_kernel_pid(kernel))
+            except (IOError, OSError, ValueError, IndexError):
+                used = 0
+            self._set_soft_limit(kernel, "RLIMIT_CPU", int(used) + self.cpu_time_limit)
+
+    def _set_soft_limit(self, kernel, name, value):
+        """Sets the soft rlimit `name` of the kernel process. None means unlimited.
+
+        The hard limit is not changed, so that the soft limit can be raised again later.
+        Returns whether the limit was set.
+        """
+        pid = _kernel_pid(kernel)
+        if (resource is None) or not hasattr(resource, "prlimit") or (pid is None):
+            if not self._limits_unsupported_warned:
+                self.log.warn("Resource limits for kernels are not supported on this platform. "
+                              "Ignored...")
+                self._limits_unsupported_warned = True
+            return False
+        limit = getattr(resource, name)
+        try:
+            soft, hard = resource.prlimit(pid, limit)
+            if value is None:
+                value = resource.RLIM_INFINITY
+            if (hard != resource.RLIM_INFINITY) and \
+                    ((value == resource.RLIM_INFINITY) or (value > hard)):
+                value = hard
+            resource.prlimit(pid, limit, (value, hard))
+        except (OSError, ValueError) as e:
+            self.log.warn("Could not set %s of kernel '%s' (%s): %s", name, kernel.kernel_name,
+                          kernel.kernel_id, e)
+            return False
+        self.log.debug("Set %s of kernel '%s' (%s) to %s.", name, kernel.kernel_name,
+                       kernel.kernel_id, value)
+        return True
+
+    def adopt(self, kernel):
+        """Hands out a kernel, which was not started by the pool (e.g. a forked kernel)
+
+        The kernel is given back via :meth:`release` like the other kernels, but it is never
+        reused.
+        """
+        with self._lock:
+            self._in_use.setdefault(kernel.kernel_name, []).append(kernel)
+        kernel.client.wait_for_ready()
+        self._apply_limits(kernel)
+        self.dispatcher.register(kernel.client, is_alive=kernel.manager.is_alive)
+        kernel.uses += 1
+        return kernel
+
+    def is_reusable(self, kernel):
+        """Whether the kernel should be reset and put back into the pool after use"""
+        if (self.size <= 0) or not (kernel.kernel_id in self.kernel_manager):
+            return False
+        return (self.max_uses <= 0) or (kernel.uses < self.max_uses)
+
+    def release(self, kernel, clean=False):
+        """Gives a kernel back to the pool
+
+        clean : bool
+            True if the kernel was successfully reset. Kernels which are not clean are replaced
+            by a freshly started kernel.
+        """
+        with self._lock:
+            kernel.last_used = time.time()
+            self.dispatcher.unregister(kernel.client)
+            in_use = self._in_use.get(kernel.kernel_name, [])
+            if kernel in in_use:
+                in_use.remove(kernel)
+            if clean and self.is_reusable(kernel):
+                # reused kernels are warm (e.g. imports are cached), so hand them out first
+                self._idle.setdefault(kernel.kernel_name, []).insert(0, kernel)
+            else:
+                self._shutdown_kernel(kernel)
+            self._fill(kernel.kernel_name)
+
+    def prestart(self, kernel_name):
+        """Starts a kernel in the background, unless an idle kernel is already there
+
+        The kernel is handed out by the next :meth:`acquire`, so it can boot while the caller
+        does other things (e.g. parsing the document).
+        """
+        with self._lock:
+            idle = self._idle.setdefault(kernel_name, [])
+            if not idle:
+                idle.append(self._start_kernel(kernel_name))
+
+    def trim(self):
+        """Shuts down idle kernels which are more than `size` (e.g. unused prestarted ones)"""
+        with self._lock:
+            for kernel_name, idle in iteritems(self._idle):
+                while idle and (len(idle) + len(self._in_use.get(kernel_name, [])) > self.size):
+                    self._shutdown_kernel(idle.pop())
+
+    def cull_idle(self):
+        """Shuts down all idle kernels, which weren't used for `cull_idle_timeout` seconds"""
+        if self.cull_idle_timeout <= 0:
+            return
+        cutoff = time.time() - self.cull_idle_timeout
+        for kernel_name, idle in iteritems(self._idle):
+            for kernel in [k for k in idle if k.last_used < cutoff]:
+                self.log.info("Culling idle kernel '%s' (%s).", kernel_name, kernel.kernel_id)
+                idle.remove(kernel)
+                self._shutdown_kernel(kernel)
+
+    def shutdown_all(self):
+        """Shuts down all kernels, including the ones which are currently in use"""
+        with self._lock:
+            kernels = [kernel for kernels in
+                       list(self._idle.values()) + list(self._in_use.values())
+                       for kernel in kernels]
+            for kernel in kernels:
+                if not kernel.kernel_id in self.kernel_manager:
+                    # e.g. in-process, shell, sql and forked kernels
+                    try:
+                        kernel.manager.shutdown_kernel(now=True)
+                    except Exception as e:
+                        self.log.warn("Could not shut down kernel '%s' (%s): %s",
+                                      kernel.kernel_name, kernel.kernel_id, e)
+        self.kernel_manager.shutdown_all()
+        # workaround for https://github.com/ipython/ipython/issues/8007
+        # FIXME: remove if IPython >3.0 is in require
+        self.kernel_manager._kernels.clear()
+        self.dispatcher = MessageDispatcher(log=self.log, parent=self)
+        self._idle = {}
+        self._in_use = {}
+
+    def _fill(self, kernel_name):
+        idle = self._idle.setdefault(kernel_name, [])
+        while len(idle) + len(self._in_use.get(kernel_name, [])) < self.size:
+            idle.append(self._start_kernel(kernel_name))
+
+    def _start_kernel(self, kernel_name):
+        self.log.info("Starting a new kernel: %s" % kernel_name)
+        if kernel_name == INPROCESS_KERNEL_NAME:
+            # runs in a thread of this process, so it's not managed (and never reused) by the
+            # kernel manager
+            manager = InProcessKernelManager(log=self.log)
+            manager.start_kernel()
+            kernel_id = manager.kernel_id
+        elif kernel_name.startswith(SHELL_KERNEL_PREFIX):
+            # a shell subprocess, which doesn't need a jupyter kernel
+            manager = ShellKernelManager(kernel_name[len(SHELL_KERNEL_PREFIX):], log=self.log)
+            manager.start_kernel()
+            kernel_id = manager.kernel_id
+        elif kernel_name == SQL_KERNEL_NAME:
+            manager = SqlKernelManager(log=self.log)
+            manager.start_kernel()
+            kernel_id = manager.kernel_id
+        else:
+            kernel_id = self.kernel_manager.start_kernel(kernel_name=kernel_name)
+            manager = self.kernel_manager.get_kernel(kernel_id)
+        client = manager.client()
+        # this does not wait until the kernel is ready, so the kernel can boot in the background
+        client.start_channels()
+        return PooledKernel(kernel_name, kernel_id, manager, client)
+
+    def _shutdown_kernel(self, kernel):
+        self.log.debug("Shutting down kernel '%s' (%s).", kernel.kernel_name, kernel.kernel_id)
+        kernel.client.stop_channels()
+        # a dead kernel can't answer a shutdown request
+        now = not kernel.manager.is_alive()
+        if kernel.kernel_id in self.kernel_manager:
+            self.kernel_manager.shutdown_kernel(kernel.kernel_id, now=now)
+        else:
+            # adopted kernels
+            kernel.manager.shutdown_kernel(now=now)
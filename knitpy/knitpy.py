@@ -17,45 +17,85 @@ from __future__ import absolute_import, unicode_literals
 
 import codecs
 import os
+import shutil
+import signal
+import sys
+import threading
+import time
 import getpass
 import datetime
 import yaml
 import re
+import uuid
+import ast
+import json
+
 try:
-    from queue import Empty  # Py 3
+    from queue import Queue, Empty
 except ImportError:
-    from Queue import Empty  # Py 2
+    from Queue import Queue, Empty
 
 from pypandoc import convert as pandoc
 
 from traitlets.config.configurable import LoggingConfigurable
 
 from traitlets import (
-    Bool, Integer, CaselessStrEnum, CRegExp, Instance, Unicode, List
+    Bool, Integer, Float, CaselessStrEnum, CRegExp, Instance, Unicode, List
 )
 
 from .py3compat import unicode_type, iteritems, getcwd
 from .path import expand_path
 
 # Stuff for the kernels
-from jupyter_client.multikernelmanager import MultiKernelManager
-from jupyter_client.kernelspec import KernelSpecManager
+from jupyter_client.kernelspec import KernelSpecManager, NoSuchKernel, NATIVE_KERNEL_NAME
 
 # Our own stuff
 from .documents import (TemporaryOutputDocument, FinalOutputConfiguration, KnitpyOutputException,
                         VALID_OUTPUT_FORMAT_NAMES, DEFAULT_OUTPUT_FORMAT_NAME,
                         DEFAULT_FINAL_OUTPUT_FORMATS, IMAGE_FILEEXTENSION_TO_MIMETYPE)
-from .engines import BaseKnitpyEngine, PythonKnitpyEngine
+from .engines import (BaseKnitpyEngine, PythonKnitpyEngine, ShellKnitpyEngine, BashKnitpyEngine,
+                      SqlKnitpyEngine)
+from .kernels import KernelPool
+from .forkserver import ForkServer, is_supported as fork_is_supported
+from .cache import ChunkCache, MarkupCache
+from .pandocserver import PandocServer
+from .dependencies import find_dependencies
 from .utils import CRegExpMultiline, _plain_text, _code, is_string
 
 TBLOCK, TINLINE, TTEXT = range(3)
 
+# message type for things which knitpy (and not the kernel) found out during the execution
+KNITPY_INVALID_CODE = "knitpy_invalid_code"
+KNITPY_TIMEOUT = "knitpy_timeout"
+KNITPY_KERNEL_DIED = "knitpy_kernel_died"
+KNITPY_LIMIT_EXCEEDED = "knitpy_limit_exceeded"
+KNITPY_ERROR = "knitpy_error"
+
+def _timed_out(messages):
+    return any(msg["msg_type"] == KNITPY_TIMEOUT for msg in messages)
+
+def _out_of_memory(messages):
+    return any((msg["msg_type"] == "error") and (msg["content"].get("ename") == "MemoryError")
+               for msg in messages)
+
+def _knitpy_message(msg_type, content):
+    """Builds a message in the same shape as the ones which are received from the kernel"""
+    return {"msg_type": msg_type, "content": content,
+            "header": {"msg_type": msg_type}, "parent_header": {}}
+
 class KnitpyException(Exception):
     pass
 
 class ParseException(KnitpyException):
     pass
 
+class KernelDiedException(KnitpyException):
+
+    def __init__(self, message, messages=None):
+        super(KernelDiedException, self).__init__(message)
+        # the messages (e.g. the execute_input) which the kernel sent before it died
+        self.messages = messages or []
+
 
 class Knitpy(LoggingConfigurable):
     """Engine used to convert from python markdown (``*.pymd``) to html/latex/..."""
@@ -77,7 +117,63 @@ class Knitpy(LoggingConfigurable):
     kernel_debug = Bool(False, config=True,
         help="""Whether to output kernel messages to the (debug) log""")
 
-    timeout = Integer(10, config=True, help="timeout for individual code executions")
+    timeout = Integer(10, config=True,
+        help="""Timeout (in seconds) for individual code executions: if the kernel doesn't send
+                anything for that long, the execution is interrupted. Chunks with the `timeout`
+                option can run up to that many seconds instead.""")
+
+    interrupt_timeout = Integer(10, config=True,
+        help="""Time (in seconds) the kernel gets to stop the code after an interrupt because of
+                a timeout.""")
+
+    max_kernel_restarts = Integer(3, config=True,
+        help="""How often a kernel which died (e.g. because it ran out of memory) is restarted
+                during one document. The chunks which the remaining chunks depend on are run
+                again in the new kernel. If the kernel dies more often, the document fails.""")
+
+    document_timeout = Integer(0, config=True,
+        help="""Time (in seconds) all code of a document may run. Code which is still running
+                at that time is interrupted and the remaining chunks are not executed
+                (0: no limit).""")
+
+    batch_execution = Bool(False, config=True,
+        help="""Whether all statements of a code chunk are sent to the kernel in one execute
+                request (if the engine supports that). The outputs are still shown below the
+                statement which produced them.""")
+
+    prestart_kernels = Bool(True, config=True,
+        help="""Whether the kernels of the engines, which a document uses, are started in the
+                background as soon as the document is read, so that they boot while the
+                document is parsed.""")
+
+    fork_kernels = Bool(True, config=True,
+        help="""Whether `render_sweep()` runs the leading python chunks, which don't use
+                `params`, only once in a template process and forks a kernel for each parameter
+                set from it (linux only).""")
+
+    parallel_kernels = Integer(1, config=True,
+        help="""Number of kernels per engine, which run independent chunks of a document at the
+                same time (1: off). Chunks which don't depend on each other (see
+                knitpy.dependencies) run in different kernels. The objects of the chunks they
+                depend on are copied into the kernel or, if they can't be saved, these chunks are
+                run again there (so chunks can run more than once).""")
+
+    concurrent_engines = Bool(False, config=True,
+        help="""Whether the chunks of different kernels (e.g. python and sql) run at the same
+                time. The chunks of one kernel always run in document order. A chunk waits for
+                the chunks given in its `dependson` option and the chunks it depends on (see
+                knitpy.dependencies). Chunks which can't be analysed (e.g. shell chunks) or have
+                effects outside of their kernel (e.g. sql chunks) wait for all chunks above them
+                and all chunks below them wait for them.""")
+
+    use_pandoc_server = Bool(False, config=True,
+        help="""Whether markup outputs (html, latex) are converted by one `pandoc server` process
+                (pandoc >= 3), which is started on first use, instead of a pandoc process per
+                conversion. Falls back to pandoc processes if the server can't be used.""")
+
+    parallel_conversions = Integer(4, config=True,
+        help="""Number of output formats (e.g. html, docx and pdf with `--to=all`), which are
+                converted by pandoc at the same time (1: one after the other).""")
 
     # Things for the parser...
     chunk_begin = CRegExpMultiline(r'^\s*```+\s*{[.]?(?P<engine>[a-z]+)\s*(?P<args>.*)}\s*$',
@@ -98,14 +194,32 @@ class Knitpy(LoggingConfigurable):
 
 
     def init_kernel_manager(self):
-        self._km = MultiKernelManager(log=self.log, parent=self)
+        self._pool = KernelPool(log=self.log, parent=self)
+        self._km = self._pool.kernel_manager
         self._ksm = KernelSpecManager(log=self.log, parent=self)
+        # kernel_name -> PooledKernel, the kernels used for the current document
         self._kernels = {}
+        # the parameters of the current document or None
+        self._params = None
+        # the state of the current render_sweep() or None
+        self._sweep = None
+        # the `in_process` yaml metadata of the current document or None (see
+        # PythonKnitpyEngine.in_process)
+        self._in_process = None
+        # `number`: the lane (see parallel_kernels) of the chunks which the thread executes
+        self._lane = threading.local()
+        # the memo of markup conversions of all documents
+        self._markup_cache = MarkupCache(log=self.log, parent=self)
+        # only started on first use (see use_pandoc_server)
+        self._pandoc_server = PandocServer(log=self.log, parent=self)
         #ksm.find_kernel_specs()
 
     def init_engines(self):
         self._engines = {}
         self._engines["python"] = PythonKnitpyEngine(parent=self)
+        self._engines["sh"] = ShellKnitpyEngine(parent=self)
+        self._engines["bash"] = BashKnitpyEngine(parent=self)
+        self._engines["sql"] = SqlKnitpyEngine(parent=self)
         # TODO: check that every kernel_name is in ksm.find_kernel_specs()
 
     def init_output_configurations(self):
@@ -147,15 +261,42 @@ class Knitpy(LoggingConfigurable):
             if end is None:
                 raise ParseException("Found no metadata end separator.")
             try:
-                res = yaml.load(doc[start.end():end.start()])
+                res = yaml.safe_load(doc[start.end():end.start()])
                 self.log.debug("Metadata: %s", res)
                 metadata.update(res)
             except Exception as e:
                 raise ParseException("Malformed metadata: %s" % str(e))
+        in_process = metadata.get("in_process", None)
+        self._in_process = None if in_process is None else bool(in_process)
+
+        if self.prestart_kernels:
+            self._prestart_kernels(doc)
 
         parsed_doc = self._parse_blocks(doc)
         return parsed_doc, metadata
 
+    def _prestart_kernels(self, doc):
+        """Starts the kernels of all engines which are used in the document in the background"""
+        engine_names = set()
+        for match in self.chunk_begin.finditer(doc):
+            engine_names.add(match.group("engine"))
+            # for compatibility with knitr, where python is specified via "{r engine='python'}"
+            override = re.search(r"""engine\s*=\s*['"]?(\w+)""", match.group("args"))
+            if override is not None:
+                engine_names.add(override.group(1))
+        for match in self.inline_code.finditer(doc):
+            engine_names.add(match.group("engine"))
+
+        kernel_names = set(self._engines[name].kernel_name for name in engine_names
+                           if name in self._engines)
+        if (self._sweep is not None) and (self._sweep.server is not None):
+            # the kernel is forked from the template process of the parameter sweep
+            kernel_names.discard(self._sweep.engine.kernel_name)
+        for kernel_name in kernel_names:
+            if not kernel_name in self._kernels:
+                self.log.debug("Prestarting kernel '%s'.", kernel_name)
+                self._pool.prestart(kernel_name)
+
     def _parse_blocks(self, doc):
         result = []
         doc_pos = 0
@@ -195,34 +336,456 @@ class Knitpy(LoggingConfigurable):
                 return False
         return True
 
-    def convert(self, parsed, output):
+    def convert(self, parsed, output, cache_dir=None, params=None):
+        """Execute the parsed document and write the results into the output document(s)
+
+        The code is executed only once, even if more than one output document is given: the
+        kernel messages are recorded and then replayed into each output document.
+
+        parsed : list
+            the parsed document (see :meth:`parse_document`)
+        output : TemporaryOutputDocument or list of TemporaryOutputDocument
+            the output document(s), which should receive the results
+        cache_dir : string or None
+            the directory for the results of chunks with `cache=True`. If None, nothing is
+            cached.
+        params : dict or None
+            the parameters of the document, which are available as `params` in the kernels
+        """
+        if isinstance(output, TemporaryOutputDocument):
+            outputs = [output]
+        else:
+            outputs = output
+
+        # Enable all image formats which are accepted by any of the output documents, the right
+        # one is chosen per output document while replaying the recording
+        image_formats = []
+        for doc in outputs:
+            for fmt in doc.export_config.accepted_image_formats:
+                if not fmt in image_formats:
+                    image_formats.append(fmt)
+
+        recording = self.execute(parsed, image_formats, cache_dir=cache_dir, params=params)
+        for doc in outputs:
+            self.replay(recording, doc)
+        return output
 
-        context = ExecutionContext(output=output)
+    def execute(self, parsed, image_formats, cache_dir=None, params=None):
+        """Execute all code in the parsed document and record the results
 
+        image_formats : list of strings
+            the image formats which should be enabled in the kernels
+        cache_dir : string or None
+            the directory for the results of chunks with `cache=True`
+        params : dict or None
+            the parameters of the document, which are available as `params` in the kernels
+
+        returns list
+            the recorded document: like the parsed document, but code entries are replaced by
+            their :class:`ChunkRecording`
+        """
+        context = ExecutionContext(output=None, image_formats=image_formats)
+        if self.document_timeout > 0:
+            context.document_deadline = time.time() + self.document_timeout
+        if cache_dir is not None:
+            context.cache = ChunkCache(cache_dir, log=self.log, parent=self)
+
+        # Create all chunks first, so that the dependencies between them are known before any
+        # code is executed
+        recording = []
+        chunks = []
         for entry in parsed:
-            if entry[0] == TBLOCK:
-                context.mode="block"
-                self._process_code(entry[1], context=context)
-            elif entry[0] == TINLINE:
-                context.mode="inline"
-                self._process_code(entry[1], context=context)
+            if entry[0] in (TBLOCK, TINLINE):
+                mode = "block" if entry[0] == TBLOCK else "inline"
+                chunk = self._create_chunk(entry[1], mode)
+                chunks.append(chunk)
+                recording.append((entry[0], chunk))
             elif entry[0] == TTEXT:
-                output.add_text(entry[1])
+                recording.append(entry)
             else:
                 raise ParseException("Found something unexpected: %s" % entry)
-        # process_code opened kernels, so close them here
-        self._km.shutdown_all()
-        # workaround for https://github.com/ipython/ipython/issues/8007
-        # FIXME: remove if IPython >3.0 is in require
-        self._km._kernels.clear()
-        self._kernels = {}
-        return output
+        find_dependencies(chunks, self.log)
+        if context.cache is not None:
+            # the keys of the chunks this chunk depends on are part of the key, so a change in a
+            # chunk invalidates the cache of all chunks which (transitively) depend on it
+            for chunk in chunks:
+                chunk.cache_key = context.cache.key(chunk, image_formats,
+                                                    [chunks[i].cache_key
+                                                     for i in chunk.dependencies],
+                                                    params=params)
+
+        self._params = params
+        try:
+            # chunks which already ran in the template process of a parameter sweep
+            done = self._fork_sweep_kernel(chunks, context) if self._sweep is not None else []
+            # kernel name -> indices of the chunks which run in that kernel (or set variables in
+            # it)
+            kernel_chunks = {}
+            kernel_names = [self._namespace_engine(chunk).kernel_name for chunk in chunks]
+            barriers = [index for index, chunk in enumerate(chunks)
+                        if (not index in done) and self._is_barrier(chunk)]
+            for index, chunk in enumerate(chunks):
+                if not index in done:
+                    kernel_name = kernel_names[index]
+                    kernel_chunks.setdefault(kernel_name, []).append(index)
+                    # the dependencies found in the code of chunks which run in other kernels
+                    # (e.g. the sql chunks of a chunk which binds a query result in python) are
+                    # waited for like the ones in `dependson`
+                    foreign = set(i for i in chunk.dependencies
+                                  if (not i in done) and (chunks[i].names is not None))
+                    # barriers wait for everything above them, everything waits for the
+                    # barriers above it
+                    if index in barriers:
+                        foreign.update(i for i in range(index) if not i in done)
+                    else:
+                        foreign.update(i for i in barriers if i < index)
+                    chunk.foreign_dependencies = sorted(
+                        i for i in foreign if kernel_names[i] != kernel_name)
+            use_lanes = (self.parallel_kernels > 1) and \
+                        (self.concurrent_engines or (len(kernel_chunks) == 1))
+            # (lane, indices of the chunks which run in the lane's kernel)
+            groups = []
+            for indices in kernel_chunks.values():
+                if use_lanes:
+                    groups.extend(self._plan_lanes(chunks, indices))
+                else:
+                    groups.append((0, indices))
+            if (len(groups) > 1) and (self.concurrent_engines or use_lanes):
+                self._execute_concurrently(chunks, groups, context)
+            else:
+                self._execute_chunks(chunks, [i for i in range(len(chunks)) if not i in done],
+                                     context)
+        finally:
+            # process_code opened kernels, so give them back here
+            self._release_kernels()
+            self._params = None
+        if (self._sweep is not None) and (self._sweep.server is None):
+            self._start_sweep_template(chunks, image_formats)
+        return recording
+
+    def _is_barrier(self, chunk):
+        """Whether the chunk must not run at the same time as chunks of other kernels
+
+        These are chunks which can't be analysed (so they might use anything) and chunks of
+        engines which have effects outside of their kernel (e.g. on files).
+        """
+        return (chunk.names is None) or chunk.names.opaque or chunk.engine.external_effects
 
-    def _process_code(self, input, context):
+    def _execute_chunks(self, chunks, indices, context, scheduler=None):
+        """Executes the chunks with the given indices (in that order)
 
-        context.execution_started()
+        scheduler : _ChunkScheduler or None
+            if given, each chunk waits until the chunks in its `dependson` option are executed
+            and the results of the chunks in its `transfers` are in the kernel
+        """
+        # engine name -> number of kernel restarts
+        restarts = {}
+        for index in indices:
+            chunk = chunks[index]
+            if scheduler is not None:
+                if not scheduler.wait_for(chunk.declared_dependencies +
+                                          chunk.foreign_dependencies):
+                    return
+                if chunk.transfers and not self._transfer_results(chunks, chunk, context,
+                                                                  scheduler):
+                    return
+            context.mode = chunk.mode
+            context.chunk_number = index
+            try:
+                self._process_code(chunk, context)
+            except KernelDiedException:
+                self._recover_from_kernel_death(chunks, index, context, restarts)
+            if scheduler is not None:
+                if chunk.exported:
+                    scheduler.objects[index] = self._save_objects(chunk, context)
+                scheduler.finished(index)
+
+    def _plan_lanes(self, chunks, indices):
+        """Distributes the chunks of one kernel over up to `parallel_kernels` lanes
+
+        Each lane runs its chunks in its own kernel. A chunk continues the lane which ran the
+        last chunk it (transitively) depends on, other chunks start a new lane. The chunks which
+        a chunk depends on, but which ran in other lanes, are set as its `transfers`.
+
+        returns list
+            (lane, indices of the chunks of the lane)
+        """
+        in_kernel = set(indices)
+        # index -> all chunks (of this kernel) it transitively depends on
+        upstream = {}
+        lanes = []
+        # lane -> number of evaluated chunks
+        load = []
+        # lane -> indices of the chunks whose results are in the lane's kernel
+        present = []
+        for index in indices:
+            chunk = chunks[index]
+            upstream[index] = set()
+            for dep in chunk.dependencies:
+                if dep in in_kernel:
+                    upstream[index].add(dep)
+                    upstream[index].update(upstream[dep])
+            if not chunk.evaluated:
+                # nothing runs, so it doesn't matter where
+                lane = 0
+            else:
+                needed = upstream[index]
+                continued = [lane for lane in range(len(lanes))
+                             if present[lane] and max(present[lane]) in needed]
+                if continued:
+                    lane = max(continued, key=lambda lane: max(present[lane]))
+                elif not lanes or (load[0] == 0):
+                    lane = 0
+                elif len(lanes) < self.parallel_kernels:
+                    lane = len(lanes)
+                else:
+                    lane = min(range(len(lanes)), key=lambda lane: load[lane])
+            if lane == len(lanes):
+                lanes.append([])
+                load.append(0)
+                present.append(set())
+            chunk.lane = lane
+            if chunk.evaluated:
+                load[lane] += 1
+                chunk.transfers = sorted(upstream[index] - present[lane])
+                for dep in chunk.transfers:
+                    chunks[dep].exported = True
+                present[lane].update(upstream[index])
+                present[lane].add(index)
+            lanes[lane].append(index)
+        if len(lanes) > 1:
+            self.log.info("Running the chunks of kernel '%s' in %s kernels.",
+                          chunks[indices[0]].engine.kernel_name, len(lanes))
+        return list(enumerate(lanes))
+
+    def _save_objects(self, chunk, context):
+        """Returns the saved objects which the chunk created or changed or None
+
+        These are loaded in the kernels of other lanes (see `_plan_lanes()`).
+        """
+        if chunk.cached_objects is not None:
+            return chunk.cached_objects
+        engine = self._namespace_engine(chunk)
+        if (not chunk.evaluated) or chunk.timed_out or (chunk.names is None) or \
+                not self._ensure_cache_helpers(engine, context):
+            return None
+        names = chunk.names.defines | chunk.names.modifies | chunk.names.calls
+        try:
+            status, objects = self._evaluate_silently(engine.kernel,
+                                                      engine.get_dump_expression(sorted(names)))
+        except KnitpyException as e:
+            self.log.debug("Could not save the objects of chunk %s: %s", context.chunk_number, e)
+            return None
+        if status != "ok":
+            self.log.debug("Can't save the objects %s of chunk %s.", ", ".join(objects),
+                           context.chunk_number)
+            return None
+        return objects
+
+    def _transfer_results(self, chunks, chunk, context, scheduler):
+        """Brings the results of the chunk's `transfers` (from other lanes) into the kernel
+
+        The saved objects of the chunks are loaded, chunks whose objects couldn't be saved are
+        run again. Returns False if the execution was aborted.
+        """
+        for index in chunk.transfers:
+            if not scheduler.wait_for([index]):
+                return False
+            source = chunks[index]
+            objects = scheduler.objects.get(index)
+            if objects is not None:
+                # loaded together with the setup of the next code
+                context.pending_objects.append((self._namespace_engine(source).name, objects))
+            elif source.evaluated and not source.timed_out:
+                self.log.info("Running chunk %s again for chunk %s.", index + 1,
+                              chunks.index(chunk) + 1)
+                self._rerun_chunk(source, context)
+        return True
+
+    def _execute_concurrently(self, chunks, groups, context):
+        """Executes each group of chunks (the chunks of one kernel or lane) in its own thread
+
+        groups : list
+            (lane, indices of the chunks)
+
+        The results are recorded in the chunks, so the output is still in document order.
+        """
+        scheduler = _ChunkScheduler()
+        dispatcher = self._pool.dispatcher
+        threads = []
+        for lane, indices in groups:
+            # the context keeps the state of one kernel, so each thread needs its own one
+            thread_context = ExecutionContext(output=None, image_formats=context.image_formats,
+                                              cache=context.cache,
+                                              document_deadline=context.document_deadline)
+            thread = threading.Thread(target=self._execute_in_thread,
+                                      args=(chunks, indices, thread_context, scheduler, lane))
+            thread.daemon = True
+            threads.append(thread)
+        self.log.info("Executing the chunks of %s kernels concurrently.", len(threads))
+        # the threads share the dispatcher: keep the polls short, so that they can send requests
+        dispatcher.poll_interval = 0.05
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # join() with a timeout, so that a KeyboardInterrupt is noticed
+                while thread.is_alive():
+                    thread.join(0.5)
+        except BaseException as e:
+            scheduler.abort(e)
+            raise
+        finally:
+            dispatcher.poll_interval = 1
+        if scheduler.error is not None:
+            raise scheduler.error
+
+    def _execute_in_thread(self, chunks, indices, context, scheduler, lane):
+        # the engines use the kernel of this lane (see _kernel_key())
+        self._lane.number = lane
+        try:
+            self._execute_chunks(chunks, indices, context, scheduler=scheduler)
+        except BaseException as e:
+            self.log.error("Error while executing chunks: %s", e)
+            # stop the other threads as well, the error is raised in the main thread
+            scheduler.abort(e)
+
+    def _recover_from_kernel_death(self, chunks, index, context, restarts):
+        """Restarts the kernel, which died while running chunk `index`
+
+        The chunk gets an error instead of its (missing) results. The chunks, which the remaining
+        chunks of the document depend on, are run again in the new kernel (without recording
+        their output), so that the document can go on.
+        """
+        chunk = chunks[index]
+        engine = chunk.engine
+        message = "The kernel died while running this chunk (e.g. because it ran out of memory)."
+        kernel = self._kernels.get(self._kernel_key(engine))
+        if (kernel is not None) and (self._pool.exit_signal(kernel) == signal.SIGXCPU):
+            message = "The kernel was killed because it used more than its CPU time limit of " \
+                      "%s seconds." % self._pool.cpu_time_limit
+        self.log.error("Kernel for engine '%s' died while running chunk %s.", engine.name,
+                       context.chunk_number)
+        chunk.messages.append(_knitpy_message(KNITPY_KERNEL_DIED, {"message": message}))
+        context.execution_finished()
 
-        # setup the execution context
+        while True:
+            restarts[engine.name] = restarts.get(engine.name, 0) + 1
+            if restarts[engine.name] > self.max_kernel_restarts:
+                raise KnitpyException("The kernel for engine '%s' died %s times. Aborting..." %
+                                      (engine.name, restarts[engine.name]))
+            self._discard_kernel(engine, context)
+            try:
+                self._restore_state(chunks, index, context)
+                return
+            except KernelDiedException:
+                self.log.error("Kernel for engine '%s' died again while restoring its state.",
+                               engine.name)
+
+    def _discard_kernel(self, engine, context):
+        """Throws away the (dead) kernel of the engine, the next use starts a new one"""
+        kernel = self._kernels.pop(self._kernel_key(engine), None)
+        if kernel is not None:
+            self._pool.release(kernel, clean=False)
+        # the new kernel needs the whole setup again
+        for names in (context.enabled_documents, context.cache_helpers):
+            if engine.name in names:
+                names.remove(engine.name)
+        context.pending_objects = [(name, data) for name, data in context.pending_objects
+                                   if name != engine.name]
+
+    def _restore_state(self, chunks, index, context):
+        """Runs the chunks before `index`, which the chunks after it need, in the engine's kernel
+
+        Only chunks which (transitively) are dependencies of the remaining chunks are run (see
+        :mod:`knitpy.dependencies`). Cached chunks restore their objects instead.
+        """
+        engine = chunks[index].engine
+        lane = chunks[index].lane
+        needed = set()
+        # chunks which set variables in the kernel count as chunks of the engine
+        todo = [i for i in range(index + 1, len(chunks))
+                if (self._namespace_engine(chunks[i]) is engine) and (chunks[i].lane == lane)]
+        while todo:
+            for dep in chunks[todo.pop()].dependencies:
+                if not dep in needed:
+                    needed.add(dep)
+                    todo.append(dep)
+        # the crashed chunk would probably crash again
+        needed.discard(index)
+        needed = [i for i in sorted(needed) if i < index and
+                  self._namespace_engine(chunks[i]) is engine and
+                  chunks[i].evaluated and not chunks[i].timed_out]
+        if not needed:
+            return
+        self.log.info("Running %s chunk(s) again to restore the state of the kernel.",
+                      len(needed))
+        for i in needed:
+            chunk = chunks[i]
+            if chunk.cached_objects is not None:
+                context.pending_objects.append((engine.name, chunk.cached_objects))
+                continue
+            self._rerun_chunk(chunk, context)
+        self._limit_memory(engine, {})
+
+    def _rerun_chunk(self, chunk, context):
+        """Runs the code of an already executed chunk again, without recording its output"""
+        engine = chunk.engine
+        context.chunk = chunk
+        self._set_limits(chunk.args, context)
+        self._prepare_kernel(engine, context)
+        self._limit_memory(engine, chunk.args)
+        self._execute(engine.kernel, engine.get_chunk_code(chunk.code, chunk.args),
+                      store_history=False, context=context)
+        self._limit_memory(engine, {})
+        output = engine.get_output_variable(chunk.args)
+        if output is not None:
+            self._set_output_variable(chunk, output, context, record=False)
+
+    def _namespace_engine(self, chunk):
+        """Returns the engine, in whose kernel the chunk defines its names
+
+        That's the chunk's engine, unless its result is set as variable in the kernel of
+        another engine (e.g. the `output_var` option of sql chunks).
+        """
+        output = chunk.engine.get_output_variable(chunk.args)
+        if (output is not None) and (output[0] in self._engines):
+            return self._engines[output[0]]
+        return chunk.engine
+
+    def _set_output_variable(self, chunk, output, context, record=True):
+        """Sets the result of the chunk as variable in the kernel of another engine
+
+        output : (string, string)
+            the name of the engine and of the variable (see
+            `BaseKnitpyEngine.get_output_variable()`)
+        record : bool
+            whether an error is recorded in the chunk's output
+        """
+        engine_name, name = output
+        error = None
+        target = self._engines.get(engine_name)
+        try:
+            if target is None:
+                raise KnitpyException("Unknown engine '%s'." % engine_name)
+            columns, rows = self._evaluate_silently(chunk.engine.kernel,
+                                                    chunk.engine.get_result_expression(name))
+            code = target.get_table_assign_code(name, columns, rows)
+            if code is None:
+                raise KnitpyException("Engine '%s' can't set variables." % engine_name)
+            self._prepare_kernel(target, context)
+            reply = self._run_silently(target.kernel, code)
+            if (reply is not None) and (reply['status'] != 'ok'):
+                raise KnitpyException("%s: %s" % (reply.get('ename'), reply.get('evalue')))
+        except (KnitpyException, TypeError, ValueError) as e:
+            error = "Could not set the variable '%s': %s" % (name, e)
+        if error is not None:
+            self.log.error(error)
+            if record:
+                chunk.messages.append(_knitpy_message(KNITPY_ERROR, {"message": error}))
+
+    def _create_chunk(self, input, mode):
+        """Returns the (not yet executed) ChunkRecording for a parsed code entry"""
         code = input[0]
         intro = input[1]
         engine_name =  intro["engine"]
@@ -241,50 +804,266 @@ class Knitpy(LoggingConfigurable):
         except:
             raise ParseException("Unknown codeblock type: %s" % engine_name)
         assert not engine is None, "Engine is None"
+        chunk = ChunkRecording(code, mode=mode, engine=engine, args=args)
+
+        # eval=False means that we don't execute the block at all
+        if args.get("eval", True) is False:
+            chunk.evaluated = False
+        else:
+            chunk.names = engine.analyse_code(code, args)
+        return chunk
+
+    def replay(self, recording, output):
+        """Write a recorded document (see :meth:`execute`) into the output document"""
+        context = ExecutionContext(output=output)
+
+        for entry in recording:
+            if entry[0] in (TBLOCK, TINLINE):
+                self._replay_chunk(entry[1], context=context)
+            elif entry[0] == TTEXT:
+                output.add_text(entry[1])
+            else:
+                raise ParseException("Found something unexpected: %s" % entry)
+        return output
+
+    def _process_code(self, chunk, context):
+
+        context.execution_started()
+
+        engine = chunk.engine
+        args = chunk.args
         context.engine = engine
+        context.chunk = chunk
+
+        cache_key = chunk.cache_key if context.cache is not None else None
+
+        if not chunk.evaluated:
+            return chunk
+
+        output = engine.get_output_variable(args)
+        use_cache = bool(args.get("cache", False)) and (cache_key is not None)
+        if use_cache and (output is not None):
+            # the variable in the other kernel can't be restored from the cache
+            self.log.info("Chunk %s sets a variable in another kernel and is not cached.",
+                          context.chunk_number)
+            use_cache = False
+        if use_cache:
+            entry = context.cache.load(cache_key)
+            if entry is not None:
+                self.log.info("Using cached results for chunk %s.", context.chunk_number)
+                chunk.messages = entry["messages"]
+                chunk.cached_objects = entry["objects"]
+                if entry["objects"] is not None:
+                    # the kernel is only needed (and started) when code is executed
+                    context.pending_objects.append((engine.name, entry["objects"]))
+                context.execution_finished()
+                return chunk
+
+        if (context.document_deadline is not None) and (time.time() >= context.document_deadline):
+            message = "Not executed: the document ran longer than %s seconds." % (
+                self.document_timeout)
+            chunk.messages.append(_knitpy_message(KNITPY_TIMEOUT, {"message": message}))
+            chunk.timed_out = True
+            context.execution_finished()
+            return chunk
+
+        self._set_limits(args, context)
+        self._prepare_kernel(engine, context)
+        memory_limit = self._limit_memory(engine, args)
+        if use_cache:
+            namespace = self._get_namespace(engine, context)
+
+        # statements which are run in one batch
+        batch = []
+        for status, lines in self._iter_statements(engine.get_chunk_code(chunk.code, args),
+                                                   engine):
+            if status == "invalid":
+                if batch:
+                    self._run_batch(batch, context)
+                    batch = []
+                # TODO: not sure how this should be handled
+                # Either abort execution of the whole file or just retry with the next line?
+                # However this should be handled via a user message
+                self.log.info("Code invalid:\n%s",  lines)
+                chunk.messages.append(_knitpy_message(KNITPY_INVALID_CODE, {"code": lines}))
+            elif self.batch_execution:
+                batch.append(lines)
+            else:
+                self._run_lines(lines, context)
+            if chunk.timed_out:
+                # the kernel was interrupted: the rest of the chunk is not run
+                break
+        if batch and not chunk.timed_out:
+            self._run_batch(batch, context)
+
+        if memory_limit and _out_of_memory(chunk.messages):
+            message = "The chunk exceeded the memory limit of %s MB." % memory_limit
+            chunk.messages.append(_knitpy_message(KNITPY_LIMIT_EXCEEDED, {"message": message}))
+        # the setup code of the next chunk should not run with the limit of this chunk
+        self._limit_memory(engine, {})
+
+        if (output is not None) and not chunk.timed_out and \
+                not any(msg["msg_type"] == "error" for msg in chunk.messages):
+            self._set_output_variable(chunk, output, context)
+
+        if use_cache and not chunk.timed_out:
+            self._store_in_cache(cache_key, namespace, context)
+
+        context.execution_finished()
+        return chunk
+
+    def _set_limits(self, args, context):
+        """Sets the timeout and the deadline for the code of the current chunk"""
+        context.timeout = self.timeout
+        context.deadline = None
+        chunk_timeout = args.get("timeout", None)
+        if chunk_timeout is not None:
+            try:
+                chunk_timeout = float(chunk_timeout)
+            except (TypeError, ValueError):
+                self.log.error("Invalid timeout option: '%s'. Ignored...", chunk_timeout)
+                chunk_timeout = None
+        if chunk_timeout is not None:
+            # the chunk may run that long, no matter if it sends output or not
+            context.timeout = None
+            context.deadline = time.time() + chunk_timeout
+            context.deadline_message = "Execution interrupted: the chunk ran longer than its " \
+                                       "timeout of %s seconds." % args["timeout"]
+        if (context.document_deadline is not None) and \
+                ((context.deadline is None) or (context.document_deadline < context.deadline)):
+            context.deadline = context.document_deadline
+            context.deadline_message = "Execution interrupted: the document ran longer than " \
+                                       "%s seconds." % self.document_timeout
+
+    def _limit_memory(self, engine, args):
+        """Sets the memory limit of the engine's kernel for the code of a chunk
+
+        The `memory_limit` chunk option (in MB) lowers the limit of the kernel (see
+        `KernelPool.memory_limit`) for this chunk. Returns the limit in MB or None.
+        """
+        kernel = self._kernels.get(self._kernel_key(engine))
+        if kernel is None:
+            return None
+        megabytes = args.get("memory_limit", None)
+        if megabytes is not None:
+            try:
+                megabytes = int(megabytes)
+                if megabytes <= 0:
+                    raise ValueError()
+            except (TypeError, ValueError):
+                self.log.error("Invalid memory_limit option: '%s'. Ignored...", megabytes)
+                megabytes = None
+        self._pool.set_memory_limit(kernel, megabytes)
+        if kernel.memory_limit is None:
+            return None
+        return kernel.memory_limit // (1024 * 1024)
+
+    def _prepare_kernel(self, engine, context):
+        """Makes sure the engine's kernel is ready to execute the code of the document
+
+        Everything which has to be set up (startup lines, plotting formats, cache helpers and
+        objects of cached chunks) is sent to the kernel in one request.
+        """
+        setup_code = []
         if not engine.name in context.enabled_documents:
-            plotting_formats = context.output.export_config.accepted_image_formats
-            plot_code = engine.get_plotting_format_code(plotting_formats)
-            self._run_silently(context.engine.kernel, plot_code)
+            plotting_formats = context.image_formats
+            setup_code.append(engine.get_plotting_format_code(plotting_formats))
             context.enabled_documents.append(engine.name)
-            self.log.info("Enabled image formats '%s' in engine '%s'.",
+            self.log.info("Enabling image formats '%s' in engine '%s'.",
                           plotting_formats,
                           engine.name)
 
-        # configure the context
-
-        if "include" in args:
-            include = args.pop("include")
-            if not include:
-                context.echo = False
-                context.results = "hide"
-
-        if "echo" in args:
-            context.echo = args.pop("echo")
+        # objects from cached chunks, which are needed by the code which is executed now
+        pending = [data for name, data in context.pending_objects if name == engine.name]
+        needs_helpers = bool(pending) or ((context.cache is not None) and
+                                          bool(context.chunk.args.get("cache", False)))
+        helper_code = engine.get_cache_helper_code()
+        if needs_helpers and (helper_code is not None) and \
+                not engine.name in context.cache_helpers:
+            setup_code.append(helper_code)
+            context.cache_helpers.append(engine.name)
+        if pending:
+            setup_code.extend(engine.get_load_code(data) for data in pending)
+            context.pending_objects = [(name, data) for name, data in context.pending_objects
+                                       if name != engine.name]
+            self.log.info("Restoring the objects of %s cached chunk(s) in engine '%s'.",
+                          len(pending), engine.name)
+
+        self._get_kernel(engine, setup_code=setup_code)
+
+    def _ensure_cache_helpers(self, engine, context):
+        """Defines the engine's cache helpers in the kernel
+
+        returns bool
+            False if the engine can't save and restore objects
+        """
+        code = engine.get_cache_helper_code()
+        if code is None:
+            return False
+        if not engine.name in context.cache_helpers:
+            self._run_silently(engine.kernel, code)
+            context.cache_helpers.append(engine.name)
+        return True
 
-        # eval=False means that we don't execute the block at all
-        if "eval" in args:
-            _eval = args.pop("eval")
-            if _eval is False:
-                # We still should add the code block if echo is True.
-                if context.echo:
-                    code = code.replace(os.linesep, "\n").lstrip("\n")
-                    context.output.add_code(code, language=engine.language)
+    def _get_namespace(self, engine, context):
+        """Returns the identities of all objects in the kernel namespace (or None)"""
+        if not self._ensure_cache_helpers(engine, context):
+            return None
+        try:
+            return json.loads(self._evaluate_silently(engine.kernel,
+                                                      engine.get_namespace_expression()))
+        except KnitpyException as e:
+            self.log.warn("Could not get the kernel namespace: %s", e)
+            return None
+
+    def _store_in_cache(self, cache_key, namespace, context):
+        """Stores the results of the current chunk and the objects it created or changed in the
+        cache"""
+        engine = context.engine
+        chunk = context.chunk
+        objects = None
+        if namespace is not None:
+            if (chunk.names is None) or chunk.names.opaque:
+                # objects of earlier chunks could be changed in place, but which ones is unknown
+                self.log.info("Chunk %s is not cached: can't find out which objects it changes.",
+                              context.chunk_number)
                 return
+            changed = self._get_namespace(engine, context)
+            if changed is None:
+                return
+            # new or rebound names, and objects of earlier chunks which were changed in place
+            # (e.g. `x.append(1)`), which have the same identity as before
+            names = set(name for name, identity in iteritems(changed)
+                        if namespace.get(name) != identity)
+            names.update(name for name in chunk.names.modifies | chunk.names.calls
+                         if name in changed)
+            names = sorted(names)
+            try:
+                status, objects = self._evaluate_silently(engine.kernel,
+                                                          engine.get_dump_expression(names))
+            except KnitpyException as e:
+                self.log.warn("Could not save the objects of chunk %s: %s",
+                              context.chunk_number, e)
+                return
+            if status != "ok":
+                self.log.warn("Chunk %s is not cached: can't save the object(s) %s.",
+                              context.chunk_number, ", ".join(objects))
+                return
+        context.cache.store(cache_key, context.chunk.messages, objects)
 
-        if "results" in args:
-            context.results = args.pop("results")
-
-        if "chunk_label" in args:
-            context.chunk_label = args.pop("chunk_label")
-        else:
-            context.chunk_label = u"unnamed-chunk-%s" % context.chunk_number
-
-        if "comment" in args:
-            context.comment = args.pop("comment")
+    def _iter_statements(self, code, engine):
+        """Splits the code into groups of lines, which can be executed one after the other
 
-        if args:
-            self.log.debug("Found unhandled args: %s", args)
+        yields (status, lines)
+            status is 'complete' (lines can be run), 'incomplete' (only at the end, running the
+            lines will result in an error) or 'invalid' (lines should not be run)
+        """
+        # If the engine can split the code itself, no round trips to the kernel are needed
+        groups = engine.split_statements(code)
+        if groups is not None:
+            for lines in groups:
+                yield "complete", lines
+            return
 
         lines = ''
         code_lines = code.split('\n')
@@ -341,12 +1120,8 @@ class Knitpy(LoggingConfigurable):
                     lines += "\n"
                     continue
             # we have a block of code, including all lines of a loop
-            msg = engine.kernel.is_complete(lines+"\n\n")
-            reply = engine.kernel.get_shell_msg(timeout=self.timeout)
-            assert reply['msg_type'] == 'is_complete_reply', str(reply)
-            if self.kernel_debug:
-                self.log.debug("completion_request: %s", msg)
-            if reply['content']['status'] == 'complete':
+            status = self._is_complete(lines+"\n\n", engine)
+            if status == 'complete':
                 if lines.strip() == "":
                     # No requests for "no code"
                     lines = ""
@@ -356,15 +1131,10 @@ class Knitpy(LoggingConfigurable):
                     lines += "\n"
                     continue
                 # run the lines
-                self._run_lines(lines+"\n", context)
+                yield "complete", lines+"\n"
                 lines = ""
-            elif reply['content']['status'] == 'invalid':
-                # TODO: not sure how this should be handled
-                # Either abort execution of the whole file or just retry with the next line?
-                # However this should be handled via a user message
-                self.log.info("Code invalid:\n%s",  lines)
-                context.output.add_code(lines, language=engine.language)
-                context.output.add_execution_error("Code invalid")
+            elif status == 'invalid':
+                yield "invalid", lines
                 lines = ""
             else:
                 # the "incomplete" case: don't run anything wait for the next line
@@ -373,7 +1143,75 @@ class Knitpy(LoggingConfigurable):
         # This can only happen if the last line is incomplete
         # This will always result in an error!
         if lines.strip() != "":
-            self._run_lines(lines, context)
+            yield "incomplete", lines
+
+    def _is_complete(self, lines, engine):
+        """Returns 'complete', 'incomplete' or 'invalid' for the given lines"""
+        status = engine.is_complete(lines)
+        if status is not None:
+            return status
+        # The engine can't answer that itself, so ask the kernel
+        request = self._pool.dispatcher.is_complete(engine.kernel, lines)
+        if not self._pool.dispatcher.wait(request, timeout=self.timeout, until_reply=True):
+            if request.kernel_died:
+                raise KernelDiedException("The kernel died.")
+            raise KnitpyException("Timeout waiting for is_complete reply.")
+        reply = request.reply
+        assert reply['msg_type'] == 'is_complete_reply', str(reply)
+        if self.kernel_debug:
+            self.log.debug("completion_request: %s", request.msg_id)
+        return reply['content']['status']
+
+    def _replay_chunk(self, chunk, context):
+
+        context.execution_started()
+        context.engine = chunk.engine
+        context.mode = chunk.mode
+
+        # configure the context
+        args = dict(chunk.args)
+
+        if "include" in args:
+            include = args.pop("include")
+            if not include:
+                context.echo = False
+                context.results = "hide"
+
+        if "echo" in args:
+            context.echo = args.pop("echo")
+
+        # eval=False means that we don't execute the block at all
+        if "eval" in args:
+            _eval = args.pop("eval")
+            if _eval is False:
+                # We still should add the code block if echo is True.
+                if context.echo:
+                    code = chunk.code.replace(os.linesep, "\n").lstrip("\n")
+                    context.output.add_code(code, language=chunk.engine.language)
+                return
+
+        if "results" in args:
+            context.results = args.pop("results")
+
+        if "chunk_label" in args:
+            context.chunk_label = args.pop("chunk_label")
+        else:
+            context.chunk_label = u"unnamed-chunk-%s" % context.chunk_number
+
+        if "comment" in args:
+            context.comment = args.pop("comment")
+
+        # options which are only relevant for the execution
+        args.pop("cache", None)
+        args.pop("dependson", None)
+        args.pop("timeout", None)
+        args.pop("memory_limit", None)
+
+        if args:
+            self.log.debug("Found unhandled args: %s", args)
+
+        for msg in chunk.messages:
+            self._handle_return_message(msg, context)
 
         context.execution_finished()
 
@@ -436,80 +1274,168 @@ class Knitpy(LoggingConfigurable):
 
 
     def _run_lines(self, lines, context):
-        kernel = context.engine.kernel
-        msg_id = kernel.execute(lines)
-        if self.kernel_debug:
-            self.log.debug("Executing lines (msg_id=%s):\n%s", msg_id, lines)
-        # wait for finish, with timeout
-        # At first we have to wait until the kernel tells us it is finished with running the code
-        while True:
-            try:
-                msg = kernel.shell_channel.get_msg(timeout=self.timeout)
-                if self.kernel_debug:
-                    self.log.debug("shell msg: %s", msg)
-            except Empty:
-                # This indicates that something bad happened, as AFAIK this should return...
-                self.log.error("Timeout waiting for execute reply")
-                raise KnitpyException("Timeout waiting for execute reply.")
-            if msg['parent_header'].get('msg_id') == msg_id:
-                # It's finished, and we got our reply, so next look at the results
-                break
-            else:
-                # not our reply
-                self.log.debug("Discarding message from a different client: %s" % msg)
-                continue
+        try:
+            messages = self._execute(context.engine.kernel, lines, context=context)
+        except KernelDiedException as e:
+            context.chunk.messages.extend(e.messages)
+            raise
+        context.chunk.messages.extend(messages)
+        if _timed_out(messages):
+            context.chunk.timed_out = True
+
+    def _run_batch(self, statements, context):
+        """Executes all statements with one execute request
+
+        The outputs are still attributed to the statement which produced them: the kernel
+        prints a marker before running each statement (see
+        :meth:`BaseKnitpyEngine.get_batch_code`).
+        """
+        marker = "@@knitpy-%s-" % uuid.uuid4().hex
+        code = context.engine.get_batch_code(statements, marker)
+        if (code is None) or (len(statements) == 1):
+            for lines in statements:
+                self._run_lines(lines, context)
+            return
 
-        # Now look at the results of our code execution and earlier completion requests
-        # We handle messages until the kernel indicates it's ide again
-        status_idle_again = False
-        while True:
-            try:
-                msg = kernel.get_iopub_msg(timeout=self.timeout)
-            except Empty:
-                # There should be at least some messages: we just executed code!
-                # The only valid time could be when the timeout happened too early (aka long
-                # running code in the document) -> we handle that below
-                self.log.warn("Timeout waiting for expected IOPub output")
+        re_marker = re.compile(re.escape(marker) + r"([0-9]+)@@\n")
+        # messages for each statement, starting with the statement's code
+        results = [[_knitpy_message("execute_input", {"code": lines})] for lines in statements]
+        number = 0
+        current = results[number]
+        died = None
+        try:
+            # The history is only stored for the individual statements
+            messages = self._execute(context.engine.kernel, code, store_history=False,
+                                     context=context)
+        except KernelDiedException as e:
+            messages, died = e.messages, e
+        for msg in messages:
+            msg_type = msg["msg_type"]
+            if msg_type == "execute_input":
+                # this is the batch code, the statements are added above
+                continue
+            if (msg_type == "stream") and (msg["content"].get("name") == "stdout"):
+                text = msg["content"].get("text", "")
+                pos = 0
+                for match in re_marker.finditer(text):
+                    if match.start() > pos:
+                        current.append(self._stream_message(msg, text[pos:match.start()]))
+                    number = int(match.group(1))
+                    current = results[number]
+                    pos = match.end()
+                if pos < len(text):
+                    current.append(self._stream_message(msg, text[pos:]))
+                continue
+            current.append(msg)
+
+        if died is not None:
+            # the statements after the one which killed the kernel didn't run
+            for messages in results[:number + 1]:
+                context.chunk.messages.extend(messages)
+            raise died
+
+        for messages in results:
+            context.chunk.messages.extend(messages)
+            if _timed_out(messages):
+                # the statements after the interrupted one didn't run
+                context.chunk.timed_out = True
                 break
 
-            if msg['parent_header'].get('msg_id') != msg_id:
-                if msg['parent_header'].get(u'msg_type') != u'is_complete_request':
-                    # not an output from our execution and not one of the complete_requests
-                    self.log.debug("Discarding output from a different client: %s" % msg)
-                else:
-                    # complete_requests are ok
-                    pass
-                continue
+    def _stream_message(self, msg, text):
+        """Returns a copy of a stream message with a different text"""
+        content = dict(msg["content"])
+        content["text"] = text
+        stream_msg = dict(msg)
+        stream_msg["content"] = content
+        return stream_msg
 
-            # Here we have some message which corresponds to our code execution
+    def _execute(self, kernel, lines, store_history=True, context=None):
+        """Executes the lines and returns all messages (e.g. outputs) of the execution
+
+        If the code doesn't finish in time (see `timeout`, the chunk's `timeout` option and
+        `document_timeout`), the kernel is interrupted and a KNITPY_TIMEOUT message is added.
+        """
+        timeout = self.timeout
+        deadline = None
+        deadline_message = ""
+        if context is not None:
+            timeout = context.timeout
+            deadline = context.deadline
+            deadline_message = context.deadline_message
+
+        dispatcher = self._pool.dispatcher
+        request = dispatcher.execute(kernel, lines, store_history=store_history)
+        if self.kernel_debug:
+            self.log.debug("Executing lines (msg_id=%s):\n%s", request.msg_id, lines)
+        # wait until the kernel tells us that it is finished with running the code (the reply)
+        # and that all outputs were sent (status idle)
+        # after a timeout, the outputs of the interrupt still belong to this request
+        finished = dispatcher.wait(request, timeout=timeout, deadline=deadline, give_up=False)
+        if self.kernel_debug:
+            self.log.debug("shell msg: %s", request.reply)
+
+        messages = []
+        timeout_message = None
+        if request.kernel_died:
+            dispatcher.discard(request)
+            # keep the messages up to now, so that the code which killed the kernel is shown
+            raise KernelDiedException("The kernel died while running:\n%s" % lines,
+                                      messages=self._content_messages(request))
+        if not finished:
+            if (deadline is not None) and (time.time() >= deadline):
+                message = deadline_message
+            else:
+                message = ("Execution interrupted: no output for %s seconds. Use the 'timeout' "
+                           "chunk option for long running code." % timeout)
+            self.log.error("%s\nline(s): %s", message, lines)
+            timeout_message = _knitpy_message(KNITPY_TIMEOUT, {"message": message})
+            # keep the messages up to now, the rest (e.g. the traceback) comes after the
+            # interrupt
+            messages.extend(request.messages)
+            messages.append(timeout_message)
+            del request.messages[:]
+            self._interrupt_kernel(kernel)
+            if not dispatcher.wait(request, timeout=self.interrupt_timeout):
+                if request.kernel_died:
+                    raise KernelDiedException("The kernel died after an interrupt.",
+                                              messages=messages + self._content_messages(request))
+                raise KnitpyException("Kernel didn't react to the interrupt.")
+
+        messages.extend(self._content_messages(request))
+        return messages
+
+    def _content_messages(self, request):
+        """Returns the IOPub messages of the request, which go into the document"""
+        messages = []
+        for msg in request.messages:
             msg_type = msg['msg_type']
-            content = msg['content']
-
-            # The kernel indicates some status: executing -> idle
-            if msg_type == 'status':
-                if content['execution_state'] == 'idle':
-                    # When idle, the kernel has executed all input
-                    status_idle_again = True
-                    break
-                else:
-                    # the "starting execution" messages
-                    continue
-            elif msg_type == 'clear_output':
+            if msg_type == 'clear_output':
                 # we don't handle that!?
                 self.log.debug("Discarding unexpected 'clear_output' message: %s" % msg)
                 continue
             ## So, from here on we have a messages with real content
             if self.kernel_debug:
                 self.log.debug("iopub msg (%s): %s",msg_type, msg)
-            self._handle_return_message(msg, context)
-
-        if not status_idle_again:
-            self.log.error("Code lines didn't execute in time. Don't use long-running code in "
-                           "documents or increase the timeout!")
-            self.log.error("line(s): %s" % lines)
+            messages.append(msg)
+        return messages
+
+    def _interrupt_kernel(self, kc):
+        """Interrupts the code which is running in the kernel of the client"""
+        # other lanes can add kernels at the same time
+        for kernel in list(self._kernels.values()):
+            if kernel.client is kc:
+                self.log.info("Interrupting kernel '%s'.", kernel.kernel_name)
+                kernel.manager.interrupt_kernel()
+                return
 
     def _handle_return_message(self, msg, context):
-        if context.mode == "inline":
+        if msg["msg_type"] == KNITPY_INVALID_CODE:
+            context.output.add_code(msg["content"]["code"], language=context.engine.language)
+            context.output.add_execution_error("Code invalid")
+        elif msg["msg_type"] in (KNITPY_TIMEOUT, KNITPY_KERNEL_DIED, KNITPY_LIMIT_EXCEEDED,
+                                 KNITPY_ERROR):
+            context.output.add_execution_error(msg["content"]["message"])
+        elif context.mode == "inline":
             #self.log.debug("inline: %s" % msg)
             if msg["msg_type"] == "execute_result":
                 context.output.add_text(_plain_text(msg["content"]))
@@ -570,13 +1496,18 @@ class Knitpy(LoggingConfigurable):
                     return
 
                 # now try some marked up text formats
-                for mime_type in context.output.markup_mimetypes:
-                    mime_data = data.get(mime_type, None)
-                    if mime_data is None:
-                        continue
+                markups = [(mime_type, data[mime_type])
+                           for mime_type in context.output.markup_mimetypes
+                           if data.get(mime_type, None) is not None]
+                # what is used if a batched conversion of the markup fails later on
+                plain = []
+                if (context.results in ('markup', 'asis')) and data.get(u"text/plain", ""):
+                    plain = [(u"text/plain", data[u"text/plain"])]
+                for number, (mime_type, mime_data) in enumerate(markups):
                     try:
                         self.log.debug("Trying to include markup text...")
-                        context.output.add_markup_text(mime_type, mime_data)
+                        context.output.add_markup_text(mime_type, mime_data,
+                                                       fallbacks=markups[number + 1:] + plain)
                     except KnitpyOutputException as e:
                         self.log.info("Couldn't include markup text: %s", e)
                         continue
@@ -618,44 +1549,115 @@ class Knitpy(LoggingConfigurable):
                 self.log.debug("Ignored msg of type %s" % type)
 
 
-    def _run_silently(self, kc, lines):
-        try:
-            msg_id = kc.execute(lines + "\n\n", silent=self.kernel_debug, store_history=False)
-            self.log.debug("Executed silent code: %s", lines)
-            reply = kc.get_shell_msg(timeout=self.timeout)
-            assert reply['parent_header'].get('msg_id') == msg_id, "Wrong reply! " + str(reply)
-            if self.kernel_debug:
-                self.log.debug("Silent code shell reply: %s", reply)
-        except Empty:
-            self.log.error("Code took too long:\n %s", lines)
-
-        # now empty the iopub channel (there is at least a "starting" message)
-        while True:
-            try:
-                msg = kc.get_iopub_msg(timeout=0.1)
-                if self.kernel_debug:
-                    self.log.debug("Silent code iopub msg: %s", msg)
-            except Empty:
-                break
+    def _run_silently(self, kc, lines, user_expressions=None):
+        """Executes lines without recording any output
 
-    def _get_kernel(self, engine):
+        returns dict or None
+            the content of the execute reply or None if the code took too long
+        """
+        dispatcher = self._pool.dispatcher
+        request = dispatcher.execute(kc, lines + "\n\n", silent=self.kernel_debug,
+                                     store_history=False, user_expressions=user_expressions)
+        self.log.debug("Executed silent code: %s", lines)
+        # the request is done when the kernel is idle again, so no output of this code can end up
+        # in the output of the next code
+        if not dispatcher.wait(request, timeout=self.timeout):
+            if request.kernel_died:
+                raise KernelDiedException("The kernel died while running:\n%s" % lines)
+            if request.reply is None:
+                self.log.error("Code took too long:\n %s", lines)
+                return None
+            self.log.warn("Timeout waiting for the kernel to become idle after:\n %s", lines)
+        if self.kernel_debug:
+            self.log.debug("Silent code shell reply: %s", request.reply)
+            for msg in request.messages:
+                self.log.debug("Silent code iopub msg: %s", msg)
+        return request.reply['content']
+
+    def _evaluate_silently(self, kc, expression):
+        """Evaluates the expression in the kernel and returns the (literal) result"""
+        content = self._run_silently(kc, "", user_expressions={"result": expression})
+        if content is None:
+            raise KnitpyException("Timeout while evaluating '%s'." % expression)
+        result = content.get('user_expressions', {}).get("result", {})
+        if result.get('status') != 'ok':
+            raise KnitpyException("Error while evaluating '%s': %s: %s" % (
+                expression, result.get('ename'), result.get('evalue')))
+        return ast.literal_eval(result['data']['text/plain'])
+
+    def _get_kernel(self, engine, setup_code=None):
+        """Returns the kernel client of the engine and runs the setup code in the kernel
+
+        setup_code : list of strings or None
+            code which has to run before the code of the document. If the kernel is new for this
+            document, the engine's startup lines are run first. If the engine supports it, all
+            parts are sent in one request (see `get_combined_code()`).
+        """
         kernel_name = engine.kernel_name
-        kernel_startup_lines = engine.startup_lines
-
-        if not kernel_name in self._kernels:
-            self.log.info("Starting a new kernel: %s" % kernel_name)
-            kernelid = self._km.start_kernel(kernel_name=kernel_name)
-            #km.list_kernel_ids()
-            kn = self._km.get_kernel(kernelid)
-            kc = kn.client()
-            self._kernels[kernel_name] = kc
-            # now initalize the channels
-            kc.start_channels()
-            kc.wait_for_ready()
-            self._run_silently(kc, kernel_startup_lines)
-            self.log.info("Executed kernel startup lines for engine '%s'.", engine.name)
+        key = self._kernel_key(engine)
+        code = list(setup_code or [])
+
+        if not key in self._kernels:
+            kernel = self._pool.acquire(kernel_name)
+            self._kernels[key] = kernel
+            code.insert(0, engine.startup_lines)
+            # a pooled kernel was started in (or used for a document in) another directory
+            chdir_code = engine.get_chdir_code(getcwd())
+            if chdir_code is not None:
+                code.insert(1, chdir_code)
+            if self._params is not None:
+                params_code = engine.get_params_code(self._params)
+                if params_code is not None:
+                    code.insert(len(code) - len(setup_code or []), params_code)
+
+        kc = self._kernels[key].client
+        if code:
+            combined = engine.get_combined_code(code) if len(code) > 1 else None
+            for part in ([combined] if combined is not None else code):
+                reply = self._run_silently(kc, part)
+                if (reply is not None) and (reply['status'] != 'ok'):
+                    self.log.warn("Error while setting up the kernel for engine '%s': %s: %s",
+                                  engine.name, reply.get('ename'), reply.get('evalue'))
+            self.log.info("Executed kernel setup code for engine '%s'.", engine.name)
+        return kc
+
+    def _kernel_key(self, engine):
+        """Returns the key of the engine's kernel in `_kernels`
+
+        Each lane (see `parallel_kernels`) has its own kernels, the lane is set per thread.
+        """
+        lane = getattr(self._lane, "number", 0)
+        if lane == 0:
+            return engine.kernel_name
+        return "%s-%s" % (engine.kernel_name, lane)
+
+    def _release_kernels(self):
+        """Gives the kernels of the current document back to the pool"""
+        engines = dict((engine.kernel_name, engine) for engine in self._engines.values())
+        for key, kernel in list(self._kernels.items()):
+            del self._kernels[key]
+            engine = engines.get(kernel.kernel_name)
+            clean = False
+            if (engine is not None) and self._pool.is_reusable(kernel):
+                reset_code = engine.get_reset_code()
+                if reset_code is not None:
+                    try:
+                        reply = self._run_silently(kernel.client, reset_code)
+                    except KernelDiedException:
+                        reply = None
+                    clean = (reply is not None) and (reply['status'] == 'ok')
+                if not clean:
+                    self.log.info("Could not reset kernel for engine '%s', restarting it.",
+                                  engine.name)
+            self._pool.release(kernel, clean=clean)
+        self._kernels = {}
+        # prestarted kernels which were not needed after all
+        self._pool.trim()
 
-        return self._kernels[kernel_name]
+    def shutdown_kernels(self):
+        """Shuts down all kernels, including the idle ones in the kernel pool"""
+        self._kernels = {}
+        self._pool.shutdown_all()
 
 
     def get_output_format(self, fmt_name, config=None):
@@ -674,8 +1676,14 @@ class Knitpy(LoggingConfigurable):
                            fmt_name, config)
         return fod
 
-    def _knit(self, input, outputdir_name, final_format="html", config=None):
-        """Internal function to aid testing"""
+    def _active_pandoc_server(self):
+        return self._pandoc_server if self.use_pandoc_server else None
+
+    def _knit(self, input, outputdir_name, final_format="html", config=None, cache_dir=None):
+        """Internal function to aid testing
+
+        Chunks with the `cache` option are only cached if `cache_dir` is given.
+        """
 
 
         parsed, metadata = self.parse_document(input) # sets kpydoc.parsed and
@@ -683,17 +1691,28 @@ class Knitpy(LoggingConfigurable):
 
         md_temp = TemporaryOutputDocument(fileoutputs=outputdir_name,
                                           export_config=final_format,
+                                          markup_cache=self._markup_cache,
+                                          pandoc_server=self._active_pandoc_server(),
                                           log=self.log, parent=self)
 
         # get the temporary md file
-        self.convert(parsed, md_temp)
+        self.convert(parsed, md_temp, cache_dir=cache_dir)
 
-        return md_temp.content
+        try:
+            return md_temp.content
+        finally:
+            md_temp.cleanup()
 
 
-    def render(self, filename, output=None):
+    def render(self, filename, output=None, params=None, output_suffix=""):
         """
         Convert the filename to the given output format(s)
+
+        params : dict or None
+            parameters, which override the `params` of the yaml metadata. They are available as
+            `params` in the kernels.
+        output_suffix : string
+            added to the name of the output files (e.g. `report-1.html`)
         """
         # Export each documents
         conversion_success = 0
@@ -710,6 +1729,9 @@ class Knitpy(LoggingConfigurable):
 
         basedir = os.path.dirname(filename)
         basename = os.path.splitext(os.path.basename(filename))[0]
+        # all parameter sets of a document share the cache (the parameters are part of the key)
+        cache_dir = basename + "_cache"
+        basename += output_suffix
 
         # It's easier if we just change wd to the dir of the file
         if unicode_type(basedir) != getcwd():
@@ -719,90 +1741,445 @@ class Knitpy(LoggingConfigurable):
             filename = os.path.basename(filename)
 
 
-        outputdir_name = os.path.splitext(basename)[0] + "_files"
+        md_temps = []
+        try:
+            outputdir_name = os.path.splitext(basename)[0] + "_files"
+
+            # parse the input document
+            parsed, metadata = self.parse_document(filename)
+            if (params is not None) or ("params" in metadata):
+                params = dict(metadata.get("params") or {}, **(params or {}))
+
+            # get the output formats
+            # order: kwarg overwrites default overwrites document
+            output_formats = [self._outputs[self.default_export_format]]
+            if output is None:
+                self.log.debug("Converting to default output format [%s]!" %
+                               self.default_export_format)
+            elif output == "all":
+                outputs = metadata.get("output", None)
+                # if nothing is specified, we keep the default
+                if outputs is None:
+                    self.log.debug("Did not find any specified output formats: using only "
+                                   "default!")
+                else:
+                    output_formats = []
+                    for fmt_name, config in iteritems(outputs):
+                        fod = self.get_output_format(fmt_name, config)
+                        output_formats.append(fod)
+                    self.log.debug("Converting to all specified output formats: %s" %
+                                   [fmt.name for fmt in output_formats])
+            else:
+                self._ensure_valid_output(output)
+                output_formats = [self._outputs[output]]
+
+            for final_format in output_formats:
+                # TODO: build a proper way to specify final output...
+                md_temp = TemporaryOutputDocument(fileoutputs=outputdir_name,
+                                                  export_config=final_format,
+                                                  markup_cache=self._markup_cache,
+                                                  pandoc_server=self._active_pandoc_server(),
+                                                  log=self.log, parent=self)
+                md_temps.append(md_temp)
+
+            # get the temporary md files: the code is only executed once for all output formats
+            self.convert(parsed, md_temps, cache_dir=cache_dir, params=params)
+
+            # the kernels are given back at the end of convert(), so they don't wait for this
+            outfilenames = self._convert_final_formats(filename, basename, output_formats,
+                                                       md_temps)
+            converted_docs.extend(os.path.join(basedir, outfilename)
+                                  for outfilename in outfilenames)
+        finally:
+            for md_temp in md_temps:
+                md_temp.cleanup()
+            # also go back if something failed, so that the next document (and the caller)
+            # doesn't end up in the wrong directory
+            if needs_chdir:
+                os.chdir(orig_cwd)
+        return converted_docs
+
+
+    def _convert_final_formats(self, filename, basename, output_formats, md_temps):
+        """Converts the temporary markdown documents to the final output formats
+
+        Up to `parallel_conversions` formats are converted at the same time. A failed format
+        doesn't stop the others: all errors are logged and then the first one is raised.
+
+        returns list
+            the names of the output files (in the order of the output formats)
+        """
+        jobs = list(zip(output_formats, md_temps))
+        # number of the job -> (output filename, exception, seconds)
+        results = {}
+
+        def convert(number):
+            final_format, md_temp = jobs[number]
+            started = time.time()
+            try:
+                outfilename = self._convert_final_format(filename, basename, final_format,
+                                                         md_temp)
+                results[number] = (outfilename, None, time.time() - started)
+            except Exception as e:
+                results[number] = (None, e, time.time() - started)
 
-        # parse the input document
-        parsed, metadata = self.parse_document(filename)
+        workers = min(max(self.parallel_conversions, 1), len(jobs))
+        if workers <= 1:
+            for number in range(len(jobs)):
+                convert(number)
+        else:
+            self.log.info("Converting to %s output formats with %s workers.", len(jobs), workers)
+            queue = Queue()
+            for number in range(len(jobs)):
+                queue.put(number)
 
-        # get the output formats
-        # order: kwarg overwrites default overwrites document
-        output_formats = [self._outputs[self.default_export_format]]
-        if output is None:
-            self.log.debug("Converting to default output format [%s]!" % self.default_export_format)
-        elif output == "all":
-            outputs = metadata.get("output", None)
-            # if nothing is specified, we keep the default
-            if outputs is None:
-                self.log.debug("Did not find any specified output formats: using only default!")
+            def work():
+                while True:
+                    try:
+                        number = queue.get_nowait()
+                    except Empty:
+                        return
+                    convert(number)
+
+            threads = [threading.Thread(target=work, name="knitpy-conversion-%s" % i)
+                       for i in range(workers)]
+            for thread in threads:
+                # pandoc processes are not stopped by a KeyboardInterrupt: don't wait for them
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                # join() with a timeout, so that a KeyboardInterrupt is noticed
+                while thread.is_alive():
+                    thread.join(0.5)
+
+        outfilenames = []
+        errors = []
+        for number, (final_format, md_temp) in enumerate(jobs):
+            outfilename, error, seconds = results[number]
+            if error is None:
+                self.log.info("Written final output: %s (%s, %.2f s)", outfilename,
+                              final_format.name, seconds)
+                outfilenames.append(outfilename)
             else:
-                output_formats = []
-                for fmt_name, config in iteritems(outputs):
-                    fod = self.get_output_format(fmt_name, config)
-                    output_formats.append(fod)
-                self.log.debug("Converting to all specified output formats: %s" %
-                               [fmt.name for fmt in output_formats])
+                self.log.error("Converting %s to %s failed after %.2f s: %s", filename,
+                               final_format.name, seconds, error)
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        return outfilenames
+
+    def _convert_final_format(self, filename, basename, final_format, md_temp):
+        """Converts one temporary markdown document with pandoc and returns the output filename"""
+        self.log.info("Converting document %s to %s", filename, final_format.name)
+        if md_temp.stream_to_file:
+            # pandoc reads the file, so the document never has to be in memory
+            source = md_temp.save()
         else:
-            self._ensure_valid_output(output)
-            output_formats = [self._outputs[output]]
-
-        for final_format in output_formats:
-            self.log.info("Converting document %s to %s", filename, final_format.name)
-            # TODO: build a proper way to specify final output...
-
-            md_temp = TemporaryOutputDocument(fileoutputs=outputdir_name,
-                                              export_config=final_format,
-                                              log=self.log, parent=self)
-
-            # get the temporary md file
-            self.convert(parsed, md_temp)
-            if final_format.keep_md or self.keep_md:
-                mdfilename = basename+"."+final_format.name+".md"
-                self.log.info("Saving the temporary markdown as '%s'." % mdfilename)
-                # TODO: remove the first yaml metadata block and
-                # put "#<title>\n<author>\n<date>" before the rest
+            source = md_temp.content
+        if final_format.keep_md or self.keep_md:
+            mdfilename = basename+"."+final_format.name+".md"
+            self.log.info("Saving the temporary markdown as '%s'." % mdfilename)
+            # TODO: remove the first yaml metadata block and
+            # put "#<title>\n<author>\n<date>" before the rest
+            if md_temp.stream_to_file:
+                shutil.copyfile(source, mdfilename)
+            else:
                 with codecs.open(mdfilename, 'w+b','UTF-8') as f:
-                    f.write(md_temp.content)
-
-            # convert the md file to the final filetype
-            input_format = "markdown" \
-                           "+autolink_bare_uris" \
-                           "+ascii_identifiers" \
-                           "+tex_math_single_backslash-implicit_figures" \
-                           "+fenced_code_attributes"
-
-            extra = ["--smart", # typographically correct output (curly quotes, etc)
-                     "--email-obfuscation", "none", #do not obfuscation email names with javascript
-                     "--self-contained", # include img/scripts as data urls
-                     "--standalone", # html with header + footer
-                     "--section-divs",
-                     ]
-
-            outfilename = basename+"." +final_format.file_extension
-
-            # exported is irrelevant, as we pass in a filename
-            exported = pandoc(source=md_temp.content,
-                              to=final_format.pandoc_export_format,
-                              format=input_format,
-                              extra_args=extra,
-                              outputfile=outfilename)
-            self.log.info("Written final output: %s" % outfilename)
-            converted_docs.append(os.path.join(basedir, outfilename))
-        if needs_chdir:
-            os.chdir(orig_cwd)
+                    f.write(source)
+
+        # convert the md file to the final filetype
+        input_format = "markdown" \
+                       "+autolink_bare_uris" \
+                       "+ascii_identifiers" \
+                       "+tex_math_single_backslash-implicit_figures" \
+                       "+fenced_code_attributes"
+
+        extra = ["--smart", # typographically correct output (curly quotes, etc)
+                 "--email-obfuscation", "none", #do not obfuscation email names with javascript
+                 "--self-contained", # include img/scripts as data urls
+                 "--standalone", # html with header + footer
+                 "--section-divs",
+                 ]
+
+        outfilename = basename+"." +final_format.file_extension
+
+        # exported is irrelevant, as we pass in a filename
+        exported = pandoc(source=source,
+                          to=final_format.pandoc_export_format,
+                          format=input_format,
+                          extra_args=extra,
+                          outputfile=outfilename)
+        return outfilename
+
+    def render_sweep(self, filename, param_sets, output=None):
+        """
+        Convert the filename once for each parameter set (see :meth:`render`)
+
+        The output files get the number of the parameter set as suffix (`report-1.html`,
+        `report-2.html`, ...). If `fork_kernels` is True, the leading python chunks which don't
+        use `params` are only run for the first parameter set and then once more in a template
+        process. The kernels for the other parameter sets are forked from it, so that they
+        already have the results of these chunks (see :mod:`knitpy.forkserver`).
+        """
+        converted_docs = []
+        if self.fork_kernels and (len(param_sets) > 1):
+            if fork_is_supported():
+                self._sweep = _ParameterSweep()
+            else:
+                self.log.warn("Forking kernels is not supported on this platform.")
+        try:
+            for number, params in enumerate(param_sets, 1):
+                converted_docs.extend(self.render(filename, output=output, params=params,
+                                                  output_suffix="-%s" % number))
+        finally:
+            if (self._sweep is not None) and (self._sweep.server is not None):
+                self._sweep.server.shutdown()
+            self._sweep = None
         return converted_docs
 
+    def _find_setup_chunks(self, chunks):
+        """Returns the indices of the leading chunks, which can run in the template process
+
+        These chunks use one engine and don't use `params` (or things which depend on it), the
+        template runs them without any limits, so chunks with `cache`, `timeout` or
+        `memory_limit` are not included.
+        """
+        setup = []
+        engine = None
+        for index, chunk in enumerate(chunks):
+            if not chunk.evaluated:
+                setup.append(index)
+                continue
+            names = chunk.names
+            if (names is None) or names.opaque:
+                break
+            if (engine is not None) and (chunk.engine is not engine):
+                break
+            used = names.reads | names.modifies | names.calls
+            for reads, _ in names.deferred.values():
+                used |= reads
+            if "params" in used:
+                break
+            if any(option in chunk.args for option in ("cache", "timeout", "memory_limit")):
+                break
+            engine = chunk.engine
+            setup.append(index)
+        if engine is None:
+            return None, []
+        return engine, setup
+
+    def _start_sweep_template(self, chunks, image_formats):
+        """Runs the setup chunks of a parameter sweep in a new template process"""
+        sweep = self._sweep
+        if sweep.setup is None:
+            sweep.engine, sweep.setup = self._find_setup_chunks(chunks)
+        if (sweep.engine is None) or sweep.failed:
+            sweep.failed = True
+            return
+        engine = sweep.engine
+
+        kernel_name = engine.kernel_name
+        if kernel_name == "python":
+            kernel_name = NATIVE_KERNEL_NAME
+        try:
+            spec = self._ksm.get_kernel_spec(kernel_name)
+        except NoSuchKernel:
+            spec = None
+        if (spec is None) or not any("ipykernel" in arg for arg in spec.argv):
+            self.log.warn("Can't fork kernels for engine '%s': it doesn't use an IPython "
+                          "kernel.", engine.name)
+            sweep.failed = True
+            return
+        python = spec.argv[0]
+        if python in ("python", "python%i" % sys.version_info[0],
+                      "python%i.%i" % sys.version_info[:2]):
+            # like jupyter_client: the kernel runs with the same python as knitpy
+            python = sys.executable
+
+        server = ForkServer(python, env=spec.env, log=self.log, parent=self)
+        try:
+            server.start()
+            setup_code = [engine.startup_lines, engine.get_plotting_format_code(image_formats)]
+            for code in setup_code:
+                error = server.run(code)
+                if error is not None:
+                    self.log.warn("Error while setting up the template process for engine "
+                                  "'%s': %s", engine.name, error)
+            for index in sweep.setup:
+                if not chunks[index].evaluated:
+                    continue
+                error = server.run(chunks[index].code)
+                if error is not None:
+                    raise RuntimeError("chunk %s failed: %s" % (index + 1, error))
+        except (RuntimeError, OSError) as e:
+            self.log.warn("Could not start the template process for forked kernels (%s). Running "
+                          "the whole document for each parameter set...", e)
+            server.shutdown()
+            sweep.failed = True
+            return
+        # the output of the setup chunks doesn't depend on the parameters, so the recording of
+        # this document is used for all others
+        sweep.messages = dict((index, chunks[index].messages) for index in sweep.setup)
+        sweep.server = server
+        self.log.info("Ran %s setup chunk(s) in the template process for forked kernels.",
+                      len(sweep.setup))
+
+    def _fork_sweep_kernel(self, chunks, context):
+        """Uses a kernel forked from the template process of the parameter sweep
+
+        returns list
+            the indices of the setup chunks, their recorded output is already set
+        """
+        sweep = self._sweep
+        if sweep.server is None:
+            return []
+        engine = sweep.engine
+        try:
+            kernel = self._pool.adopt(sweep.server.fork(engine.kernel_name))
+        except (RuntimeError, OSError) as e:
+            self.log.warn("Could not fork a kernel (%s). Running the whole document...", e)
+            sweep.server.shutdown()
+            sweep.server = None
+            sweep.failed = True
+            return []
+        self._kernels[self._kernel_key(engine)] = kernel
+        # the startup lines and the plotting setup ran in the template process, only the
+        # parameters are new
+        context.enabled_documents.append(engine.name)
+        params_code = engine.get_params_code(self._params or {})
+        if params_code is not None:
+            self._run_silently(kernel.client, params_code)
+        for index in sweep.setup:
+            chunks[index].messages = list(sweep.messages[index])
+        return sweep.setup
 
     def _ensure_valid_output(self, fmt_name):
         if fmt_name in self._outputs:
             return
         raise KnitpyException("Format '%s' is not a valid output format!" % fmt_name)
 
+class ChunkRecording(object):
+    """The recorded execution of a code chunk or of inline code
+
+    All kernel messages are kept in the same order as they were received, so that the chunk
+    can be written into more than one output document without executing the code again.
+    """
+
+    def __init__(self, code, mode, engine, args):
+        self.code = code
+        self.mode = mode
+        self.engine = engine
+        # the parsed chunk options, which are interpreted when the chunk is replayed
+        self.args = args
+        # False if the chunk was not executed (eval=False)
+        self.evaluated = True
+        # the names the code defines and reads (see knitpy.dependencies.CodeNames) or None
+        self.names = None
+        # indices (in the list of all chunks of the document) of the chunks this chunk depends on
+        self.dependencies = []
+        # the part of the dependencies which was given in the `dependson` option
+        self.declared_dependencies = []
+        # the dependencies which run in the kernels of other engines
+        self.foreign_dependencies = []
+        # the lane (kernel) which runs the chunk, if the chunks run in more than one kernel of
+        # the engine (see Knitpy.parallel_kernels)
+        self.lane = 0
+        # indices of the chunks from other lanes, whose results are needed by this chunk
+        self.transfers = []
+        # True if other lanes need the results of this chunk
+        self.exported = False
+        self.cache_key = ""
+        # True if the code didn't finish in time
+        self.timed_out = False
+        # the saved objects if the results came from the cache
+        self.cached_objects = None
+        self.messages = []
+
+
+class _ChunkScheduler(object):
+    """Keeps track of the executed chunks, when the chunks of the kernels run concurrently"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._finished = set()
+        # index -> saved objects of chunks, which are needed in other lanes (or None)
+        self.objects = {}
+        # the exception which stopped one of the threads
+        self.error = None
+
+    def wait_for(self, indices):
+        """Waits until all chunks with the given indices are executed
+
+        returns bool
+            False if the execution was aborted
+        """
+        with self._condition:
+            while (self.error is None) and not self._finished.issuperset(indices):
+                self._condition.wait(0.5)
+            return self.error is None
+
+    def finished(self, index):
+        with self._condition:
+            self._finished.add(index)
+            self._condition.notify_all()
+
+    def abort(self, error):
+        with self._condition:
+            if self.error is None:
+                self.error = error
+            self._condition.notify_all()
+
+
+class _ParameterSweep(object):
+    """The state of a :meth:`Knitpy.render_sweep`"""
+
+    def __init__(self):
+        # the engine and the indices of the chunks which run in the template process (see
+        # Knitpy._find_setup_chunks()), None until the first document was executed
+        self.engine = None
+        self.setup = None
+        # index -> recorded messages of the setup chunks
+        self.messages = {}
+        # the template process or None
+        self.server = None
+        # True if kernels can't be forked for this document
+        self.failed = False
+
+
 class ExecutionContext(LoggingConfigurable):
 
     # These first are valid for the time of the existance of this contex
     output = Instance(klass=TemporaryOutputDocument, allow_none=True, config=False,
                             help="current output document")
 
+    image_formats = List([], config=False, help="Image formats which should be enabled in the "
+                                                "kernels.")
+
+    chunk = Instance(klass=ChunkRecording, allow_none=True, config=False,
+                     help="the recording of the currently executed chunk")
+
+    cache = Instance(klass=ChunkCache, allow_none=True, config=False,
+                     help="the cache for chunks with 'cache=True'")
+
+    pending_objects = List([], config=False,
+                           help="(engine name, objects) of cached chunks, which still have to be "
+                                "restored in the kernel")
+
+    document_deadline = Float(None, allow_none=True, config=False,
+                              help="time (see time.time()) at which all code has to be finished")
+
+    timeout = Integer(None, allow_none=True, config=False,
+                      help="the timeout for the code of the current chunk (None: no limit)")
+
+    deadline = Float(None, allow_none=True, config=False,
+                     help="time at which the code of the current chunk has to be finished")
+
+    deadline_message = Unicode("", config=False,
+                               help="recorded if the code runs longer than the deadline")
+
+    cache_helpers = List([], config=False,
+                         help="Names of engines, which have the cache helpers defined.")
+
     chunk_number = Integer(0, config=False, allow_none=False, help="current chunk number")
     def _chunk_number_changed(self, name, old, new):
         if old != new:
@@ -849,13 +2226,17 @@ class ExecutionContext(LoggingConfigurable):
     def __init__(self, output, **kwargs):
         super(ExecutionContext,self).__init__(**kwargs)
         self.output = output
-        output.context = self
+        # output is None while executing the code, the results are only written to the output
+        # document when the recording is replayed
+        if output is not None:
+            output.context = self
 
     def execution_started(self):
         self.chunk_number += 1
 
     def execution_finished(self):
-        self.output.flush()
+        if self.output is not None:
+            self.output.flush()
         reset_needed = ["engine", "mode"
                         "chunk_label", "comment",
                         "include", "echo",  "include", "results"]
@@ -20,17 +20,24 @@ import os
 import logging
 import glob
 import sys
+import traceback
+import multiprocessing
+import yaml
+from multiprocessing.util import Finalize
 
 # TODO: fix IPython useage...
 from jupyter_core.application import JupyterApp, base_aliases, base_flags
 from traitlets.config import catch_config_error
 from traitlets import (
-    Unicode, List, Bool, Type, CaselessStrEnum,
+    Unicode, List, Bool, Type, CaselessStrEnum, Integer,
 )
 
 
 from .documents import TemporaryOutputDocument
 from .knitpy import DEFAULT_OUTPUT_FORMAT_NAME, VALID_OUTPUT_FORMAT_NAMES, Knitpy, ParseException
+from .kernels import KernelPool
+from .cache import ChunkCache, MarkupCache
+from .pandocserver import PandocServer
 from .utils import get_by_name
 
 #-----------------------------------------------------------------------------
@@ -46,6 +53,10 @@ knitpy_aliases.update({
     'keep-md': 'Knitpy.keep_md',
     'kernel-debug': 'Knitpy.kernel_debug',
     'timeout' : 'Knitpy.timeout',
+    'kernel-pool-size': 'KernelPool.size',
+    'j': 'KnitpyApp.jobs',
+    'jobs': 'KnitpyApp.jobs',
+    'params-file': 'KnitpyApp.params_file',
     'output-debug': 'TemporaryOutputDocument.output_debug',
 })
 
@@ -65,6 +76,14 @@ knitpy_flags.update({
          "KnitpyApp":{"log_level":logging.DEBUG}},
         "send kernel messages to debug log (implies log-level=DEBUG)"
     ),
+    'batch-execution' : (
+        {'Knitpy' : {'batch_execution' : True}},
+        "send all statements of a code chunk to the kernel in one execute request"
+    ),
+    'stream-to-file' : (
+        {'TemporaryOutputDocument' : {'stream_to_file' : True}},
+        "write the temporary markdown to a file instead of keeping it in memory"
+    ),
     'output-debug' : (
         {'TemporaryOutputDocument': {'output_debug': True},
          "KnitpyApp":{"log_level":logging.DEBUG}},
@@ -85,7 +104,8 @@ class KnitpyApp(JupyterApp):
         return logging.INFO
 
     def _classes_default(self):
-        classes = [KnitpyApp, Knitpy, TemporaryOutputDocument, ProfileDir]
+        classes = [KnitpyApp, Knitpy, KernelPool, ChunkCache, MarkupCache,
+                   PandocServer, TemporaryOutputDocument, ProfileDir]
         # TODO: engines should be added here
         return classes
 
@@ -143,6 +163,14 @@ class KnitpyApp(JupyterApp):
     log_to_file = Bool(False, config=True,
         help="""Whether to send the log to a file""")
 
+    jobs = Integer(1, config=True,
+        help="""Number of documents which are converted at the same time. Each document is
+                converted in a worker process with its own kernels.""")
+
+    params_file = Unicode(u"", config=True,
+        help="""A yaml file with a list of parameter sets. Each document is converted once for
+                each parameter set (see `Knitpy.render_sweep()`).""")
+
     @catch_config_error
     def initialize(self, argv=None):
         super(KnitpyApp, self).initialize(argv) # sets the crash handler
@@ -190,34 +218,129 @@ class KnitpyApp(JupyterApp):
         """
         Convert the documents in the self.document traitlet
         """
-        # Export each documents
-        conversion_success = 0
-
-        kp = Knitpy(log=self.log, parent=self)
+        # If nothing should be converted, help the user.
+        if not self.documents:
+            self.print_help()
+            sys.exit(-1)
 
+        # Documents which write to the same output files (e.g. `report.pymd` and `report.md` in
+        # the same directory) are converted one after the other in the same worker
+        groups = []
+        group_by_output = {}
         for document_filename in self.documents:
-
+            output_stem = os.path.splitext(os.path.abspath(document_filename))[0]
+            if output_stem in group_by_output:
+                self.log.warn("'%s' writes to the same output files as '%s'.", document_filename,
+                              group_by_output[output_stem][0])
+                group_by_output[output_stem].append(document_filename)
+            else:
+                group_by_output[output_stem] = [document_filename]
+                groups.append(group_by_output[output_stem])
+
+        param_sets = None
+        if self.params_file:
+            with open(self.params_file) as f:
+                param_sets = yaml.safe_load(f)
+            if not isinstance(param_sets, list) or \
+                    not all(isinstance(params, dict) for params in param_sets):
+                self.log.error("'%s' must contain a list of parameter sets.", self.params_file)
+                sys.exit(-1)
+
+        jobs = min(self.jobs, len(groups))
+        if jobs > 1:
+            self.log.info("Converting %s documents with %s workers.", len(self.documents), jobs)
+            results = []
+            pool = multiprocessing.Pool(processes=jobs, initializer=_init_worker,
+                                        initargs=(self.config, self.log_level))
             try:
-                outfilenames = kp.render(document_filename, output=self.export_format)
-            except ParseException as pe:
-                self.log.error(str(pe))
-                self.log.error("Error while converting '%s'. Aborting...", document_filename)
-                exit(1)
-
-            except Exception as e:
-                self.log.error("Error while converting '%s'", document_filename, exc_info=True)
-                exit(1)
-
+                for group_results in pool.imap_unordered(_convert_in_worker,
+                                                         [(group, self.export_format,
+                                                           param_sets)
+                                                          for group in groups]):
+                    results.extend(group_results)
+                pool.close()
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+        else:
+            kp = Knitpy(log=self.log, parent=self)
+            try:
+                results = [_convert_document(kp, document_filename, self.export_format,
+                                             param_sets)
+                           for group in groups for document_filename in group]
+            finally:
+                # the kernel pool might still have some kernels running
+                kp.shutdown_kernels()
+
+        failed = [(filename, error) for filename, outfilenames, error in results
+                  if error is not None]
+        for filename, outfilenames, error in results:
             #Todo: add a config value... auto-open
-            if self.export_format in ["html", "htm"]:
+            if error is None and self.export_format in ["html", "htm"]:
                 import webbrowser
                 webbrowser.open(outfilenames[0])
-            conversion_success += 1
 
-        # If nothing was converted successfully, help the user.
-        if conversion_success == 0:
-            self.print_help()
-            sys.exit(-1)
+        self.log.info("Converted %s of %s documents.", len(results) - len(failed), len(results))
+        if failed:
+            for filename, error in failed:
+                self.log.error("Failed: '%s': %s", filename, error)
+            sys.exit(1)
+
+
+def _convert_document(kp, document_filename, export_format, param_sets=None):
+    """Converts one document (once for each parameter set, if given)
+
+    returns (document_filename, output filenames, error message or None)
+    """
+    try:
+        if param_sets is not None:
+            outfilenames = kp.render_sweep(document_filename, param_sets, output=export_format)
+        else:
+            outfilenames = kp.render(document_filename, output=export_format)
+    except ParseException as pe:
+        kp.log.error(str(pe))
+        kp.log.error("Error while converting '%s'.", document_filename)
+        return (document_filename, None, str(pe))
+    except Exception as e:
+        kp.log.error("Error while converting '%s'", document_filename, exc_info=True)
+        return (document_filename, None, traceback.format_exception_only(type(e), e)[-1].strip())
+    return (document_filename, outfilenames, None)
+
+
+# The Knitpy instance of a worker process (`knitpy -j N`): it is used for all documents, which are
+# converted by the worker, so that kernels from the pool can be reused.
+_worker_knitpy = None
+_worker_init_error = None
+
+def _init_worker(config, log_level):
+    global _worker_knitpy, _worker_init_error
+    log = logging.getLogger("knitpy.worker-%s" % os.getpid())
+    log.setLevel(log_level)
+    log.propagate = False
+    if not log.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("[%(name)s] %(message)s"))
+        log.addHandler(handler)
+    try:
+        _worker_knitpy = Knitpy(config=config, log=log)
+    except Exception as e:
+        # raising here would only make the pool start new workers (which fail again) forever
+        log.error("Could not initialize the worker.", exc_info=True)
+        _worker_init_error = traceback.format_exception_only(type(e), e)[-1].strip()
+        return
+    # shutdown the kernels when the worker exits
+    Finalize(_worker_knitpy, _worker_knitpy.shutdown_kernels, exitpriority=10)
+
+
+def _convert_in_worker(args):
+    document_filenames, export_format, param_sets = args
+    if _worker_knitpy is None:
+        return [(document_filename, None, _worker_init_error)
+                for document_filename in document_filenames]
+    return [_convert_document(_worker_knitpy, document_filename, export_format, param_sets)
+            for document_filename in document_filenames]
 
 
 # redefine the error message on crashes
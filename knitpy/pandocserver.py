@@ -0,0 +1,177 @@
+# encoding: utf-8
+"""
+Conversions with one `pandoc server` process instead of one pandoc process per conversion.
+
+The server is started on first use, listens on a free port of the loopback interface and is
+stopped when knitpy exits. If the pandoc build has no server mode (pandoc < 3 or built without
+it) or the server dies, :class:`PandocServerUnavailable` is raised and the caller converts with a
+pandoc subprocess instead.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import atexit
+import json
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+from traitlets.config.configurable import LoggingConfigurable
+from traitlets import Integer, Unicode
+
+from .py3compat import cast_bytes, cast_unicode
+
+
+class PandocServerUnavailable(Exception):
+    """The conversion has to be done without the server"""
+    pass
+
+
+class PandocServer(LoggingConfigurable):
+    """A `pandoc server` process, which is shared by all conversions of a knitpy process
+
+    The server has no access to files, so it is only used for conversions of text (see
+    `TemporaryOutputDocument.add_markup_text()`).
+    """
+
+    executable = Unicode("pandoc", config=True,
+        help="""The pandoc executable, which is started as `<executable> server`.""")
+
+    timeout = Integer(60, config=True,
+        help="""Time (in seconds) the server may take for a conversion.""")
+
+    startup_timeout = Integer(10, config=True,
+        help="""Time (in seconds) the server may take to start. If it doesn't answer by then,
+                the conversions are done with pandoc subprocesses.""")
+
+    def __init__(self, **kwargs):
+        super(PandocServer, self).__init__(**kwargs)
+        self._process = None
+        self._url = None
+        # False once the server could not be started (or died): no further tries
+        self._available = True
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return self._available
+
+    def convert(self, source, to, format):
+        """Converts the source (text) and returns the converted text
+
+        Raises RuntimeError if pandoc can't convert the source (like pypandoc) and
+        PandocServerUnavailable if the server can't be used.
+        """
+        url = self._ensure_started()
+        request = {"text": source, "from": format, "to": to}
+        data = cast_bytes(json.dumps(request), "utf-8")
+        headers = {"Content-Type": "application/json", "Accept": "application/json"}
+        try:
+            response = urlopen(Request(url, data, headers), timeout=self.timeout + 5)
+            result = json.loads(cast_unicode(response.read(), "utf-8"))
+        except HTTPError as e:
+            # pandoc could not convert the source
+            raise RuntimeError("pandoc server: %s" % cast_unicode(e.read(), "utf-8").strip())
+        except (URLError, socket.error, ValueError) as e:
+            self.log.warn("The pandoc server failed (%s), using pandoc subprocesses instead.", e)
+            self._give_up()
+            raise PandocServerUnavailable(str(e))
+        if isinstance(result, dict) and ("error" in result) and not "output" in result:
+            raise RuntimeError("pandoc server: %s" % result["error"])
+        if isinstance(result, dict):
+            for message in result.get("messages") or []:
+                self.log.debug("pandoc server: %s", message)
+            return result["output"]
+        return result
+
+    def _ensure_started(self):
+        """Starts the server (if not yet done) and returns its url"""
+        with self._lock:
+            if not self._available:
+                raise PandocServerUnavailable("The pandoc server could not be started.")
+            if (self._process is not None) and (self._process.poll() is None):
+                return self._url
+            if self._process is not None:
+                self.log.warn("The pandoc server died, using pandoc subprocesses instead.")
+                self._give_up()
+                raise PandocServerUnavailable("The pandoc server died.")
+            self._start()
+            return self._url
+
+    def _start(self):
+        port = _free_port()
+        args = [self.executable, "server", "--port", str(port), "--timeout", str(self.timeout)]
+        self.log.debug("Starting the pandoc server: %s", " ".join(args))
+        # not a pipe: nobody reads the output of a running server, so a pipe could fill up
+        output = tempfile.TemporaryFile()
+        try:
+            self._process = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=output,
+                                             stderr=subprocess.STDOUT)
+        except OSError as e:
+            output.close()
+            self.log.info("Could not start the pandoc server (%s), using pandoc subprocesses.", e)
+            self._available = False
+            raise PandocServerUnavailable(str(e))
+        atexit.register(self.shutdown)
+        url = "http://127.0.0.1:%s/" % port
+        deadline = time.time() + self.startup_timeout
+        while time.time() < deadline:
+            if self._process.poll() is not None:
+                # e.g. a pandoc without server mode
+                output.seek(0)
+                message = cast_unicode(output.read(), "utf-8").strip()
+                output.close()
+                self.log.info("pandoc has no server mode (%s), using pandoc subprocesses.",
+                              message.split("\n")[0])
+                self._give_up()
+                raise PandocServerUnavailable(message)
+            try:
+                urlopen(url + "version", timeout=1).read()
+            except (URLError, socket.error):
+                time.sleep(0.05)
+                continue
+            output.close()
+            self._url = url
+            self.log.info("Started the pandoc server on %s.", url)
+            return
+        output.close()
+        self.log.warn("The pandoc server did not start in time, using pandoc subprocesses.")
+        self._give_up()
+        raise PandocServerUnavailable("The pandoc server did not start in time.")
+
+    def _give_up(self):
+        self._available = False
+        self.shutdown()
+
+    def shutdown(self):
+        """Stops the server (if it runs)"""
+        process, self._process = self._process, None
+        self._url = None
+        if (process is None) or (process.poll() is not None):
+            return
+        process.terminate()
+        try:
+            process.wait()
+        except OSError:
+            pass
+
+
+def _free_port():
+    """Returns a port on the loopback interface, which is free right now"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
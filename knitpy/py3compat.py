@@ -162,6 +162,7 @@ if sys.version_info[0] >= 3:
     buffer_to_bytes_py2 = no_code
     
     string_types = (str,)
+    integer_types = (int,)
     unicode_type = str
     
     which = shutil.which
@@ -230,6 +231,7 @@ else:
     buffer_to_bytes_py2 = buffer_to_bytes
     
     string_types = (str, unicode)
+    integer_types = (int, long)
     unicode_type = unicode
     
     import re
@@ -0,0 +1,174 @@
+# encoding: utf-8
+"""
+A shell "kernel": a shell subprocess which runs the code of shell chunks.
+
+One shell process is used for all chunks of a document, so state like the working directory
+(`cd`) or environment variables is kept between chunks. The code of a chunk is written to a
+temporary file and sourced by the shell. Its output is sent as stream messages while it runs.
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import codecs
+import os
+import signal
+import subprocess
+import tempfile
+import threading
+import uuid
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+from .inprocess import LocalKernelManager
+
+# kernel names of shell kernels are this prefix plus the shell executable (see `KernelPool`)
+SHELL_KERNEL_PREFIX = "knitpy-shell:"
+
+
+class ShellKernelManager(LocalKernelManager):
+    """Runs the code of shell chunks in a shell subprocess
+
+    shell : string
+        the shell executable (e.g. "bash")
+    """
+
+    kernel_id_prefix = "shell"
+
+    def __init__(self, shell, log=None):
+        super(ShellKernelManager, self).__init__(log=log)
+        self.shell = shell
+        self._process = None
+        # written by the shell after the code of a request is done
+        self._marker = "@@knitpy-done-%s@@" % uuid.uuid4().hex
+        # stream name -> event which is set when the marker was read from that stream
+        self._done = {}
+        self._exit_status = None
+
+    def _setup(self):
+        # in its own session like jupyter kernels, so that an interrupt only reaches the shell
+        # and its children
+        preexec_fn = os.setsid if hasattr(os, "setsid") else None
+        self._process = subprocess.Popen([self.shell], stdin=subprocess.PIPE,
+                                         stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                         preexec_fn=preexec_fn)
+        for name, pipe in (("stdout", self._process.stdout), ("stderr", self._process.stderr)):
+            self._done[name] = threading.Event()
+            reader = threading.Thread(target=self._read_output, args=(name, pipe),
+                                      name="%s-%s" % (self.kernel_id, name))
+            reader.daemon = True
+            reader.start()
+
+    def is_alive(self):
+        return super(ShellKernelManager, self).is_alive() and (self._process is not None) and \
+               (self._process.poll() is None)
+
+    def interrupt_kernel(self):
+        if not self.is_alive():
+            return
+        if hasattr(os, "killpg"):
+            os.killpg(self._process.pid, signal.SIGINT)
+        else:
+            self._process.send_signal(signal.SIGINT)
+
+    def shutdown_kernel(self, now=False):
+        if self._process is not None:
+            if self._process.poll() is None:
+                if now:
+                    self._process.kill()
+                else:
+                    # the shell exits at the end of its input
+                    try:
+                        self._process.stdin.close()
+                    except (IOError, OSError):
+                        pass
+                    self._process.terminate()
+            self._process.wait()
+        super(ShellKernelManager, self).shutdown_kernel(now=now)
+
+    def _read_output(self, name, pipe):
+        """Sends the output of the shell as stream messages, until the pipe is closed"""
+        decoder = codecs.getincrementaldecoder("utf-8")("replace")
+        fd = pipe.fileno()
+        text = ""
+        while True:
+            data = os.read(fd, 65536)
+            text += decoder.decode(data, final=not data)
+            while True:
+                pos = text.find(self._marker)
+                end = text.find("\n", pos) if pos >= 0 else -1
+                if end < 0:
+                    break
+                self._send_output(name, text[:pos])
+                if name == "stdout":
+                    self._exit_status = text[pos + len(self._marker):end].strip()
+                text = text[end + 1:]
+                self._done[name].set()
+            if pos < 0:
+                # keep what could be the start of the next marker
+                pos = len(text)
+                for length in range(min(len(self._marker) - 1, len(text)), 0, -1):
+                    if text.endswith(self._marker[:length]):
+                        pos = len(text) - length
+                        break
+            self._send_output(name, text[:pos])
+            text = text[pos:]
+            if not data:
+                break
+        self._send_output(name, text)
+        # the shell died: nothing waits for the marker anymore
+        self._done[name].set()
+
+    def _send_output(self, name, text):
+        if text:
+            self.send_iopub("stream", {"name": name, "text": text})
+
+    def _handle_request(self, msg_type, content):
+        if msg_type == "is_complete":
+            # the whole chunk is run at once
+            return {"status": "complete", "indent": ""}
+        elif msg_type != "execute":
+            return None
+        reply = {"status": "ok", "execution_count": 0, "user_expressions": {}, "payload": []}
+        code = content["code"]
+        if not code.strip():
+            return reply
+        if not content["silent"]:
+            self.send_iopub("execute_input", {"code": code, "execution_count": 0})
+
+        fd, filename = tempfile.mkstemp(suffix=".sh", prefix="knitpy-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(code.encode("utf-8"))
+            for done in self._done.values():
+                done.clear()
+            self._exit_status = None
+            # an interrupt stops the sourced file, the shell keeps running; the code must not
+            # read the next commands from stdin
+            command = "trap 'return 130 2>/dev/null' INT; . %s </dev/null; " \
+                      "_knitpy_status=$?; trap - INT; " \
+                      "printf '%%s %%s\\n' '%s' \"$_knitpy_status\"; " \
+                      "printf '%%s\\n' '%s' >&2\n" % (shell_quote(filename), self._marker,
+                                                      self._marker)
+            try:
+                self._process.stdin.write(command.encode("utf-8"))
+                self._process.stdin.flush()
+            except (IOError, OSError):
+                # the shell died, the dispatcher notices that
+                return reply
+            for done in self._done.values():
+                done.wait()
+        finally:
+            os.remove(filename)
+
+        if self._exit_status not in (None, "0"):
+            message = "The shell code exited with status %s." % self._exit_status
+            self.send_iopub("error", {"ename": "ShellError", "evalue": message, "traceback": []})
+            reply.update({"status": "error", "ename": "ShellError", "evalue": message,
+                          "traceback": []})
+        return reply
@@ -0,0 +1,236 @@
+# encoding: utf-8
+"""
+A sql "kernel": runs the statements of sql chunks on SQLite (or DuckDB) databases.
+
+The connections are opened on first use and kept for the whole document (one per connection
+string), so e.g. temporary tables or an in-memory database survive between chunks. The rows of a
+query are written into a markdown pipe table while they are fetched, without going through
+pandas, html or pandoc.
+
+The options of a chunk are passed in a first line `-- knitpy: <json>` (see
+`SqlKnitpyEngine.get_chunk_code()`).
+"""
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import sqlite3
+
+from .htmltables import _escape
+from .inprocess import LocalKernelManager
+from .py3compat import unicode_type, string_types, integer_types
+
+# the kernel name of sql kernels (see `KernelPool`)
+SQL_KERNEL_NAME = "knitpy-sql"
+
+# the first line of the code, which holds the chunk options
+OPTIONS_PREFIX = "-- knitpy: "
+
+# python types which are kept in results (everything else is converted to a string), so that
+# the results can be passed on as python literal
+_LITERAL_TYPES = (bool, float, bytes, type(None)) + integer_types + string_types
+
+
+def split_sql(code):
+    """Splits sql code into statements (at `;` which are not in strings or comments)"""
+    statements = []
+    start = 0
+    pos = 0
+    quote = None
+    while pos < len(code):
+        char = code[pos]
+        if quote is not None:
+            if char == quote:
+                quote = None
+        elif char in "'\"`":
+            quote = char
+        elif code.startswith("--", pos):
+            end = code.find("\n", pos)
+            pos = len(code) if end < 0 else end
+            continue
+        elif code.startswith("/*", pos):
+            end = code.find("*/", pos + 2)
+            pos = len(code) if end < 0 else end + 2
+            continue
+        elif char == ";":
+            statements.append(code[start:pos])
+            start = pos + 1
+        pos += 1
+    statements.append(code[start:])
+    return [statement.strip() for statement in statements if _has_code(statement)]
+
+
+def _has_code(statement):
+    for line in statement.split("\n"):
+        line = line.strip()
+        if line and not line.startswith("--"):
+            return True
+    return False
+
+
+def _parse_connection(connection_string):
+    """Returns (driver, path) of a connection string like `sqlite:///file.db`"""
+    for driver in ("sqlite", "duckdb"):
+        for prefix in (driver + ":///", driver + "://"):
+            if connection_string.startswith(prefix):
+                return driver, connection_string[len(prefix):] or ":memory:"
+    if connection_string.endswith(".duckdb"):
+        return "duckdb", connection_string
+    return "sqlite", connection_string
+
+
+def _cell(value):
+    if value is None:
+        return "NULL"
+    if isinstance(value, bytes):
+        return "<%s bytes>" % len(value)
+    # like the cells of html tables (see knitpy.htmltables)
+    return _escape(unicode_type(value)).replace("\r", "").replace("\n", " ")
+
+
+def _is_number(value):
+    return isinstance(value, integer_types + (float,)) and not isinstance(value, bool)
+
+
+def _literal(value):
+    return value if isinstance(value, _LITERAL_TYPES) else unicode_type(value)
+
+
+class SqlKernelManager(LocalKernelManager):
+    """Runs the statements of sql chunks in a thread of the knitpy process"""
+
+    kernel_id_prefix = "sql"
+
+    def __init__(self, log=None):
+        super(SqlKernelManager, self).__init__(log=log)
+        # connection string -> connection
+        self._connections = {}
+        # output_var -> (columns, rows) of the last query of the chunk with that `output_var`
+        self._results = {}
+
+    def interrupt_kernel(self):
+        # the running query stops with an OperationalError
+        for connection in list(self._connections.values()):
+            connection.interrupt()
+
+    def _teardown(self):
+        # sqlite connections can only be closed in the thread which opened them
+        connections, self._connections = self._connections, {}
+        self._results = {}
+        for connection_string, connection in connections.items():
+            try:
+                connection.close()
+            except Exception as e:
+                if self.log is not None:
+                    self.log.warn("Could not close the sql connection '%s': %s",
+                                  connection_string, e)
+
+    def _connect(self, connection_string):
+        """Returns the (pooled) connection for the connection string
+
+        `duckdb:///file` and files ending in `.duckdb` are opened with duckdb (if installed),
+        everything else (`sqlite:///file`, a plain file name or `:memory:`) with sqlite3.
+        """
+        connection = self._connections.get(connection_string)
+        if connection is not None:
+            return connection
+        driver, path = _parse_connection(connection_string)
+        if driver == "duckdb":
+            try:
+                import duckdb
+            except ImportError:
+                raise RuntimeError("duckdb is needed for the connection '%s'." %
+                                   connection_string)
+            connection = duckdb.connect(path)
+        else:
+            # no implicit transactions: every statement is committed
+            connection = sqlite3.connect(path, isolation_level=None)
+        self._connections[connection_string] = connection
+        return connection
+
+    def _handle_request(self, msg_type, content):
+        if msg_type == "is_complete":
+            return {"status": "complete", "indent": ""}
+        elif msg_type != "execute":
+            return None
+        code = content["code"]
+        options = {}
+        if code.startswith(OPTIONS_PREFIX):
+            header, _, code = code.partition("\n")
+            options = json.loads(header[len(OPTIONS_PREFIX):])
+        reply = {"status": "ok", "execution_count": 0, "user_expressions": {}, "payload": []}
+        if not content["silent"]:
+            self.send_iopub("execute_input", {"code": code, "execution_count": 0})
+        try:
+            statements = split_sql(code)
+            if statements:
+                self._results.pop(options.get("output_var"), None)
+                connection = self._connect(options.get("connection", ":memory:"))
+            for statement in statements:
+                self._run_statement(connection, statement, options)
+        except Exception as e:
+            error = {"ename": type(e).__name__, "evalue": "%s" % e, "traceback": []}
+            self.send_iopub("error", error)
+            reply["status"] = "error"
+            reply.update(error)
+        for name, expression in content.get("user_expressions", {}).items():
+            if expression.startswith("result:"):
+                reply["user_expressions"][name] = {
+                    "status": "ok", "metadata": {},
+                    "data": {"text/plain": repr(self._results.get(expression[len("result:"):]))}}
+            else:
+                reply["user_expressions"][name] = {
+                    "status": "error", "ename": "ValueError", "traceback": [],
+                    "evalue": "Unknown expression: %s" % expression}
+        return reply
+
+    def _run_statement(self, connection, statement, options):
+        cursor = connection.cursor()
+        try:
+            cursor.execute(statement)
+            if cursor.description is None:
+                # no query
+                return
+            columns = [description[0] for description in cursor.description]
+            if options.get("output_var"):
+                # bound to a variable in another kernel instead of shown
+                rows = [tuple(_literal(value) for value in row) for row in cursor.fetchall()]
+                self._results[options["output_var"]] = (columns, rows)
+                return
+            self._send_table(cursor, columns, int(options.get("max_rows", 20)))
+        finally:
+            cursor.close()
+
+    def _send_table(self, cursor, columns, max_rows):
+        """Writes the rows of the query into a markdown pipe table, up to `max_rows` rows"""
+        lines = []
+        # the first value of a column, which is not NULL, decides its alignment: numbers are
+        # right aligned
+        alignments = [None] * len(columns)
+        shown = 0
+        more = False
+        # one more row than shown, to know whether there are more
+        batch_size = min(max_rows + 1, 1000) if max_rows > 0 else 1000
+        while not more:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                if (max_rows > 0) and (shown >= max_rows):
+                    more = True
+                    break
+                for column, value in enumerate(row):
+                    if (alignments[column] is None) and (value is not None):
+                        alignments[column] = "---:" if _is_number(value) else "---"
+                lines.append("| " + " | ".join(_cell(value) for value in row) + " |")
+                shown += 1
+        header = ["| " + " | ".join(_cell(column) for column in columns) + " |",
+                  "|" + "|".join(alignment or "---" for alignment in alignments) + "|"]
+        table = "\n".join(header + lines) + "\n"
+        if more:
+            table += "\nOnly the first %s rows are shown.\n" % max_rows
+        self.send_iopub("display_data", {"data": {"text/markdown": table, "text/plain": table},
+                                         "metadata": {}, "transient": {}})
@@ -57,6 +57,8 @@ def _add_test_cases(cls, foldername):
 class AbstractOutputTestCase(unittest.TestCase):
     #<ipython-input-2-fb4ced135814>
     _re_ipython_id = re.compile(r"<ipython-input-[0-9]+-[a-z0-9]+>")
+    # Cell In[3], line 1 (IPython >= 8): the execution count depends on how the code was run
+    _re_cell_id = re.compile(r"Cell In ?\[[0-9]+\]")
 
     def setUp(self):
         self.maxDiff = None
@@ -98,6 +100,8 @@ class AbstractOutputTestCase(unittest.TestCase):
         received = received.replace(os.linesep, "\n").rstrip('\n')
         # in errors, there is a unique id like  <ipython-input-2-fb4ced135814>
         received = self._re_ipython_id.sub("<ipython-input>", received)
+        expected = self._re_cell_id.sub("Cell In[]", expected)
+        received = self._re_cell_id.sub("Cell In[]", received)
         # this is a hardcoded fix for py3, where there are quotes around the module:
         received = received.replace("'NoneExistingModule'", "NoneExistingModule")
 
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import logging
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import zlib
+
+from pypandoc import get_pandoc_version
+
+from knitpy.cache import DiskStore, ChunkCache, MarkupCache
+
+
+def _has_pandoc():
+    try:
+        get_pandoc_version()
+        return True
+    except Exception:
+        return False
+
+
+class DiskStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.log = logging.getLogger("knitpy-test")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_put_get(self):
+        store = DiskStore(self.directory, 0, self.log)
+        store.put("key", b"data")
+        self.assertEqual(store.get("key"), b"data")
+        self.assertIsNone(store.get("other"))
+
+    def test_evict(self):
+        # room for one entry
+        size = len(zlib.compress(b"data"))
+        store = DiskStore(self.directory, size + size // 2, self.log)
+        store.put("old", b"data")
+        past = time.time() - 100
+        os.utime(os.path.join(self.directory, "old"), (past, past))
+        # an entry, which another writer is still writing
+        tmp_filename = os.path.join(self.directory, "other.1234.tmp")
+        with open(tmp_filename, "wb") as f:
+            f.write(b"x" * 100)
+        store.put("new", b"data")
+        self.assertEqual(sorted(os.listdir(self.directory)), ["new", "other.1234.tmp"])
+
+
+class ChunkCacheTestCase(unittest.TestCase):
+
+    def test_unwritable_directory(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(directory, "file")
+            with open(filename, "w") as f:
+                f.write("not a directory")
+            cache = ChunkCache(filename)
+            # logs a warning instead of failing
+            cache.store("key", [], {})
+            self.assertIsNone(cache.load("key"))
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class MarkupCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_memory(self):
+        cache = MarkupCache(memory_entries=2)
+        cache.put("a", "A")
+        cache.put("b", "B")
+        # a is now used more recently than b
+        self.assertEqual(cache.get("a"), "A")
+        cache.put("c", "C")
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "A")
+        self.assertEqual(cache.get("c"), "C")
+
+    def test_no_memory(self):
+        cache = MarkupCache(memory_entries=0)
+        cache.put("a", "A")
+        self.assertIsNone(cache.get("a"))
+
+    def test_disk(self):
+        MarkupCache(memory_entries=0, directory=self.directory).put("a", "\u00e4")
+        # a later run
+        cache = MarkupCache(memory_entries=0, directory=self.directory)
+        self.assertEqual(cache.get("a"), "\u00e4")
+        self.assertIsNone(cache.get("b"))
+
+    def test_unwritable_directory(self):
+        filename = os.path.join(self.directory, "file")
+        with open(filename, "w") as f:
+            f.write("not a directory")
+        cache = MarkupCache(directory=filename)
+        # logs a warning, but still keeps the conversion in memory
+        cache.put("a", "A")
+        self.assertEqual(cache.get("a"), "A")
+
+    def test_none_key(self):
+        # the key of conversions without pandoc
+        cache = MarkupCache()
+        cache.put(None, "A")
+        self.assertIsNone(cache.get(None))
+
+    @unittest.skipUnless(_has_pandoc(), "needs pandoc")
+    def test_key(self):
+        cache = MarkupCache()
+        key = cache.key("<b>a</b>", "html", "markdown")
+        self.assertEqual(key, cache.key("<b>a</b>", "html", "markdown"))
+        self.assertNotEqual(key, cache.key("<b>b</b>", "html", "markdown"))
+        self.assertNotEqual(key, cache.key("<b>a</b>", "latex", "markdown"))
+        self.assertNotEqual(key, cache.key("<b>a</b>", "html", "html"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,8 +4,20 @@
 # Copyright (c) Jan Schulz <jasc@gmx.net>
 # Distributed under the terms of the Modified BSD License.
 
+import codecs
+import os
+import shutil
+import tempfile
 import unittest
 
+try:
+    import resource
+except ImportError:
+    resource = None
+from traitlets.config import Config
+
+from knitpy.knitpy import Knitpy, KnitpyException
+from knitpy.shellkernel import SHELL_KERNEL_PREFIX
 from knitpy.tests import AbstractOutputTestCase, _add_test_cases
 class OutputTestCase(AbstractOutputTestCase):
     pass
@@ -13,5 +25,215 @@ _add_test_cases(OutputTestCase, "basics")
 _add_test_cases(OutputTestCase, "chunk_options")
 
 
+class BatchOutputTestCase(AbstractOutputTestCase):
+    """Sends all statements of a chunk in one execute request (see Knitpy.batch_execution)"""
+
+    def setUp(self):
+        super(BatchOutputTestCase, self).setUp()
+        self.knitpy = Knitpy(batch_execution=True)
+
+    def test_same_output_as_single_requests(self):
+        # an error doesn't stop the statements after it
+        input = "```{python}\nprint('before')\n1/0\nprint('after')\n```\n"
+        expected = Knitpy()._knit(input, tempfile.gettempdir())
+        received = self.knitpy._knit(input, tempfile.gettempdir())
+        self.assertIn("after", received)
+        self.assert_equal_output(expected, received)
+_add_test_cases(BatchOutputTestCase, "batch_execution")
+
+
+class ParallelOutputTestCase(AbstractOutputTestCase):
+    """Runs independent chunks in two kernels (see Knitpy.parallel_kernels)"""
+
+    def setUp(self):
+        super(ParallelOutputTestCase, self).setUp()
+        self.knitpy = Knitpy(parallel_kernels=2)
+
+    def test_independent_chunks_in_different_kernels(self):
+        chunk = "```{python}\nimport os\nprint(os.getpid())\n```\n\n"
+        output = self.knitpy._knit(chunk + chunk, tempfile.gettempdir())
+        pids = [line for line in output.split("\n") if line.startswith("## ")]
+        self.assertEqual(len(pids), 2)
+        self.assertNotEqual(pids[0], pids[1])
+_add_test_cases(ParallelOutputTestCase, "basics")
+_add_test_cases(ParallelOutputTestCase, "parallel")
+
+
+class KernelPoolOutputTestCase(AbstractOutputTestCase):
+    """Renders more than one document with the kernels of a pool (see KernelPool.size)"""
+
+    def setUp(self):
+        super(KernelPoolOutputTestCase, self).setUp()
+        self.knitpy = Knitpy(config=Config({"KernelPool": {"size": 1}}))
+
+    def tearDown(self):
+        self.knitpy.shutdown_kernels()
+
+    def test_reused_kernel_is_clean(self):
+        first = self.knitpy._knit("```{python}\nx = 1\nprint(x)\n```\n",
+                                  tempfile.gettempdir())
+        self.assertIn("## 1", first)
+        kernel = self.knitpy._pool._idle["python"][0]
+        second = self.knitpy._knit("```{python}\nprint('x' in dir())\n```\n",
+                                   tempfile.gettempdir())
+        self.assertIn("## False", second)
+        self.assertIs(self.knitpy._pool._idle["python"][0], kernel)
+        self.assertEqual(kernel.uses, 2)
+
+    def test_same_output_in_reused_kernel(self):
+        tests_dir = os.path.join(os.path.dirname(__file__), "basics")
+        for name in ("statements", "loops", "statements"):
+            self._output_test(os.path.join(tests_dir, name + ".pymd"),
+                              os.path.join(tests_dir, name + ".md"))
+        self.assertEqual(self.knitpy._pool._idle["python"][0].uses, 3)
+
+
+class PrestartTestCase(AbstractOutputTestCase):
+    """Starts the kernels while the document is parsed (see Knitpy.prestart_kernels)"""
+
+    def _fixture(self, name):
+        tests_dir = os.path.dirname(__file__)
+        return (os.path.join(tests_dir, "basics", name + ".pymd"),
+                os.path.join(tests_dir, "basics", name + ".md"))
+
+    def test_prestarted_kernels_are_used(self):
+        kernel_names = {"loops": ["python"],
+                        "shell": [SHELL_KERNEL_PREFIX + "bash", SHELL_KERNEL_PREFIX + "sh"]}
+        for name in ("loops", "shell"):
+            self.knitpy = Knitpy()
+            input_file, output_file = self._fixture(name)
+            with codecs.open(input_file, 'r', 'UTF-8') as f:
+                self.knitpy.parse_document(f.read())
+            idle = self.knitpy._pool._idle
+            self.assertEqual(sorted(idle.keys()), kernel_names[name])
+            prestarted = [kernel for kernels in idle.values() for kernel in kernels]
+            self.assertEqual(len(prestarted), len(kernel_names[name]))
+            # parsing the document again doesn't start more kernels
+            self._output_test(input_file, output_file)
+            self.assertTrue(all(kernel.uses == 1 for kernel in prestarted))
+            self.assertFalse(any(kernel.manager.is_alive() for kernel in prestarted))
+
+    def test_without_prestart(self):
+        self.knitpy = Knitpy(prestart_kernels=False)
+        input_file, output_file = self._fixture("loops")
+        with codecs.open(input_file, 'r', 'UTF-8') as f:
+            self.knitpy.parse_document(f.read())
+        self.assertFalse(any(self.knitpy._pool._idle.values()))
+        self._output_test(input_file, output_file)
+
+
+class InProcessOutputTestCase(AbstractOutputTestCase):
+    """Runs the python code in the knitpy process (see PythonKnitpyEngine.in_process)"""
+
+    def setUp(self):
+        super(InProcessOutputTestCase, self).setUp()
+        self.knitpy = Knitpy(config=Config({"PythonKnitpyEngine": {"in_process": True}}))
+
+    def tearDown(self):
+        self.knitpy.shutdown_kernels()
+
+    def test_runs_in_this_process(self):
+        input = "```{python}\nimport os\nprint(os.getpid())\n```\n"
+        self.assertIn("## %s\n" % os.getpid(), self.knitpy._knit(input, tempfile.gettempdir()))
+
+    def test_metadata(self):
+        self.knitpy = Knitpy()
+        input = "```{python}\nimport os\nprint(os.getpid())\n```\n"
+        self.assertNotIn("## %s\n" % os.getpid(),
+                         self.knitpy._knit(input, tempfile.gettempdir()))
+        self.assertIn("## %s\n" % os.getpid(),
+                      self.knitpy._knit("---\nin_process: true\n---\n" + input,
+                                        tempfile.gettempdir()))
+_add_test_cases(InProcessOutputTestCase, "basics")
+
+
+class CacheTestCase(AbstractOutputTestCase):
+    """Renders documents with cached chunks more than once with the same cache directory"""
+
+    def setUp(self):
+        super(CacheTestCase, self).setUp()
+        self.outputdir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.outputdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.outputdir, ignore_errors=True)
+
+    def _read(self, name):
+        tests_dir = os.path.dirname(__file__)
+        with codecs.open(os.path.join(tests_dir, name), 'r', 'UTF-8') as f:
+            return f.read()
+
+    def _knit(self, input):
+        return self.knitpy._knit(input, self.outputdir, cache_dir=self.cache_dir)
+
+    def _entries(self):
+        return len(os.listdir(self.cache_dir))
+
+    def test_cache_rerender(self):
+        input = self._read(os.path.join("chunk_options", "cache.pymd"))
+        expected = self._read(os.path.join("chunk_options", "cache.md"))
+
+        # first run: the chunk is executed and stored
+        self.assert_equal_output(expected, self._knit(input))
+        self.assertEqual(self._entries(), 1)
+
+        # second run: the results (also of `x`, which the chunk changed in place) are restored
+        # from the cache
+        self.assert_equal_output(expected, self._knit(input))
+        self.assertEqual(self._entries(), 1)
+
+        # a changed chunk is executed again
+        changed = input.replace("x.append(1)", "x.append(2)")
+        self.assert_equal_output(expected.replace("x.append(1)", "x.append(2)")
+                                         .replace("## [1]", "## [2]"), self._knit(changed))
+        self.assertEqual(self._entries(), 2)
+
+    def test_upstream_change(self):
+        input = self._read(os.path.join("cache", "upstream.pymd"))
+        expected = self._read(os.path.join("cache", "upstream.md"))
+        self.assert_equal_output(expected, self._knit(input))
+        self.assert_equal_output(expected, self._knit(input))
+        self.assertEqual(self._entries(), 1)
+
+        # the cached chunk depends on the changed chunk, so it is executed again
+        changed = input.replace("x = 5", "x = 6")
+        expected = expected.replace("x = 5", "x = 6").replace("## 6", "## 7")
+        self.assert_equal_output(expected, self._knit(changed))
+        self.assertEqual(self._entries(), 2)
+
+    def test_no_cache_dir(self):
+        input = self._read(os.path.join("chunk_options", "cache.pymd"))
+        expected = self._read(os.path.join("chunk_options", "cache.md"))
+        self.assert_equal_output(expected, self.knitpy._knit(input, self.outputdir))
+        self.assertEqual(os.listdir(self.outputdir), [])
+
+
+class KernelRestartTestCase(AbstractOutputTestCase):
+    """Kernels, which die while running a chunk, are restarted (see Knitpy.max_kernel_restarts)"""
+
+    def test_too_many_restarts(self):
+        self.knitpy = Knitpy(max_kernel_restarts=0)
+        input = "```{python}\nimport os\nos._exit(1)\n```\n"
+        with self.assertRaises(KnitpyException):
+            self.knitpy._knit(input, tempfile.gettempdir())
+_add_test_cases(KernelRestartTestCase, "kernel_restart")
+
+
+@unittest.skipUnless(hasattr(resource, "prlimit"), "needs resource.prlimit (linux)")
+class LimitsTestCase(AbstractOutputTestCase):
+    """Resource limits of the kernels (see KernelPool.memory_limit and .cpu_time_limit)"""
+
+    def test_cpu_time_limit(self):
+        self.knitpy = Knitpy(config=Config({"KernelPool": {"cpu_time_limit": 1}}))
+        input = "```{python}\nx = 1\n```\n\n```{python}\nwhile True:\n    pass\n```\n\n" \
+                "```{python}\nprint(x)\n```\n"
+        output = self.knitpy._knit(input, tempfile.gettempdir())
+        self.assertIn("**ERROR**: The kernel was killed because it used more than its CPU time "
+                      "limit of 1 seconds.", output)
+        # the kernel was restarted
+        self.assertIn("## 1", output)
+_add_test_cases(LimitsTestCase, "limits")
+
+
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
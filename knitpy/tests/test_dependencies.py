@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import logging
+import unittest
+
+from knitpy.dependencies import analyse_python_code, find_dependencies
+
+
+class _Chunk(object):
+    """The part of a ChunkRecording which find_dependencies() uses"""
+
+    def __init__(self, code, args=None):
+        self.names = analyse_python_code(code)
+        self.args = args or {}
+        self.evaluated = True
+
+
+def _dependencies(*sources):
+    chunks = [_Chunk(source) for source in sources]
+    find_dependencies(chunks, logging.getLogger("knitpy-test"))
+    return [chunk.dependencies for chunk in chunks]
+
+
+class AnalyseCodeTestCase(unittest.TestCase):
+
+    def test_assignment(self):
+        names = analyse_python_code("y = x + 1\nz = y")
+        self.assertEqual(names.defines, set(["y", "z"]))
+        self.assertEqual(names.reads, set(["x"]))
+
+    def test_invalid_code(self):
+        self.assertIsNone(analyse_python_code("x = ("))
+
+    def test_class_body(self):
+        names = analyse_python_code("class A(Base):\n    x = 1\n    y = x + z\n"
+                                    "    def f(self):\n        return w\n")
+        self.assertEqual(names.defines, set(["A"]))
+        self.assertEqual(names.reads, set(["Base", "z"]))
+        self.assertEqual(names.deferred["A"][0], set(["w"]))
+
+    def test_comprehensions(self):
+        for code in ("zeros = [0 for x in range(3) if x > w]",
+                     "zeros = set(0 for x in range(3) if x > w)",
+                     "zeros = {0 for x in range(3) if x > w}",
+                     "zeros = {x: 0 for x in range(3) if x > w}"):
+            names = analyse_python_code(code)
+            self.assertEqual(names.defines, set(["zeros"]), code)
+            self.assertEqual(names.reads - set(["range", "set"]), set(["w"]), code)
+        # the first iterable is evaluated outside of the comprehension
+        names = analyse_python_code("y = [x for x in x]")
+        self.assertEqual(names.reads, set(["x"]))
+        names = analyse_python_code("y = [(a, b) for a in aa for b in a]")
+        self.assertEqual(names.reads, set(["aa"]))
+
+    def test_global_in_function(self):
+        names = analyse_python_code("def f():\n    global counter\n    counter = step\n"
+                                    "    local = 1\n")
+        self.assertEqual(names.defines, set(["f"]))
+        self.assertEqual(names.reads, set())
+        self.assertEqual(names.deferred["f"], (set(["step"]), set(["counter"])))
+
+    def test_star_import(self):
+        names = analyse_python_code("from os.path import *")
+        self.assertTrue(names.star_import)
+        self.assertEqual(names.defines, set())
+
+    def test_imports(self):
+        names = analyse_python_code("import os.path\nfrom json import loads as l")
+        self.assertEqual(names.imports, set(["os", "l"]))
+        self.assertEqual(names.defines, set(["os", "l"]))
+
+    def test_augmented_assignment(self):
+        names = analyse_python_code("x += 1\nd['a'] += 1")
+        self.assertEqual(names.defines, set(["x"]))
+        self.assertEqual(names.reads, set(["x", "d"]))
+        self.assertEqual(names.modifies, set(["d"]))
+
+    def test_mutation(self):
+        names = analyse_python_code("a.b = 1\nc[0] = 2\nd.e.append(3)")
+        self.assertEqual(names.modifies, set(["a", "c"]))
+        self.assertEqual(names.calls, set(["d"]))
+        self.assertEqual(names.defines, set())
+
+    def test_magics(self):
+        code = "get_ipython().run_line_magic('matplotlib', 'inline')"
+        self.assertFalse(analyse_python_code(code).opaque)
+        code = "get_ipython().run_line_magic('run', 'other.py')"
+        self.assertTrue(analyse_python_code(code).opaque)
+
+
+class FindDependenciesTestCase(unittest.TestCase):
+
+    def test_last_writer(self):
+        self.assertEqual(_dependencies("x = 1", "x = 2", "print(x)"), [[], [], [1]])
+
+    def test_class_body(self):
+        self.assertEqual(_dependencies("x = 5", "class A:\n    x = 1", "print(x)"),
+                         [[], [], [0]])
+
+    def test_comprehension(self):
+        self.assertEqual(_dependencies("x = 5", "zeros = [0 for x in range(3)]", "print(x)"),
+                         [[], [], [0]])
+
+    def test_global_in_function(self):
+        deps = _dependencies("step = 1", "def f():\n    global counter\n    counter = step",
+                             "f()", "print(counter)")
+        self.assertEqual(deps, [[], [], [0, 1], [2]])
+
+    def test_star_import(self):
+        self.assertEqual(_dependencies("x = 1", "from os.path import *", "print(join, x)"),
+                         [[], [], [0, 1]])
+
+    def test_augmented_assignment(self):
+        self.assertEqual(_dependencies("x = 1", "x += 1", "print(x)"), [[], [0], [1]])
+
+    def test_mutation(self):
+        deps = _dependencies("x = []", "x.append(1)", "x[0] = 2", "x.attr = 3", "print(x)")
+        self.assertEqual(deps, [[], [0], [1], [2], [3]])
+
+    def test_imported_modules_are_not_modified(self):
+        self.assertEqual(_dependencies("import os", "os.getcwd()", "print(os)"),
+                         [[], [0], [0]])
+
+    def test_unanalysable_and_opaque(self):
+        deps = _dependencies("x = 1", "x = (", "y = 2",
+                             "get_ipython().run_line_magic('run', 'a.py')", "print(y)")
+        self.assertEqual(deps, [[], [0], [], [0, 1, 2], [2, 3]])
+
+    def test_dependson(self):
+        chunks = [_Chunk("x = 1", {"chunk_label": "first"}), _Chunk("y = 2"),
+                  _Chunk("print(y)", {"dependson": "first"})]
+        find_dependencies(chunks, logging.getLogger("knitpy-test"))
+        self.assertEqual(chunks[2].dependencies, [0, 1])
+        self.assertEqual(chunks[2].declared_dependencies, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import os
+import re
+import tempfile
+import unittest
+
+from pypandoc import get_pandoc_version
+
+from knitpy.cache import MarkupCache
+from knitpy.documents import (TemporaryOutputDocument, FinalOutputConfiguration,
+                              KnitpyOutputException)
+
+
+def _has_pandoc():
+    try:
+        get_pandoc_version()
+        return True
+    except Exception:
+        return False
+
+
+class _ConvertingDocument(TemporaryOutputDocument):
+    """Converts latex markup with a small regex "pandoc" and records the conversions"""
+
+    def __init__(self, *args, **kwargs):
+        super(_ConvertingDocument, self).__init__(*args, **kwargs)
+        self.conversions = []
+
+    def _run_pandoc(self, mimetype, mimedata):
+        self.conversions.append(mimedata)
+        if "\\fail" in mimedata:
+            raise KnitpyOutputException("can't convert \\fail")
+        # like pandoc, an unclosed environment swallows everything after it (incl. the markers)
+        text = re.sub(r"\\begin\{comment\}.*", "", mimedata, flags=re.DOTALL)
+        return re.sub(r"\\textbf\{(.*?)\}", r"**\1**", text) + "\n"
+
+
+class ConvertPendingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        export_config = FinalOutputConfiguration(name="html_document", alias="html",
+                                                 pandoc_export_format="html",
+                                                 file_extension="html")
+        self.document = _ConvertingDocument(tempfile.gettempdir(), export_config)
+
+    def test_one_run_for_all_markup(self):
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.document.add_markup_text("text/latex", "\\textbf{two}")
+        self.assertEqual(self.document.conversions, [])
+        self.assertEqual(self.document.content, "\n**one**\n\n\n**two**\n\n")
+        self.assertEqual(len(self.document.conversions), 1)
+
+    def test_lost_markers(self):
+        # the comment swallows the marker after it, so the batch can't be split again
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.document.add_markup_text("text/latex", "\\begin{comment}")
+        self.document.add_markup_text("text/latex", "\\textbf{three}")
+        content = self.document.content
+        # the batch and then each part on its own
+        self.assertEqual(len(self.document.conversions), 4)
+        self.assertEqual(self.document.conversions[1:],
+                         ["\\textbf{one}", "\\begin{comment}", "\\textbf{three}"])
+        self.assertEqual(content, "\n**one**\n\n\n\n\n\n**three**\n\n")
+
+    def test_failed_conversion_uses_fallback(self):
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.document.add_markup_text("text/latex", "\\fail",
+                                      fallbacks=[("text/plain", "plain text")])
+        content = self.document.content
+        self.assertIn("**one**", content)
+        self.assertIn("```\n## plain text\n```", content)
+        self.assertNotIn("fail", content)
+
+    def test_without_batching(self):
+        self.document.batch_markup_conversions = False
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.assertEqual(self.document.conversions, ["\\textbf{one}"])
+        with self.assertRaises(KnitpyOutputException):
+            self.document.add_markup_text("text/latex", "\\fail")
+
+    def test_batch_size(self):
+        self.document.markup_batch_size = 2
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.assertEqual(self.document.conversions, [])
+        self.document.add_markup_text("text/latex", "\\textbf{two}")
+        self.assertEqual(len(self.document.conversions), 1)
+        self.document.add_markup_text("text/latex", "\\textbf{three}")
+        self.assertIn("**three**", self.document.content)
+        self.assertEqual(len(self.document.conversions), 2)
+
+    @unittest.skipUnless(_has_pandoc(), "the keys of the markup cache need pandoc")
+    def test_markup_cache(self):
+        cache = MarkupCache()
+        self.document.markup_cache = cache
+        self.document.add_markup_text("text/latex", "\\textbf{one}")
+        self.document.add_markup_text("text/latex", "\\textbf{two}")
+        content = self.document.content
+        # a later document with the same markup (and one new part)
+        document = _ConvertingDocument(tempfile.gettempdir(), self.document.export_config,
+                                       markup_cache=cache)
+        document.add_markup_text("text/latex", "\\textbf{one}")
+        document.add_markup_text("text/latex", "\\textbf{two}")
+        self.assertEqual(document.content, content)
+        self.assertEqual(document.conversions, [])
+        document.add_markup_text("text/latex", "\\textbf{three}")
+        self.assertIn("**three**", document.content)
+        self.assertEqual(document.conversions, ["\\textbf{three}"])
+
+
+class StreamToFileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        export_config = FinalOutputConfiguration(name="html_document", alias="html",
+                                                 pandoc_export_format="html",
+                                                 file_extension="html")
+        self.documents = [_ConvertingDocument(tempfile.gettempdir(), export_config,
+                                              stream_to_file=stream_to_file)
+                          for stream_to_file in (False, True)]
+
+    def tearDown(self):
+        for document in self.documents:
+            document.cleanup()
+
+    def _add(self, method, *args):
+        for document in self.documents:
+            getattr(document, method)(*args)
+
+    def test_same_content(self):
+        for number in range(50):
+            self._add("add_text", "Paragraph %s\n\n" % number)
+            self._add("add_code", "x = %s\n" % number)
+            self._add("add_text", "\n")
+        in_memory, streamed = self.documents
+        # the flushed parts are in the file, only the last one stays in memory
+        self.assertLess(len(streamed._output), 5)
+        self.assertTrue(streamed._file.tell() > 0)
+        self.assertEqual(streamed.content, in_memory.content)
+
+    def test_pending_markup(self):
+        for document in self.documents:
+            document.markup_batch_size = 10
+        for number in range(50):
+            self._add("add_text", "Paragraph %s\n\n" % number)
+            self._add("add_markup_text", "text/latex", "\\textbf{%s}" % number)
+        in_memory, streamed = self.documents
+        # the placeholders (and everything after them) stay in memory until they are converted
+        self.assertLess(len(streamed._output), len(in_memory._output) // 2)
+        self.assertEqual(streamed.content, in_memory.content)
+        self.assertIn("**49**", streamed.content)
+        self.assertEqual(len(streamed.conversions), 5)
+
+    def test_cleanup(self):
+        streamed = self.documents[1]
+        streamed.add_text("text\n")
+        filename = streamed.save()
+        self.assertTrue(os.path.exists(filename))
+        streamed.cleanup()
+        self.assertFalse(os.path.exists(filename))
+
+
+if __name__ == "__main__":
+    unittest.main()
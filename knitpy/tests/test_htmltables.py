@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import unittest
+
+from knitpy.htmltables import html_tables_to_markdown
+
+# the html of a small pandas DataFrame (`df._repr_html_()`)
+PANDAS_TABLE = """<div>
+<style scoped>
+    .dataframe tbody tr th:only-of-type {
+        vertical-align: middle;
+    }
+</style>
+<table border="1" class="dataframe">
+  <thead>
+    <tr style="text-align: right;">
+      <th></th>
+      <th>name</th>
+      <th>value</th>
+    </tr>
+  </thead>
+  <tbody>
+    <tr>
+      <th>0</th>
+      <td>a</td>
+      <td>1.5</td>
+    </tr>
+    <tr>
+      <th>1</th>
+      <td>b</td>
+      <td>NaN</td>
+    </tr>
+  </tbody>
+</table>
+<p>2 rows × 2 columns</p>
+</div>"""
+
+
+class HtmlTablesTestCase(unittest.TestCase):
+
+    def test_pandas_table(self):
+        expected = "|  | name | value |\n" +\
+                   "|---:|---|---:|\n" +\
+                   "| 0 | a | 1.5 |\n" +\
+                   "| 1 | b | NaN |\n" +\
+                   "\n" +\
+                   "2 rows × 2 columns\n"
+        self.assertEqual(html_tables_to_markdown(PANDAS_TABLE), expected)
+
+    def test_multiline_cells(self):
+        html = "<table><tr><th>a</th></tr><tr><td>one<br>two</td></tr></table>"
+        expected = "+-----+\n" +\
+                   "| a   |\n" +\
+                   "+=====+\n" +\
+                   "| one |\n" +\
+                   "| two |\n" +\
+                   "+-----+\n"
+        self.assertEqual(html_tables_to_markdown(html), expected)
+
+    def test_escaping(self):
+        html = "<table><tr><th>a|b</th></tr><tr><td>*x* &amp; _y_ &#124;</td></tr></table>"
+        expected = "| a\\|b |\n" +\
+                   "|---|\n" +\
+                   "| \\*x\\* \\& \\_y\\_ \\| |\n"
+        self.assertEqual(html_tables_to_markdown(html), expected)
+
+    def test_spanning_cells(self):
+        for attr in ('colspan="2"', 'rowspan="2"'):
+            html = "<table><tr><th %s>a</th><th>b</th></tr></table>" % attr
+            self.assertIsNone(html_tables_to_markdown(html))
+        html = '<table><tr><th colspan="1">a</th></tr></table>'
+        self.assertEqual(html_tables_to_markdown(html), "| a |\n|---|\n")
+
+    def test_bad_entities(self):
+        for entity in ("&#1114112;", "&#x110000;", "&#99999999999999999999;", "&nosuchentity;"):
+            html = "<table><tr><th>%s</th></tr></table>" % entity
+            self.assertIsNone(html_tables_to_markdown(html))
+
+    def test_unsupported_html(self):
+        for html in ("<p>no table</p>",
+                     "<table><tr><th>a</th></tr><tr><td><table></table></td></tr></table>",
+                     "<table><tr><th><b>bold</b></th></tr></table>",
+                     "<table><tr><th>unclosed</th></tr>"):
+            self.assertIsNone(html_tables_to_markdown(html))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import time
+import unittest
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from knitpy.inprocess import INPROCESS_KERNEL_NAME
+from knitpy.kernels import KernelPool
+from knitpy.sqlkernel import SQL_KERNEL_NAME
+
+
+class KernelPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = KernelPool()
+
+    def tearDown(self):
+        self.pool.shutdown_all()
+
+    def test_shutdown_all_in_use(self):
+        kernels = [self.pool.acquire(INPROCESS_KERNEL_NAME), self.pool.acquire(SQL_KERNEL_NAME)]
+        self.pool.prestart(SQL_KERNEL_NAME)
+        self.assertTrue(all(kernel.manager.is_alive() for kernel in kernels))
+        self.pool.shutdown_all()
+        # the kernel threads end after their current request
+        deadline = time.time() + 5
+        while any(kernel.manager.is_alive() for kernel in kernels) and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(any(kernel.manager.is_alive() for kernel in kernels))
+
+    def test_reuse(self):
+        self.pool.size = 1
+        self.pool.max_uses = 2
+        kernel = self.pool.acquire("python3")
+        self.pool.release(kernel, clean=True)
+        self.assertIs(self.pool.acquire("python3"), kernel)
+        self.assertEqual(kernel.uses, 2)
+        self.pool.release(kernel, clean=True)
+        # used up: a fresh kernel replaces it
+        other = self.pool.acquire("python3")
+        self.assertIsNot(other, kernel)
+        self.assertEqual(other.uses, 1)
+        self.assertFalse(kernel.manager.is_alive())
+
+    def test_not_clean(self):
+        self.pool.size = 1
+        kernel = self.pool.acquire("python3")
+        self.pool.release(kernel, clean=False)
+        self.assertIsNot(self.pool.acquire("python3"), kernel)
+
+    def test_cull_idle(self):
+        self.pool.cull_idle_timeout = 10
+        self.pool.prestart(INPROCESS_KERNEL_NAME)
+        self.pool.prestart(SQL_KERNEL_NAME)
+        old = self.pool._idle[INPROCESS_KERNEL_NAME][0]
+        recent = self.pool._idle[SQL_KERNEL_NAME][0]
+        old.last_used -= 20
+        self.pool.cull_idle()
+        self.assertEqual(self.pool._idle[INPROCESS_KERNEL_NAME], [])
+        self.assertEqual(self.pool._idle[SQL_KERNEL_NAME], [recent])
+        deadline = time.time() + 5
+        while old.manager.is_alive() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(old.manager.is_alive())
+
+    @unittest.skipUnless(hasattr(resource, "prlimit"), "needs resource.prlimit (linux)")
+    def test_memory_limit(self):
+        self.pool.memory_limit = 500
+        kernel = self.pool.acquire("python3")
+        self.assertEqual(kernel.memory_limit, 500 * 1024 * 1024)
+        # a chunk can only lower the limit
+        self.pool.set_memory_limit(kernel, 100)
+        self.assertEqual(kernel.memory_limit, 100 * 1024 * 1024)
+        self.pool.set_memory_limit(kernel, 1000)
+        self.assertEqual(kernel.memory_limit, 500 * 1024 * 1024)
+        self.pool.set_memory_limit(kernel)
+        self.assertEqual(kernel.memory_limit, 500 * 1024 * 1024)
+        soft, hard = resource.prlimit(kernel.manager.provisioner.process.pid, resource.RLIMIT_AS)
+        self.assertEqual(soft, 500 * 1024 * 1024)
+
+
+class MessageDispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = KernelPool()
+        self.kernel = self.pool.acquire(INPROCESS_KERNEL_NAME)
+        self.dispatcher = self.pool.dispatcher
+
+    def tearDown(self):
+        self.pool.shutdown_all()
+
+    def test_finished_request(self):
+        request = self.dispatcher.execute(self.kernel.client, "print(1)")
+        self.assertTrue(self.dispatcher.wait(request, timeout=5))
+        self.assertEqual(request.messages[-1]["content"]["text"], "1\n")
+        self.assertNotIn(request.msg_id, self.dispatcher._requests)
+
+    def test_given_up_request(self):
+        code = "import time\ntime.sleep(0.5)"
+        request = self.dispatcher.execute(self.kernel.client, code)
+        self.assertFalse(self.dispatcher.wait(request, timeout=0.1, give_up=False))
+        # still dispatched: e.g. waiting again after an interrupt
+        self.assertIn(request.msg_id, self.dispatcher._requests)
+        self.assertFalse(self.dispatcher.wait(request, timeout=0.1))
+        self.assertNotIn(request.msg_id, self.dispatcher._requests)
+        # the late messages are dropped
+        time.sleep(0.6)
+        self.dispatcher.poll(0.1)
+        self.assertIsNone(request.reply)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+from pypandoc import get_pandoc_version
+
+from knitpy.documents import TemporaryOutputDocument, FinalOutputConfiguration
+from knitpy.pandocserver import PandocServer, PandocServerUnavailable
+
+# a `pandoc server` which "converts" text to upper case
+FAKE_SERVER = """#!%s
+import json, os, sys
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+class Handler(BaseHTTPRequestHandler):
+    def _answer(self, code, body):
+        body = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._answer(200, "3.1")
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8"))
+        if request["text"] == "die":
+            os._exit(1)
+        if request["text"] == "fail":
+            self._answer(400, "can't convert")
+        else:
+            self._answer(200, json.dumps({"output": request["text"].upper()}))
+
+    def log_message(self, *args):
+        pass
+
+HTTPServer(("127.0.0.1", int(sys.argv[sys.argv.index("--port") + 1])), Handler).serve_forever()
+"""
+
+
+def _has_pandoc():
+    try:
+        get_pandoc_version()
+        return True
+    except Exception:
+        return False
+
+
+class PandocServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _server(self, script=None, executable=None):
+        if script is not None:
+            executable = os.path.join(self.directory, "pandoc")
+            with open(executable, "w") as f:
+                f.write(script)
+            os.chmod(executable, os.stat(executable).st_mode | stat.S_IXUSR)
+        server = PandocServer(executable=executable, startup_timeout=5)
+        self.servers.append(server)
+        return server
+
+    def test_convert(self):
+        server = self._server(FAKE_SERVER % sys.executable)
+        self.assertEqual(server.convert("abc", to="markdown", format="html"), "ABC")
+        self.assertEqual(server.convert("def", to="markdown", format="html"), "DEF")
+        self.assertTrue(server.available)
+
+    def test_conversion_error(self):
+        server = self._server(FAKE_SERVER % sys.executable)
+        # like pypandoc and the server is still used
+        with self.assertRaises(RuntimeError):
+            server.convert("fail", to="markdown", format="html")
+        self.assertTrue(server.available)
+        self.assertEqual(server.convert("abc", to="markdown", format="html"), "ABC")
+
+    def test_server_dies(self):
+        server = self._server(FAKE_SERVER % sys.executable)
+        self.assertEqual(server.convert("abc", to="markdown", format="html"), "ABC")
+        with self.assertRaises(PandocServerUnavailable):
+            server.convert("die", to="markdown", format="html")
+        self.assertFalse(server.available)
+        with self.assertRaises(PandocServerUnavailable):
+            server.convert("abc", to="markdown", format="html")
+
+    def test_missing_executable(self):
+        server = self._server(executable=os.path.join(self.directory, "no-pandoc"))
+        with self.assertRaises(PandocServerUnavailable):
+            server.convert("abc", to="markdown", format="html")
+        self.assertFalse(server.available)
+
+    def test_no_server_mode(self):
+        # like a pandoc < 3, which exits with an error
+        server = self._server("#!/bin/sh\necho \"Unknown input format server\" >&2\nexit 2\n")
+        with self.assertRaises(PandocServerUnavailable):
+            server.convert("abc", to="markdown", format="html")
+        self.assertFalse(server.available)
+
+    def _document(self, server):
+        export_config = FinalOutputConfiguration(name="html_document", alias="html",
+                                                 pandoc_export_format="html",
+                                                 file_extension="html")
+        return TemporaryOutputDocument(self.directory, export_config, pandoc_server=server,
+                                       batch_markup_conversions=False)
+
+    def test_document_uses_server(self):
+        document = self._document(self._server(FAKE_SERVER % sys.executable))
+        document.add_markup_text("text/latex", "abc")
+        self.assertEqual(document.content, "\nABC\n")
+
+    @unittest.skipUnless(_has_pandoc(), "needs pandoc")
+    def test_document_fallback(self):
+        server = self._server(executable=os.path.join(self.directory, "no-pandoc"))
+        document = self._document(server)
+        # converted with a pandoc subprocess
+        document.add_markup_text("text/latex", "\\textbf{abc}")
+        self.assertEqual(document.content.strip(), "**abc**")
+        self.assertFalse(server.available)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+# Copyright (c) Jan Schulz <jasc@gmx.net>
+# Distributed under the terms of the Modified BSD License.
+
+from __future__ import unicode_literals
+
+import codecs
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import yaml
+from traitlets.config import Config
+
+from knitpy.documents import TemporaryOutputDocument
+from knitpy.forkserver import is_supported as fork_is_supported
+from knitpy.knitpy import Knitpy
+from knitpy.tests import AbstractOutputTestCase
+
+TESTS_DIR = os.path.dirname(__file__)
+
+
+class _MarkdownKnitpy(Knitpy):
+    """Writes the temporary markdown as final output instead of converting it with pandoc"""
+
+    def _convert_final_format(self, filename, basename, final_format, md_temp):
+        outfilename = basename + "." + final_format.file_extension
+        if md_temp.stream_to_file:
+            shutil.copyfile(md_temp.save(), outfilename)
+        else:
+            with codecs.open(outfilename, 'w', 'UTF-8') as f:
+                f.write(md_temp.content)
+        return outfilename
+
+
+class RenderTestCase(AbstractOutputTestCase):
+    """Renders copies of the test documents in a temporary directory"""
+
+    def setUp(self):
+        super(RenderTestCase, self).setUp()
+        self.knitpy = _MarkdownKnitpy()
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.knitpy.shutdown_kernels()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def _copy(self, name):
+        """Copies the test document `name` (e.g. "basics/loops") into the temporary directory
+
+        returns the filename of the copy and the expected output
+        """
+        filename = os.path.join(self.directory, os.path.basename(name) + ".pymd")
+        shutil.copyfile(os.path.join(TESTS_DIR, name + ".pymd"), filename)
+        return filename, self._read(os.path.join(TESTS_DIR, name + ".md"))
+
+    def _read(self, filename):
+        with codecs.open(filename, 'r', 'UTF-8') as f:
+            return f.read()
+
+
+class MultipleFormatsTestCase(RenderTestCase):
+    """Executes the code once and writes the results into all output formats"""
+
+    def test_fixtures(self):
+        for name in ("blocks", "inlinecode", "loops", "statements"):
+            filename = os.path.join(TESTS_DIR, "basics", name + ".pymd")
+            parsed, metadata = self.knitpy.parse_document(self._read(filename))
+            md_temps = [TemporaryOutputDocument(fileoutputs=self.directory,
+                                                export_config=self.knitpy.get_output_format(fmt),
+                                                log=self.knitpy.log, parent=self.knitpy)
+                        for fmt in ("html", "latex")]
+            self.knitpy.convert(parsed, md_temps)
+            expected = self._read(os.path.join(TESTS_DIR, "basics", name + ".md"))
+            for md_temp in md_temps:
+                self.assert_equal_output(expected, md_temp.content)
+
+    def test_render_all(self):
+        filename = os.path.join(self.directory, "formats.pymd")
+        with codecs.open(filename, 'w', 'UTF-8') as f:
+            f.write("---\noutput:\n  html_document: default\n  latex_document: default\n---\n\n"
+                    "```{python}\nwith open('runs.txt', 'a') as f:\n    f.write('run')\n```\n")
+        outfilenames = self.knitpy.render(filename, output="all")
+        self.assertEqual([os.path.basename(name) for name in outfilenames],
+                         ["formats.html", "formats.tex"])
+        self.assertEqual(self._read(outfilenames[0]), self._read(outfilenames[1]))
+        # the code ran only once
+        self.assertEqual(self._read(os.path.join(self.directory, "runs.txt")), "run")
+
+
+class StreamToFileTestCase(RenderTestCase):
+    """Writes the temporary markdown to a file while the document is executed"""
+
+    def setUp(self):
+        super(StreamToFileTestCase, self).setUp()
+        self.knitpy = _MarkdownKnitpy(
+            config=Config({"TemporaryOutputDocument": {"stream_to_file": True}}))
+
+    def test_fixtures(self):
+        for name in ("basics/blocks", "basics/inlinecode", "basics/loops", "basics/statements",
+                     "chunk_options/results"):
+            filename, expected = self._copy(name)
+            outfilename, = self.knitpy.render(filename)
+            self.assert_equal_output(expected, self._read(outfilename))
+
+
+@unittest.skipUnless(fork_is_supported(), "needs forking kernels")
+class SweepTestCase(RenderTestCase):
+    """Renders a document for more than one parameter set (see Knitpy.render_sweep)"""
+
+    def _runs(self, fork_kernels):
+        filename = os.path.join(self.directory, "runs.pymd")
+        with codecs.open(filename, 'w', 'UTF-8') as f:
+            f.write("```{python}\nwith open('runs.txt', 'a') as f:\n    f.write('x')\n```\n\n"
+                    "```{python}\nprint(params['n'])\n```\n")
+        self.knitpy.fork_kernels = fork_kernels
+        outfilenames = self.knitpy.render_sweep(filename, [{"n": 1}, {"n": 2}, {"n": 3}])
+        for n, outfilename in enumerate(outfilenames, 1):
+            self.assertIn("## %s" % n, self._read(outfilename))
+        runs = os.path.join(self.directory, "runs.txt")
+        count = len(self._read(runs))
+        os.remove(runs)
+        return count
+
+    def test_fixture(self):
+        filename, expected = self._copy("params/report")
+        outfilenames = self.knitpy.render_sweep(filename, [{"n": 1}, {"n": 2}, {"n": 3}])
+        self.assertEqual([os.path.basename(name) for name in outfilenames],
+                         ["report-1.html", "report-2.html", "report-3.html"])
+        for outfilename, result in zip(outfilenames, ["3.14", "6.28", "9.42"]):
+            self.assert_equal_output(expected.replace("## 3.14", "## " + result),
+                                     self._read(outfilename))
+
+    def test_setup_chunks_run_once(self):
+        # the first parameter set and the template process
+        self.assertEqual(self._runs(fork_kernels=True), 2)
+        self.assertEqual(self._runs(fork_kernels=False), 3)
+
+
+# `knitpy` with the markdown only Knitpy (also in the forked worker processes)
+KNITPY_SCRIPT = """
+from knitpy import knitpyapp
+from knitpy.tests.test_render import _MarkdownKnitpy
+knitpyapp.Knitpy = _MarkdownKnitpy
+knitpyapp.launch_new_instance()
+"""
+
+
+@unittest.skipUnless(multiprocessing.get_start_method() == "fork",
+                     "the workers have to inherit the markdown only Knitpy")
+class ParallelDocumentsTestCase(RenderTestCase):
+    """Converts the documents in worker processes (`knitpy -j N`)"""
+
+    def _knitpy(self, *args):
+        # a new process: worker processes which are forked from a process which already used
+        # kernels can't start kernels
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(TESTS_DIR))
+        env["PYTHONPATH"] = os.pathsep.join([package_dir] +
+                                            [p for p in [env.get("PYTHONPATH")] if p])
+        subprocess.check_call([sys.executable, "-c", KNITPY_SCRIPT, "--to=latex"] + list(args),
+                              cwd=self.directory, env=env)
+
+    def _outfilename(self, filename, suffix=""):
+        return os.path.splitext(filename)[0] + suffix + ".tex"
+
+    def test_documents(self):
+        documents = [self._copy("basics/loops"), self._copy("basics/statements")]
+        self._knitpy("-j", "2", *[filename for filename, expected in documents])
+        for filename, expected in documents:
+            self.assert_equal_output(expected, self._read(self._outfilename(filename)))
+
+    def test_params_file(self):
+        report, expected_report = self._copy("params/report")
+        loops, expected_loops = self._copy("basics/loops")
+        params_file = os.path.join(self.directory, "params.yaml")
+        with open(params_file, "w") as f:
+            yaml.safe_dump([{"n": 1}, {"n": 2}], f)
+        self._knitpy("-j", "2", "--params-file=%s" % params_file, report, loops)
+        self.assert_equal_output(expected_report, self._read(self._outfilename(report, "-1")))
+        self.assert_equal_output(expected_report.replace("## 3.14", "## 6.28"),
+                                 self._read(self._outfilename(report, "-2")))
+        for suffix in ("-1", "-2"):
+            self.assert_equal_output(expected_loops, self._read(self._outfilename(loops, suffix)))
+
+
+if __name__ == '__main__':
+    unittest.main()